@@ -0,0 +1,119 @@
+"""
+Deterministic benchmark dataset, generated from a seed at a given scale and
+loaded on top of the test fixtures with COPY
+The same seed and scale always produce the same rows with the same ids,
+so results from different commits are comparable
+"""
+import datetime
+import random
+import asyncpg
+import bulk_load
+import migrate
+
+
+FIXTURES = 'test/integration/fixtures/initialise_postgresdb.sql'
+
+# purchases are spread over the year before this, not before now
+END_TS = datetime.datetime(2022, 1, 1)
+DAYS = 365
+
+DEFAULT_SCALE = dict(
+    entities=100000,
+    companies=1000,
+    products=100000,
+    company_products=200000,
+    purchases=1000000,
+    max_items=3
+)
+
+
+def generate_entities(rng, n, prefix):
+    for i in range(n):
+        yield ('%s %d' % (prefix, i), 0, rng.randint(0, 50))
+
+
+def generate_products(rng, n):
+    for i in range(n):
+        yield ('product %d' % i, rng.randint(0, 200000))
+
+
+def generate_company_products(rng, n, comp_ids, prod_ids):
+    n = min(n, len(comp_ids) * len(prod_ids))
+    pairs = set()
+    while len(pairs) < n:
+        pairs.add((rng.choice(comp_ids), rng.choice(prod_ids)))
+    for comp_id, prod_id in sorted(pairs):
+        yield (comp_id, prod_id, rng.randint(0, 200000))
+
+
+def generate_purchases(rng, n, user_ids, comp_ids, prod_ids, max_items):
+    """
+    Purchases in the format bulk_load.load takes, items are sold by the seller
+    """
+    for _ in range(n):
+        selr_id = rng.choice(comp_ids)
+        yield dict(
+            buyr_id=rng.choice(user_ids),
+            selr_id=selr_id,
+            price=rng.randint(100, 100000),
+            carbon_cost=rng.randint(0, 500000),
+            ts=(END_TS - datetime.timedelta(seconds=rng.randrange(DAYS * 86400))).timestamp(),
+            item_list=[
+                dict(comp_id=selr_id, prod_id=rng.choice(prod_ids))
+                for _ in range(rng.randint(0, max_items))
+            ]
+        )
+
+
+async def copy_with_ids(conn, table, columns, records):
+    records = list(records)
+    ids = await bulk_load.reserve_ids(conn, table, len(records))
+    await conn.copy_records_to_table(
+        table, records=[(id,) + record for id, record in zip(ids, records)],
+        columns=['id'] + columns)
+    return ids
+
+
+async def generate(dsn, seed=0, chunk_size=10000, **scale):
+    """
+    Recreate the tables from the fixtures, migrate them and load a dataset
+    of the given scale, any scale not given takes its DEFAULT_SCALE
+    """
+    scale = dict(DEFAULT_SCALE, **scale)
+    rng = random.Random(seed)
+    with open(FIXTURES) as f:
+        fixtures = f.read()
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(fixtures)
+        await migrate.migrate(dsn)
+        async with conn.transaction():
+            user_ids = await copy_with_ids(
+                conn, 'entity', ['display_name', 'carbon_offset', 'carbon_cost'],
+                generate_entities(rng, scale['entities'] - scale['companies'], 'user'))
+            comp_ids = await copy_with_ids(
+                conn, 'entity', ['display_name', 'carbon_offset', 'carbon_cost'],
+                generate_entities(rng, scale['companies'], 'company'))
+            prod_ids = await copy_with_ids(
+                conn, 'product', ['item_name', 'carbon_cost'],
+                generate_products(rng, scale['products']))
+            await conn.copy_records_to_table(
+                'company_product',
+                records=list(generate_company_products(
+                    rng, scale['company_products'], comp_ids, prod_ids)),
+                columns=['comp_id', 'prod_id', 'carbon_cost'])
+        await conn.execute('ANALYZE')
+    finally:
+        await conn.close()
+
+    await bulk_load.load(dsn, generate_purchases(
+        rng, scale['purchases'], user_ids, comp_ids, prod_ids, scale['max_items']),
+        chunk_size)
+
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute('ANALYZE')
+    finally:
+        await conn.close()
+    return scale
@@ -0,0 +1,277 @@
+"""
+Latency benchmark: drive each endpoint at a fixed concurrency against an app
+built by make_app on a local Postgres, and save throughput and latency
+percentiles as JSON
+
+$ python -m bench.run --generate --purchases 1000000 --products 100000
+$ python -m bench.run --concurrency 64 --requests 5000 --output bench.json
+$ python -m bench.run --url http://localhost:8888 --endpoints entity_get,purchase_get
+
+The app is served from a child process, so the client does not compete with
+it for the event loop. The BENCH section of config.ini is used by default.
+"""
+import argparse
+import asyncio
+import configparser
+import datetime
+import json
+import logging
+import math
+import multiprocessing
+import random
+import subprocess
+import time
+import asyncpg
+import tornado.httpclient
+import tornado.ioloop
+from bench import dataset
+from main import make_app
+
+
+logger = logging.getLogger('bench')
+
+MULTI_GET_SIZE = 20
+
+
+async def load_targets(dsn):
+    """
+    The id ranges the requests are drawn from, taken from the database so a
+    dataset generated earlier can be reused
+    """
+    conn = await asyncpg.connect(dsn)
+    try:
+        users = await conn.fetchrow(
+            "SELECT min(id), max(id) FROM entity WHERE display_name LIKE 'user %'")
+        entities = await conn.fetchrow('SELECT min(id), max(id) FROM entity')
+        products = await conn.fetchrow('SELECT min(id), max(id) FROM product')
+        purchases = await conn.fetchrow('SELECT min(id), max(id) FROM purchase')
+        pairs = await conn.fetch(
+            'SELECT comp_id, prod_id FROM company_product ORDER BY comp_id, prod_id LIMIT 10000')
+    finally:
+        await conn.close()
+    return dict(
+        # the fixtures alone have no generated users
+        users=tuple(users) if users[0] is not None else tuple(entities),
+        entities=tuple(entities),
+        products=tuple(products),
+        purchases=tuple(purchases),
+        company_products=[tuple(pair) for pair in pairs]
+    )
+
+
+def pick(rng, id_range):
+    return rng.randint(*id_range)
+
+
+def purchase_body(rng, targets):
+    comp_id, prod_id = rng.choice(targets['company_products'])
+    return dict(
+        buyr_id=pick(rng, targets['users']),
+        selr_id=comp_id,
+        price=rng.randint(100, 100000),
+        carbon_cost=None,
+        item_list=[dict(comp_id=comp_id, prod_id=prod_id)]
+    )
+
+
+def time_range(rng, days):
+    end = dataset.END_TS - datetime.timedelta(days=rng.randrange(dataset.DAYS - days))
+    return (end - datetime.timedelta(days=days)).timestamp(), end.timestamp()
+
+
+def ids(rng, id_range):
+    return ','.join(str(pick(rng, id_range)) for _ in range(MULTI_GET_SIZE))
+
+
+# name: function of (rng, targets) returning (method, path, body)
+ENDPOINTS = {
+    'entity_get': lambda rng, t: (
+        'GET', '/entity/get/%d' % pick(rng, t['entities']), None),
+    'entity_get_multi': lambda rng, t: (
+        'GET', '/entity/get?ids=%s' % ids(rng, t['entities']), None),
+    'product_get': lambda rng, t: (
+        'GET', '/product/get/%d' % pick(rng, t['products']), None),
+    'product_company_get': lambda rng, t: (
+        'GET', '/product/get/%d/%d' % rng.choice(t['company_products']), None),
+    'purchase_get': lambda rng, t: (
+        'GET', '/purchase/get/%d' % pick(rng, t['purchases']), None),
+    'purchase_get_multi': lambda rng, t: (
+        'GET', '/purchase/get?ids=%s' % ids(rng, t['purchases']), None),
+    'entity_purchases_get': lambda rng, t: (
+        'GET', '/entity/purchases/get/%d?start_ts=%f&end_ts=%f&limit=100' % (
+            (pick(rng, t['users']),) + time_range(rng, 30)), None),
+    'entity_carbon_get': lambda rng, t: (
+        'GET', '/entity/carbon/get/%d?start_ts=%f&end_ts=%f&bucket=week' % (
+            (pick(rng, t['users']),) + time_range(rng, 90)), None),
+    'purchase_add': lambda rng, t: (
+        'POST', '/purchase/add', purchase_body(rng, t)),
+    'entity_update': lambda rng, t: (
+        'POST', '/entity/update', dict(
+            id=pick(rng, t['users']), carbon_offset=rng.randint(0, 1000),
+            carbon_cost=rng.randint(0, 50)))
+}
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+async def drive(url, make_request, n_requests, concurrency, rng, targets):
+    """
+    Send n_requests with concurrency of them in flight at all times
+    Returns the throughput, latency percentiles in milliseconds and errors
+    """
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    # built up front, so drawing the requests is not timed
+    requests = []
+    for _ in range(n_requests):
+        method, path, body = make_request(rng, targets)
+        requests.append(tornado.httpclient.HTTPRequest(
+            url + path, method=method,
+            body=None if body is None else json.dumps(body)))
+    pending = iter(requests)
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for request in pending:
+            start = time.perf_counter()
+            response = await client.fetch(request, raise_error=False)
+            latencies.append(time.perf_counter() - start)
+            if response.code >= 500 or response.code == 599:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    client.close()
+
+    latencies.sort()
+    return dict(
+        requests=n_requests,
+        errors=errors,
+        seconds=elapsed,
+        throughput=n_requests / elapsed,
+        mean_ms=sum(latencies) / len(latencies) * 1000,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p95_ms=percentile(latencies, 95) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        max_ms=latencies[-1] * 1000
+    )
+
+
+def serve_app(config, port):
+    # asyncio.run in the parent, e.g. for --generate, leaves no current
+    # event loop to inherit through the fork, and make_app needs one
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    app, db = make_app(config)
+    app.listen(port)
+    tornado.ioloop.IOLoop.current().start()
+
+
+async def wait_until_up(url, timeout=30):
+    client = tornado.httpclient.AsyncHTTPClient()
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            await client.fetch(url + '/ping')
+            return
+        except (OSError, tornado.httpclient.HTTPClientError):
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args, section):
+    targets = await load_targets(section['database_url'])
+    url = args.url or 'http://127.0.0.1:%d' % section.getint('port')
+    await wait_until_up(url)
+    names = args.endpoints.split(',') if args.endpoints else list(ENDPOINTS)
+    results = {}
+    for name in names:
+        # each endpoint draws from its own seeded generator, so its requests
+        # do not depend on which other endpoints were run
+        rng = random.Random('%s:%d' % (name, args.seed))
+        if args.warm_up:
+            await drive(url, ENDPOINTS[name], args.warm_up, args.concurrency, rng, targets)
+        results[name] = await drive(
+            url, ENDPOINTS[name], args.requests, args.concurrency, rng, targets)
+        logger.info(
+            '%-22s %8.0f req/s  p50 %7.2fms  p95 %7.2fms  p99 %7.2fms  errors %d',
+            name, results[name]['throughput'], results[name]['p50_ms'],
+            results[name]['p95_ms'], results[name]['p99_ms'], results[name]['errors'])
+    return targets, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the endpoints')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--mode', default='BENCH', help='config.ini section to use')
+    parser.add_argument('--generate', action='store_true',
+                        help='recreate the database with a generated dataset first')
+    parser.add_argument('--seed', type=int, default=0)
+    for key, value in dataset.DEFAULT_SCALE.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=int, default=value)
+    parser.add_argument('--url', help='benchmark a running server instead of starting one')
+    parser.add_argument('--endpoints', help='comma separated, defaults to all of %s' % ', '.join(ENDPOINTS))
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=2000, help='per endpoint')
+    parser.add_argument('--warm-up', type=int, default=200, help='untimed requests per endpoint')
+    parser.add_argument('--output', default='bench.json')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    config['MODE']['mode'] = args.mode
+    section = config[args.mode]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    scale = {key: getattr(args, key) for key in dataset.DEFAULT_SCALE}
+    if args.generate:
+        start = time.perf_counter()
+        asyncio.run(dataset.generate(section['database_url'], args.seed, **scale))
+        logger.info('dataset generated in %.1fs', time.perf_counter() - start)
+
+    server = None
+    if not args.url:
+        server = multiprocessing.get_context('fork').Process(
+            target=serve_app, args=(config, section.getint('port')), daemon=True)
+        server.start()
+    try:
+        targets, results = asyncio.run(run(args, section))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    with open(args.output, 'w') as f:
+        json.dump(dict(
+            commit=git_commit(),
+            date=datetime.datetime.now().isoformat(),
+            seed=args.seed,
+            scale=scale if args.generate else None,
+            id_ranges={key: value for key, value in targets.items() if key != 'company_products'},
+            concurrency=args.concurrency,
+            endpoints=results
+        ), f, indent=2)
+    logger.info('results written to %s', args.output)
+
+
+if __name__ == '__main__':
+    main()
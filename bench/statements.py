@@ -0,0 +1,129 @@
+"""
+Micro-benchmark of the SQLAlchemy work a request does before its statement
+reaches the driver: building the statement and compiling it, or finding
+its compiled form in the compiled cache
+
+$ python -m bench.statements
+$ python -m bench.statements --iterations 20000 --output statements.json
+
+rebuilt builds the statement per request with its values inline, as the
+handlers used to, prebuilt executes the statement from db.stmts with bind
+parameters. Both go through the compiled cache, as Connection.execute does.
+uncached also compiles the rebuilt statement every time, which is what a
+request pays when its statement misses the cache. No database is needed.
+"""
+import argparse
+import datetime
+import json
+import time
+import sqlalchemy
+from sqlalchemy.dialects.postgresql import asyncpg
+import schema
+from handlers.statements import build_statements, select_purchases_with_items
+
+
+tables = schema.metadata.tables
+stmts = build_statements(schema.metadata)
+start_ts = datetime.datetime(2022, 1, 1)
+end_ts = datetime.datetime(2022, 2, 1)
+
+
+def rebuild_entity_get():
+    t_entity = tables['entity']
+    return sqlalchemy.select(t_entity).where(t_entity.c.id == 1)
+
+
+def rebuild_purchase_get():
+    t_purchase = tables['purchase']
+    return select_purchases_with_items(t_purchase, tables['products_purchased'])\
+        .where(t_purchase.c.id == 1)
+
+
+def rebuild_entity_purchases():
+    t_purchase = tables['purchase']
+    return sqlalchemy\
+        .select(t_purchase)\
+        .where(
+            t_purchase.c.buyr_id == 1,
+            t_purchase.c.ts > start_ts,
+            t_purchase.c.ts < end_ts
+        )\
+        .order_by(t_purchase.c.ts, t_purchase.c.id)\
+        .limit(101)
+
+
+def rebuild_product_update():
+    t_product = tables['product']
+    return sqlalchemy\
+        .update(t_product)\
+        .where(t_product.c.id == 1)\
+        .values(carbon_cost=1000)\
+        .returning(t_product.c.id)
+
+
+# handler: (rebuild the statement, prebuilt statement, its parameters)
+CASES = {
+    'EntityGetHandler': (rebuild_entity_get, stmts.entity_get, dict(id=1)),
+    'PurchaseGetHandler': (rebuild_purchase_get, stmts.purchase_get, dict(id=1)),
+    'EntityPurchasesGetHandler': (
+        rebuild_entity_purchases, stmts.entity_purchases[False, True],
+        dict(buyr_id=1, start_ts=start_ts, end_ts=end_ts, limit=101)),
+    'ProductUpdateHandler': (
+        rebuild_product_update, stmts.product_update,
+        dict(product_id=1, carbon_cost=1000)),
+}
+
+
+def time_per_call(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+
+def measure(rebuild, prebuilt, params, iterations):
+    """
+    Microseconds per request in each mode
+    """
+    dialect = asyncpg.dialect()
+    cache = {}
+    keys = sorted(params)
+
+    def uncached():
+        rebuild().compile(dialect=dialect)
+
+    def rebuilt():
+        rebuild()._compile_w_cache(dialect, compiled_cache=cache, column_keys=[])
+
+    def prebuilt_():
+        prebuilt._compile_w_cache(dialect, compiled_cache=cache, column_keys=keys)
+
+    return dict(
+        uncached_us=time_per_call(uncached, max(iterations // 10, 1)) * 1e6,
+        rebuilt_us=time_per_call(rebuilt, iterations) * 1e6,
+        prebuilt_us=time_per_call(prebuilt_, iterations) * 1e6
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='time building and compiling statements per request')
+    parser.add_argument('--iterations', type=int, default=10000)
+    parser.add_argument('--output', help='also write the results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    print('%-26s %12s %12s %12s %8s' % ('', 'uncached us', 'rebuilt us', 'prebuilt us', 'saved'))
+    for name, (rebuild, prebuilt, params) in CASES.items():
+        result = results[name] = measure(rebuild, prebuilt, params, args.iterations)
+        print('%-26s %12.1f %12.1f %12.1f %7.0f%%' % (
+            name, result['uncached_us'], result['rebuilt_us'], result['prebuilt_us'],
+            100 * (1 - result['prebuilt_us'] / result['rebuilt_us'])))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
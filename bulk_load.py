@@ -0,0 +1,169 @@
+"""
+Bulk load historical purchases into the database with COPY
+
+$ python bulk_load.py purchases.ndjson
+$ python bulk_load.py purchases.csv --chunk-size 50000
+
+Each NDJSON line takes the same fields as /purchase/add, plus an optional
+ts (unix timestamp). CSV files need a header with the columns buyr_id,
+selr_id, price, carbon_cost, ts and item_list, where item_list is a JSON
+list of {"prod_id": .., "comp_id": ..} objects. Empty cells are null.
+"""
+import argparse
+import asyncio
+import configparser
+import csv
+import datetime
+import itertools
+import json
+import logging
+import time
+import asyncpg
+import partitions
+
+
+logger = logging.getLogger('bulk_load')
+
+PURCHASE_COLUMNS = ['id', 'buyr_id', 'selr_id', 'price', 'carbon_cost', 'ts']
+PRODUCTS_PURCHASED_COLUMNS = ['prch_id', 'comp_id', 'prod_id', 'prch_ts']
+
+
+def read_ndjson(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(f):
+    def value(row, key, parse=int):
+        return parse(row[key]) if row.get(key) else None
+
+    for row in csv.DictReader(f):
+        yield dict(
+            buyr_id=value(row, 'buyr_id'),
+            selr_id=value(row, 'selr_id'),
+            price=value(row, 'price'),
+            carbon_cost=value(row, 'carbon_cost'),
+            ts=value(row, 'ts', float),
+            item_list=value(row, 'item_list', json.loads)
+        )
+
+
+async def reserve_ids(conn, table, n):
+    """
+    Take the next n ids from the serial sequence of table
+    """
+    rows = await conn.fetch(
+        "SELECT nextval(pg_get_serial_sequence($1, 'id')) AS id "
+        "FROM generate_series(1, $2)",
+        table, n
+    )
+    return [row['id'] for row in rows]
+
+
+async def load_chunk(conn, chunk):
+    """
+    Copy one chunk of purchases and their items in a single transaction
+    Purchase ids are reserved from the sequence up front, so items can
+    be linked to their purchase before either table is written, and
+    purchases are copied before items so the foreign keys hold
+    The buyers' daily rollups are updated in the same transaction
+    The monthly partitions the chunk falls in are created first, rather
+    than letting historical rows pile up in the default partitions
+    """
+    now = datetime.datetime.now()
+    async with conn.transaction():
+        prch_ids = await reserve_ids(conn, 'purchase', len(chunk))
+
+        purchases = []
+        items = []
+        for prch_id, purchase in zip(prch_ids, chunk):
+            ts = purchase.get('ts')
+            ts = now if ts is None else datetime.datetime.fromtimestamp(ts)
+            purchases.append((
+                prch_id,
+                purchase['buyr_id'],
+                purchase['selr_id'],
+                purchase['price'],
+                purchase.get('carbon_cost'),
+                ts
+            ))
+            for item in purchase.get('item_list') or []:
+                items.append((prch_id, item['comp_id'], item['prod_id'], ts))
+
+        existing = set(await partitions.month_partitions(conn))
+        for month in sorted(set(purchase[-1].date().replace(day=1) for purchase in purchases)):
+            if month not in existing:
+                await partitions.create_month(conn, month)
+        await conn.copy_records_to_table(
+            'purchase', records=purchases, columns=PURCHASE_COLUMNS)
+        if items:
+            await conn.copy_records_to_table(
+                'products_purchased', records=items,
+                columns=PRODUCTS_PURCHASED_COLUMNS)
+        await conn.execute(
+            'SELECT apply_purchase_rollups($1, $2, 1)',
+            prch_ids, [purchase[-1] for purchase in purchases])
+    return len(purchases), len(items)
+
+
+async def load(dsn, purchases, chunk_size=10000):
+    """
+    Load an iterable of purchases chunk by chunk, so at most chunk_size
+    purchases are held in memory at once
+    Returns the number of purchase and products_purchased rows written
+    """
+    conn = await asyncpg.connect(dsn)
+    total_purchases = total_items = 0
+    start = time.perf_counter()
+    try:
+        purchases = iter(purchases)
+        while True:
+            chunk = list(itertools.islice(purchases, chunk_size))
+            if not chunk:
+                break
+            n_purchases, n_items = await load_chunk(conn, chunk)
+            total_purchases += n_purchases
+            total_items += n_items
+            elapsed = time.perf_counter() - start
+            logger.info(
+                '%d purchases, %d items loaded (%.0f rows/s)',
+                total_purchases, total_items,
+                (total_purchases + total_items) / elapsed)
+    finally:
+        await conn.close()
+    return total_purchases, total_items
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='bulk load purchases from a CSV or NDJSON file')
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=['csv', 'ndjson'],
+                        help='defaults to the file extension')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--config', default='config.ini')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    mode = config['MODE']['mode']
+
+    file_format = args.format or (
+        'csv' if args.path.endswith('.csv') else 'ndjson')
+    reader = read_csv if file_format == 'csv' else read_ndjson
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    start = time.perf_counter()
+    with open(args.path, newline='') as f:
+        n_purchases, n_items = asyncio.run(load(
+            config[mode]['database_url'], reader(f), args.chunk_size))
+    elapsed = time.perf_counter() - start
+    logger.info(
+        'done: %d purchases, %d items in %.1fs (%.0f rows/s)',
+        n_purchases, n_items, elapsed, (n_purchases + n_items) / elapsed)
+
+
+if __name__ == '__main__':
+    main()
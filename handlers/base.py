@@ -0,0 +1,163 @@
+import datetime
+import decimal
+import json
+import time
+import tornado.web
+import profiling
+from sqlalchemy.engine import Row
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# the last result whose rows were encoded and their keys. The rows of a
+# result share its metadata, so a response's rows look their keys up once
+# rather than building each dict through Row._asdict and Row._mapping
+_row_keys = [None, ()]
+
+
+def row_to_dict(row):
+    parent = row._parent
+    if _row_keys[0] is not parent:
+        _row_keys[:] = parent, tuple(parent.keys)
+    return dict(zip(_row_keys[1], row))
+
+
+def to_json(obj):
+    """
+    Encode the types the handlers return that JSON has no type for:
+    timestamps as unix time, numerics as numbers and rows as objects
+    """
+    if isinstance(obj, Row):
+        return row_to_dict(obj)
+    if isinstance(obj, datetime.datetime):
+        return obj.timestamp()
+    if isinstance(obj, datetime.date):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    raise TypeError('%s is not JSON serializable' % type(obj).__name__)
+
+
+class JsonSerializer:
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=to_json).encode()
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonSerializer:
+    name = 'orjson'
+    # datetimes go through to_json, so timestamps stay unix time
+    OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+    def dumps(self, obj):
+        return orjson.dumps(obj, default=to_json, option=self.OPTIONS)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+def get_serializer(name):
+    """
+    Return the serializer called name, orjson falls back to the standard
+    library json module if it is not installed
+    """
+    if name == 'orjson' and orjson is not None:
+        return OrjsonSerializer()
+    return JsonSerializer()
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    """
+    Parses request bodies and writes responses with the serializer in the
+    application settings, and reports the time spent in the database, the
+    pool and serialization in a Server-Timing header
+    GET handlers read through read_engine, the replica if one is configured
+    """
+    # the version of the row the response holds, see not_modified
+    row_version = None
+
+    def initialize(self, db):
+        self.db = db
+
+    def prepare(self):
+        # statement text is only exposed in debug mode
+        self.profile = profiling.start(keep_statements=self.settings.get('debug', False))
+
+    def flush(self, include_footers=False):
+        # the header can only be added before the first flush, so streamed
+        # responses report the time up to their first chunk
+        profile = getattr(self, 'profile', None)
+        if profile is not None and not self._headers_written:
+            self.set_header('Server-Timing', profile.server_timing())
+        return super().flush(include_footers)
+
+    def compute_etag(self):
+        """
+        A strong ETag from the row version, so an unchanged row is
+        recognised without reading or serializing it. Responses without
+        one are hashed as usual
+        """
+        if self.row_version is not None:
+            return '"%s"' % self.row_version
+        return super().compute_etag()
+
+    def not_modified(self, row_version):
+        """
+        Set the ETag from row_version and return True, with a 304 status,
+        if it is in the request's If-None-Match, so the handler can return
+        without writing a body
+        """
+        self.row_version = row_version
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    @property
+    def read_primary(self):
+        """
+        Whether the client asked to read its own writes, with the
+        X-Read-Primary header or the primary argument set to true
+        """
+        value = self.request.headers.get('X-Read-Primary') \
+            or self.get_argument('primary', 'false')
+        return value.lower() in ('1', 'true')
+
+    @property
+    def read_engine(self):
+        """
+        The replica engine, or the primary if the request asks to read
+        from it, since the replica may not have caught up with its writes
+        """
+        return self.db.async_engine if self.read_primary else self.db.read_engine
+
+    @property
+    def serializer(self):
+        return self.settings['serializer']
+
+    def load_body(self):
+        try:
+            return self.serializer.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(
+                status_code=400, reason='request body is not valid JSON')
+
+    def dumps(self, obj):
+        start = time.perf_counter()
+        data = self.serializer.dumps(obj)
+        profile = getattr(self, 'profile', None)
+        if profile is not None:
+            profile.serialize_time += time.perf_counter() - start
+        return data
+
+    def write_json(self, obj):
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(self.dumps(obj))
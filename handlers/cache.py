@@ -0,0 +1,150 @@
+import asyncio
+import collections
+import logging
+import time
+import asyncpg
+from handlers.statements import PRODUCT_CACHE_CHANNEL
+
+
+logger = logging.getLogger('tornado.application')
+
+
+class LRUCache:
+    """
+    Bounded in-process cache with least-recently-used eviction
+    Entries older than ttl seconds are treated as missing, a ttl of 0
+    keeps entries until they are evicted or invalidated
+    A disabled cache misses on every get and ignores puts
+    generation changes with every invalidation, a put given the
+    generation read before its value was loaded is ignored if an
+    invalidation happened in between, as the value may predate it
+    """
+
+    def __init__(self, maxsize, ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.enabled = True
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self._data.get(key) if self.enabled else None
+        if entry is not None:
+            value, expires = entry
+            if not expires or expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value, generation=None):
+        if self.maxsize <= 0 or not self.enabled:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else 0
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self):
+        return dict(
+            size=len(self._data),
+            maxsize=self.maxsize,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            enabled=self.enabled
+        )
+
+
+def encode_key(key):
+    """
+    The NOTIFY payload of a product cache key, e.g. company_product:6:1
+    """
+    return ':'.join(map(str, key))
+
+
+def decode_key(payload):
+    table, *ids = payload.split(':')
+    return (table, *map(int, ids))
+
+
+class CacheInvalidator:
+    """
+    Keeps the product cache of every worker process consistent with the
+    writes of the others. A writer NOTIFYs PRODUCT_CACHE_CHANNEL of the
+    key it changed in its transaction, and each process LISTENs on its
+    own connection and invalidates the key when the transaction commits
+    Notifications sent while the connection is down are lost, so the
+    cache is disabled until it is listening, and cleared when it starts
+    """
+
+    def __init__(self, dsn, cache, reconnect_delay=1):
+        self.dsn = dsn
+        self.cache = cache
+        self.reconnect_delay = reconnect_delay
+        self.conn = None
+        self.closed = False
+        self.lock = asyncio.Lock()
+        cache.enabled = False
+
+    async def listen(self):
+        """
+        Connect and start listening, retrying until it succeeds
+        """
+        async with self.lock:
+            while self.conn is None and not self.closed:
+                conn = None
+                try:
+                    conn = await asyncpg.connect(self.dsn)
+                    await conn.add_listener(PRODUCT_CACHE_CHANNEL, self.on_notify)
+                # anything, e.g. a timeout, would otherwise end the task
+                # and leave the cache disabled for good
+                except Exception as e:
+                    logger.warning('product cache listener failed to connect: %r', e)
+                    if conn is not None:
+                        conn.terminate()
+                    self.cache.enabled = False
+                    self.cache.clear()
+                    await asyncio.sleep(self.reconnect_delay)
+                    continue
+                conn.add_termination_listener(self.on_terminated)
+                self.conn = conn
+                self.cache.clear()
+                self.cache.enabled = True
+
+    def on_notify(self, conn, pid, channel, payload):
+        self.cache.invalidate(decode_key(payload))
+
+    def on_terminated(self, conn):
+        if conn is not self.conn:
+            return
+        self.conn = None
+        self.cache.enabled = False
+        self.cache.clear()
+        if not self.closed:
+            logger.warning('product cache listener connection lost, reconnecting')
+            asyncio.ensure_future(self.listen())
+
+    async def close(self):
+        self.closed = True
+        self.cache.enabled = False
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            await conn.close()
@@ -0,0 +1,102 @@
+import asyncio
+import contextvars
+import functools
+import logging
+from handlers.purchase import insert_purchases
+
+
+logger = logging.getLogger('tornado.application')
+
+
+class PurchaseCoalescer:
+    """
+    Collects purchases added concurrently and writes them in one
+    transaction, so they share a single commit
+    A batch is written window_ms after its first purchase arrives, or as
+    soon as it holds max_batch purchases. If the batch fails, each of its
+    purchases is retried in a transaction of its own, one after another so
+    the retries hold a single pool connection, and only the callers whose
+    purchase is at fault see an error. With notify, the purchases are
+    published to the change feed.
+    """
+
+    def __init__(self, async_engine, stmts, window_ms=2, max_batch=100, notify=False):
+        self.async_engine = async_engine
+        self.stmts = stmts
+        self.notify = notify
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = []
+        self.timer = None
+        self.writes = set()
+        self.batches = 0
+        self.purchases = 0
+        self.retried_batches = 0
+
+    async def add(self, purchase):
+        """
+        Queue a purchase, in the form insert_purchases takes, and return
+        its prch_id once its batch has been committed
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((purchase, future))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            self.batches += 1
+            self.purchases += len(batch)
+            # written in an empty context, so the batch's queries are not
+            # charged to the profile of whichever request started it
+            task = contextvars.Context().run(asyncio.ensure_future, self.write(batch))
+            self.writes.add(task)
+            task.add_done_callback(functools.partial(self.written, batch))
+
+    def written(self, batch, task):
+        """
+        Fail every purchase of batch still unresolved once its write has
+        ended, e.g. cancelled at shutdown, even before it started, so no
+        caller waits forever
+        """
+        self.writes.discard(task)
+        for purchase, future in batch:
+            if not future.done():
+                future.set_exception(RuntimeError('coalesced purchase was not written'))
+
+    async def write(self, batch):
+        try:
+            async with self.async_engine.begin() as conn:
+                prch_ids = await insert_purchases(
+                    conn, self.stmts, [purchase for purchase, future in batch],
+                    notify=self.notify)
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            self.retried_batches += 1
+            logger.warning(
+                'coalesced batch of %d purchases failed, retrying one by one: %s',
+                len(batch), e)
+            for item in batch:
+                await self.write([item])
+            return
+        for (purchase, future), prch_id in zip(batch, prch_ids):
+            if not future.done():
+                future.set_result(prch_id)
+
+    def stats(self):
+        return dict(
+            batches=self.batches,
+            purchases=self.purchases,
+            retried_batches=self.retried_batches,
+            pending=len(self.pending)
+        )
@@ -1,38 +1,64 @@
+import base64
 import datetime
 import tornado.web
 import json
-import sqlalchemy
+from handlers.base import BaseHandler
+from handlers.statements import CARBON_BUCKETS
+from handlers.util import parse_ids, without_version
 
 
-class EntityGetHandler(tornado.web.RequestHandler):
-    def initialize(self, db):
-        self.db = db
-
+class EntityGetHandler(BaseHandler):
     async def get(self, user_id):
+        """
+        Return the entity, with its row version as the ETag
+        A request with If-None-Match only reads the version unless the
+        entity has changed
+        """
         user_id = int(user_id)
 
-        t_entity = self.db.metadata.tables['entity']
-        stmt = sqlalchemy\
-            .select(t_entity)\
-            .where(t_entity.c.id == user_id)
+        if 'If-None-Match' in self.request.headers:
+            async with self.read_engine.begin() as conn:
+                cursor = await conn.execute(self.db.stmts.entity_version, dict(id=user_id))
+                version = cursor.scalar()
+            if version is not None and self.not_modified(version):
+                return
 
         result = None
-        async with self.db.async_engine.begin() as conn:
-            cursor = await conn.execute(stmt)
+        async with self.read_engine.begin() as conn:
+            cursor = await conn.execute(self.db.stmts.entity_get, dict(id=user_id))
             for row in cursor:
-                result = row._asdict()
+                result = row
         if result is None:
             raise tornado.web.HTTPError(
                 status_code=400, reason='entity id not in database')
-        self.write(json.dumps(result))
+        if self.not_modified(result.version):
+            return
+        self.write_json(without_version(result))
+
+
+class EntityMultiGetHandler(BaseHandler):
+    async def get(self):
+        """
+        Return the entities in the ids argument, e.g. ?ids=1,2,3, keyed by id
+        Ids that are not in the database are listed under missing
+        """
+        ids = parse_ids(self.get_argument('ids'))
 
+        result = {
+            'data': {},
+            'missing': []
+        }
+        async with self.read_engine.begin() as conn:
+            cursor = await conn.execute(self.db.stmts.entity_get_multi, dict(ids=ids))
+            for row in cursor:
+                result['data'][row.id] = row
+        result['missing'] = [id for id in ids if id not in result['data']]
+        self.write_json(result)
 
-class EntityUpdateHandler(tornado.web.RequestHandler):
-    def initialize(self, db):
-        self.db = db
 
+class EntityUpdateHandler(BaseHandler):
     async def post(self):
-        data = json.loads(self.request.body)
+        data = self.load_body()
         id = data['id']
 
         result = {
@@ -40,61 +66,153 @@ class EntityUpdateHandler(tornado.web.RequestHandler):
             'data': None
         }
 
-        t_entity = self.db.metadata.tables['entity']
-
-        stmt_check = sqlalchemy\
-            .select(t_entity)\
-            .where(t_entity.c.id == id)
-
-        stmt_update = sqlalchemy\
-            .update(t_entity)\
-            .where(t_entity.c.id == id)\
-            .values(
+        async with self.db.async_engine.begin() as conn:
+            cursor = await conn.execute(self.db.stmts.entity_update, dict(
+                entity_id=id,
                 carbon_offset=data['carbon_offset'],
                 carbon_cost=data['carbon_cost']
-            )
-
-        async with self.db.async_engine.begin() as conn:
-            has_row = False
-            for _ in await conn.execute(stmt_check):
-                has_row = True
-            if not has_row:
+            ))
+            if cursor.first() is None:
                 raise tornado.web.HTTPError(
                     status_code=400, reason='entity id not in database')
-            await conn.execute(stmt_update)
 
         result['data'] = dict(id=id)
-        self.write(json.dumps(result))
+        self.write_json(result)
+
+
+def encode_cursor(ts, id):
+    """
+    Opaque page token pointing just past (ts, id)
+    """
+    token = json.dumps([ts.isoformat(), id])
+    return base64.urlsafe_b64encode(token.encode()).decode()
 
 
-class EntityPurchasesGetHandler(tornado.web.RequestHandler):
-    def initialize(self, db):
-        self.db = db
+def decode_cursor(cursor):
+    try:
+        ts, id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.datetime.fromisoformat(ts), int(id)
+    except (TypeError, ValueError):
+        raise tornado.web.HTTPError(
+            status_code=400, reason='invalid cursor')
+
+
+class EntityPurchasesGetHandler(BaseHandler):
+    # rows fetched from the server-side cursor per flush in streaming mode
+    STREAM_CHUNK_SIZE = 1000
 
     async def get(self, user_id):
+        """
+        Return the purchases of user_id between start_ts and end_ts,
+        ordered by (ts, id)
+        Optional arguments:
+        limit: page size, the response then includes a next_cursor,
+            which is null on the last page
+        cursor: next_cursor of the previous page
+        stream: if true, stream the result from a server-side cursor
+        """
         user_id = int(user_id)
         start_ts = datetime.datetime.fromtimestamp(
             float(self.get_argument('start_ts')))
         end_ts = datetime.datetime.fromtimestamp(
             float(self.get_argument('end_ts')))
+        limit = self.get_argument('limit', None)
+        page_cursor = self.get_argument('cursor', None)
+        stream = self.get_argument('stream', 'false').lower() in ('1', 'true')
+
+        params = dict(buyr_id=user_id, start_ts=start_ts, end_ts=end_ts)
+        if page_cursor is not None:
+            params['cursor_ts'], params['cursor_id'] = decode_cursor(page_cursor)
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = 0
+            # limit + 1 is bound as an INT
+            if not 0 < limit < 2 ** 31 - 1:
+                raise tornado.web.HTTPError(
+                    status_code=400, reason='limit must be a positive integer')
+            # one extra row tells us whether there is another page
+            params['limit'] = limit + 1
+        stmt = self.db.stmts.entity_purchases[page_cursor is not None, limit is not None]
+
+        if stream:
+            await self.stream_purchases(stmt, params, user_id, limit)
+            return
 
         result = {
             "user_id": user_id,
             "purchase_list": []
         }
+        last_ts = last_id = None
+        async with self.read_engine.begin() as conn:
+            cursor = await conn.execute(stmt, params)
+            for i, row in enumerate(cursor):
+                if i == limit:
+                    result['next_cursor'] = encode_cursor(last_ts, last_id)
+                    break
+                last_ts, last_id = row.ts, row.id
+                result['purchase_list'].append(row)
+            else:
+                if limit is not None:
+                    result['next_cursor'] = None
+        self.write_json(result)
+
+    async def stream_purchases(self, stmt, params, user_id, limit):
+        """
+        Write the same response as a normal request, one chunk of rows
+        at a time, so memory use does not grow with the number of rows
+        """
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write('{"user_id": %d, "purchase_list": [' % user_id)
+        next_cursor = last_ts = last_id = None
+        count = 0
+        async with self.read_engine.begin() as conn:
+            result = await conn.stream(stmt, params)
+            async for partition in result.partitions(self.STREAM_CHUNK_SIZE):
+                chunk = []
+                for row in partition:
+                    if count == limit:
+                        next_cursor = encode_cursor(last_ts, last_id)
+                        break
+                    last_ts, last_id = row.ts, row.id
+                    chunk.append(self.dumps(row))
+                    count += 1
+                if chunk:
+                    self.write((b', ' if count > len(chunk) else b'') + b', '.join(chunk))
+                    await self.flush()
+        self.write(']')
+        if limit is not None:
+            self.write(b', "next_cursor": ' + self.dumps(next_cursor))
+        self.write('}')
+
+
+class EntityCarbonGetHandler(BaseHandler):
+    async def get(self, user_id):
+        """
+        Return the purchase count, price and carbon cost totals of user_id
+        per day, week or month (the bucket argument, day by default)
+        between start_ts and end_ts, read from entity_daily_rollup
+        Each bucket is labelled with the timestamp of its first day
+        """
+        user_id = int(user_id)
+        start_day = datetime.datetime.fromtimestamp(
+            float(self.get_argument('start_ts'))).date()
+        end_day = datetime.datetime.fromtimestamp(
+            float(self.get_argument('end_ts'))).date()
+        bucket = self.get_argument('bucket', 'day')
+        if bucket not in CARBON_BUCKETS:
+            raise tornado.web.HTTPError(
+                status_code=400, reason='bucket must be day, week or month')
 
-        t_purchase = self.db.metadata.tables['purchase']
-        stmt = sqlalchemy\
-            .select(t_purchase)\
-            .where(
-                t_purchase.c.buyr_id == user_id,
-                t_purchase.c.ts > start_ts,
-                t_purchase.c.ts < end_ts
-            )
-        async with self.db.async_engine.begin() as conn:
-            cursor = await conn.execute(stmt)
+        result = {
+            "user_id": user_id,
+            "bucket": bucket,
+            "series": []
+        }
+        async with self.read_engine.begin() as conn:
+            cursor = await conn.execute(self.db.stmts.entity_carbon[bucket], dict(
+                entity_id=user_id, start_day=start_day, end_day=end_day))
             for row in cursor:
-                row = row._asdict()
-                row['ts'] = datetime.datetime.timestamp(row['ts'])
-                result['purchase_list'].append(row)
-        self.write(json.dumps(result))
+                result['series'].append(row)
+        self.write_json(result)
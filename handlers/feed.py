@@ -0,0 +1,150 @@
+import asyncio
+import datetime
+import json
+import logging
+import asyncpg
+from handlers.statements import PURCHASE_FEED_CHANNEL
+
+
+logger = logging.getLogger('tornado.application')
+
+
+class Subscription:
+    """
+    The purchase changes one subscriber has yet to receive, optionally
+    only those of buyr_id and selr_id
+    None is queued when the subscription ends, because the feed closed
+    or the subscriber fell more than queue_size changes behind
+    """
+
+    def __init__(self, buyr_id=None, selr_id=None, queue_size=1000):
+        self.buyr_id = buyr_id
+        self.selr_id = selr_id
+        self.queue = asyncio.Queue(maxsize=queue_size + 1)
+        self.closed = False
+
+    def matches(self, change):
+        return (self.buyr_id is None or change['buyr_id'] == self.buyr_id) \
+            and (self.selr_id is None or change['selr_id'] == self.selr_id)
+
+    def put(self, change, data):
+        if self.closed or not self.matches(change):
+            return
+        # the last slot is kept for the None that ends the subscription
+        if self.queue.qsize() >= self.queue.maxsize - 1:
+            self.close()
+            return
+        self.queue.put_nowait((change, data))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put_nowait(None)
+
+    async def get(self):
+        """
+        The next (change, serialized change), or None once the
+        subscription has ended
+        """
+        return await self.queue.get()
+
+
+class PurchaseFeed:
+    """
+    Fans the purchase changes published with NOTIFY out to the
+    subscribers in this process, from a single LISTEN connection
+    The connection is opened with the first subscriber and reopened if
+    it is lost, changes published while it is down are missed
+    """
+
+    def __init__(self, dsn, serializer, queue_size=1000, reconnect_delay=1):
+        self.dsn = dsn
+        self.serializer = serializer
+        self.queue_size = queue_size
+        self.reconnect_delay = reconnect_delay
+        self.subscribers = set()
+        self.conn = None
+        self.reconnecting = None
+        self.lock = asyncio.Lock()
+        self.notifications = 0
+        self.reconnects = 0
+
+    async def listen(self):
+        async with self.lock:
+            if self.conn is not None and not self.conn.is_closed():
+                return
+            conn = await asyncpg.connect(self.dsn)
+            try:
+                await conn.add_listener(PURCHASE_FEED_CHANNEL, self.on_notify)
+            except BaseException:
+                conn.terminate()
+                raise
+            conn.add_termination_listener(self.on_terminated)
+            self.conn = conn
+
+    def on_notify(self, conn, pid, channel, payload):
+        self.notifications += 1
+        change = json.loads(payload)
+        change['ts'] = datetime.datetime.fromisoformat(change['ts'])
+        # serialized once, however many subscribers receive it
+        data = self.serializer.dumps(change)
+        for subscription in list(self.subscribers):
+            subscription.put(change, data)
+
+    def on_terminated(self, conn):
+        if conn is not self.conn:
+            return
+        self.conn = None
+        if self.subscribers:
+            logger.warning('purchase feed connection lost, reconnecting')
+            self.reconnecting = asyncio.ensure_future(self.reconnect())
+
+    async def reconnect(self):
+        """
+        Listen again, retrying while there are subscribers. If it stops
+        without a connection, e.g. cancelled, every subscription is ended
+        rather than left waiting for changes that will never come
+        """
+        try:
+            while self.subscribers and self.conn is None:
+                self.reconnects += 1
+                try:
+                    await self.listen()
+                # anything, e.g. a timeout, would otherwise end the task
+                except Exception as e:
+                    logger.warning('purchase feed reconnect failed: %r', e)
+                    await asyncio.sleep(self.reconnect_delay)
+        finally:
+            if self.conn is None:
+                for subscription in list(self.subscribers):
+                    self.unsubscribe(subscription)
+
+    async def subscribe(self, buyr_id=None, selr_id=None):
+        subscription = Subscription(buyr_id, selr_id, self.queue_size)
+        await self.listen()
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        self.subscribers.discard(subscription)
+
+    async def close(self):
+        """
+        End every subscription and stop listening
+        """
+        for subscription in list(self.subscribers):
+            self.unsubscribe(subscription)
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            await conn.close()
+
+    def stats(self):
+        return dict(
+            subscribers=len(self.subscribers),
+            listening=self.conn is not None,
+            notifications=self.notifications,
+            reconnects=self.reconnects
+        )
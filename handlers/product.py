@@ -1,13 +1,11 @@
-from re import S
+import sqlalchemy.exc
 import tornado.web
-import json
-import sqlalchemy
+from handlers.base import BaseHandler
+from handlers.cache import encode_key
+from handlers.util import parse_ids, parse_pairs, without_version
 
 
-class ProductCompanyGetHandler(tornado.web.RequestHandler):
-    def initialize(self, db):
-        self.db = db
-
+class ProductCompanyGetHandler(BaseHandler):
     async def get(self, comp_id, prod_id):
         comp_id, prod_id = map(int, (comp_id, prod_id))
         """
@@ -18,111 +16,201 @@ class ProductCompanyGetHandler(tornado.web.RequestHandler):
             carbon_cost: 3
         }
         """
-        t_product = self.db.metadata.tables['product']
-        t_company_product = self.db.metadata.tables['company_product']
-        stmt = sqlalchemy\
-            .select(t_company_product)\
-            .where(
-                t_company_product.c.comp_id == comp_id,
-                t_company_product.c.prod_id == prod_id
-            )
-
-        result = None
-        async with self.db.async_engine.begin() as conn:
-            cursor = await conn.execute(stmt)
-            for row in cursor:
-                result = row._asdict()
+        cache_key = ('company_product', comp_id, prod_id)
+        generation = self.db.product_cache.generation
+        # reading from the primary skips the cache as well, which may hold
+        # a row read from the replica before it caught up
+        result = None if self.read_primary else self.db.product_cache.get(cache_key)
+        if result is None and 'If-None-Match' in self.request.headers:
+            async with self.read_engine.begin() as conn:
+                cursor = await conn.execute(
+                    self.db.stmts.company_product_version,
+                    dict(comp_id=comp_id, prod_id=prod_id))
+                version = cursor.scalar()
+            if version is not None and self.not_modified(version):
+                return
         if result is None:
-            raise tornado.web.HTTPError(
-                status_code=400, reason='comp_id, prod_id not in database')
-        self.write(json.dumps(result))
-
-
-class ProductGetHandler(tornado.web.RequestHandler):
-    def initialize(self, db):
-        self.db = db
-
+            async with self.read_engine.begin() as conn:
+                cursor = await conn.execute(
+                    self.db.stmts.company_product_get,
+                    dict(comp_id=comp_id, prod_id=prod_id))
+                for row in cursor:
+                    result = row
+            if result is None:
+                raise tornado.web.HTTPError(
+                    status_code=400, reason='comp_id, prod_id not in database')
+            self.db.product_cache.put(cache_key, result, generation)
+        if self.not_modified(result.version):
+            return
+        self.write_json(without_version(result))
+
+
+class ProductGetHandler(BaseHandler):
     async def get(self, prod_id):
+        """
+        Return the product, with its row version as the ETag
+        A request with If-None-Match is answered from the cached version,
+        or by reading only the version if the product is not cached
+        """
         prod_id = int(prod_id)
-        t_product = self.db.metadata.tables['product']
-        stmt = sqlalchemy\
-            .select(t_product)\
-            .where(t_product.c.id == prod_id)
-        result = None
-        async with self.db.async_engine.begin() as conn:
-            for row in await conn.execute(stmt):
-                result = row._asdict()
+        cache_key = ('product', prod_id)
+        generation = self.db.product_cache.generation
+        result = None if self.read_primary else self.db.product_cache.get(cache_key)
+        if result is None and 'If-None-Match' in self.request.headers:
+            async with self.read_engine.begin() as conn:
+                cursor = await conn.execute(self.db.stmts.product_version, dict(id=prod_id))
+                version = cursor.scalar()
+            if version is not None and self.not_modified(version):
+                return
         if result is None:
-            raise tornado.web.HTTPError(
-                status_code=400, reason='product id not in database')
-        self.write(json.dumps(result))
+            async with self.read_engine.begin() as conn:
+                for row in await conn.execute(self.db.stmts.product_get, dict(id=prod_id)):
+                    result = row
+            if result is None:
+                raise tornado.web.HTTPError(
+                    status_code=400, reason='product id not in database')
+            self.db.product_cache.put(cache_key, result, generation)
+        if self.not_modified(result.version):
+            return
+        self.write_json(without_version(result))
+
+
+class ProductCompanyMultiGetHandler(BaseHandler):
+    async def get(self):
+        """
+        Return the company products in the pairs argument,
+        e.g. ?pairs=6:1,12:6, keyed by "comp_id:prod_id"
+        Pairs that are not in the database are listed under missing
+        """
+        pairs = parse_pairs(self.get_argument('pairs'))
+        generation = self.db.product_cache.generation
+        rows = {}
+        for comp_id, prod_id in [] if self.read_primary else pairs:
+            row = self.db.product_cache.get(('company_product', comp_id, prod_id))
+            if row is not None:
+                rows[comp_id, prod_id] = row
+
+        uncached = [pair for pair in pairs if pair not in rows]
+        if uncached:
+            comp_ids, prod_ids = zip(*uncached)
+            async with self.read_engine.begin() as conn:
+                cursor = await conn.execute(
+                    self.db.stmts.company_product_get_multi,
+                    dict(comp_ids=list(comp_ids), prod_ids=list(prod_ids)))
+                for row in cursor:
+                    rows[row.comp_id, row.prod_id] = row
+                    self.db.product_cache.put(
+                        ('company_product', row.comp_id, row.prod_id), row, generation)
 
+        result = {
+            'data': {
+                '%d:%d' % pair: without_version(rows[pair]) for pair in pairs if pair in rows
+            },
+            'missing': ['%d:%d' % pair for pair in pairs if pair not in rows]
+        }
+        self.write_json(result)
 
-class ProductAddHandler(tornado.web.RequestHandler):
-    def initialize(self, db):
-        self.db = db
 
+class ProductMultiGetHandler(BaseHandler):
+    async def get(self):
+        """
+        Return the products in the ids argument, e.g. ?ids=1,2,3, keyed by id
+        Ids that are not in the database are listed under missing
+        """
+        ids = parse_ids(self.get_argument('ids'))
+        generation = self.db.product_cache.generation
+        rows = {}
+        for prod_id in [] if self.read_primary else ids:
+            row = self.db.product_cache.get(('product', prod_id))
+            if row is not None:
+                rows[prod_id] = row
+
+        uncached = [prod_id for prod_id in ids if prod_id not in rows]
+        if uncached:
+            async with self.read_engine.begin() as conn:
+                cursor = await conn.execute(
+                    self.db.stmts.product_get_multi, dict(ids=uncached))
+                for row in cursor:
+                    rows[row.id] = row
+                    self.db.product_cache.put(('product', row.id), row, generation)
+
+        result = {
+            'data': {
+                prod_id: without_version(rows[prod_id]) for prod_id in ids if prod_id in rows
+            },
+            'missing': [prod_id for prod_id in ids if prod_id not in rows]
+        }
+        self.write_json(result)
+
+
+class ProductAddHandler(BaseHandler):
     async def post(self):
         """
         Add to company_product table
         """
-        data = json.loads(self.request.body)
+        data = self.load_body()
         result = {
             'status': 'success',
         }
-        t_company_product = self.db.metadata.tables['company_product']
-
-        stmt = sqlalchemy\
-            .insert(t_company_product)\
-            .values(
-                comp_id=data['comp_id'],
-                prod_id=data['prod_id'],
-                carbon_cost=data['carbon_cost']
-            )
+        cache_key = ('company_product', data['comp_id'], data['prod_id'])
         async with self.db.async_engine.begin() as conn:
-            await conn.execute(stmt)
-
-        self.write(json.dumps(result))
-
-
-class ProductUpdateHandler(tornado.web.RequestHandler):
-    def initialize(self, db):
-        self.db = db
-
+            try:
+                await conn.execute(self.db.stmts.company_product_add, dict(
+                    comp_id=data['comp_id'],
+                    prod_id=data['prod_id'],
+                    carbon_cost=data['carbon_cost']
+                ))
+            # (comp_id, prod_id) is the primary key, and both are foreign keys
+            except sqlalchemy.exc.IntegrityError:
+                raise tornado.web.HTTPError(
+                    status_code=400,
+                    reason='company product already in database, or ids not in database')
+            # the other workers invalidate their caches on commit
+            await conn.execute(
+                self.db.stmts.product_cache_notify, dict(key=encode_key(cache_key)))
+        self.db.product_cache.invalidate(cache_key)
+
+        self.write_json(result)
+
+
+class ProductUpdateHandler(BaseHandler):
     async def post(self):
         """
         If prod_id is None, update entity table
         Else if comp_id is None, update product table
         Else, update company_product table
         """
-        data = json.loads(self.request.body)
+        data = self.load_body()
         result = {
             'status': 'success',
         }
-        t_product = self.db.metadata.tables['product']
-        t_entity = self.db.metadata.tables['entity']
-        t_company_product = self.db.metadata.tables['company_product']
-
+        cache_key = None
+        params = dict(carbon_cost=data['carbon_cost'])
         if data['prod_id'] is None:
-            stmt = sqlalchemy\
-                .update(t_entity)\
-                .where(t_entity.c.id == data['comp_id'])\
-                .values(carbon_cost=data['carbon_cost'])
+            reason = 'entity id not in database'
+            stmt = self.db.stmts.entity_update_carbon_cost
+            params.update(entity_id=data['comp_id'])
         elif data['comp_id'] is None:
-            stmt = sqlalchemy\
-                .update(t_product)\
-                .where(t_product.c.id == data['prod_id'])\
-                .values(carbon_cost=data['carbon_cost'])
+            cache_key = ('product', data['prod_id'])
+            reason = 'product id not in database'
+            stmt = self.db.stmts.product_update
+            params.update(product_id=data['prod_id'])
         else:
-            stmt = sqlalchemy\
-                .update(t_company_product)\
-                .where(
-                    t_company_product.c.comp_id == data['comp_id'],
-                    t_company_product.c.prod_id == data['prod_id']
-                )\
-                .values(carbon_cost=data['carbon_cost'])
+            cache_key = ('company_product', data['comp_id'], data['prod_id'])
+            reason = 'comp_id, prod_id not in database'
+            stmt = self.db.stmts.company_product_update
+            params.update(company_id=data['comp_id'], product_id=data['prod_id'])
 
         async with self.db.async_engine.begin() as conn:
-            await conn.execute(stmt)
-
-        self.write(json.dumps(result))
+            cursor = await conn.execute(stmt, params)
+            if cursor.first() is None:
+                raise tornado.web.HTTPError(status_code=400, reason=reason)
+            if cache_key is not None:
+                # the other workers invalidate their caches on commit
+                await conn.execute(
+                    self.db.stmts.product_cache_notify, dict(key=encode_key(cache_key)))
+        # this one now, so its next read sees the write
+        if cache_key is not None:
+            self.db.product_cache.invalidate(cache_key)
+
+        self.write_json(result)
@@ -1,151 +1,394 @@
+import asyncio
 import datetime
-from re import S
+import tornado.iostream
 import tornado.web
-import json
-import sqlalchemy
+from handlers.base import BaseHandler
+from handlers.statements import EXPORT_TS_FORMATS, PURCHASE_COLUMNS
+from handlers.util import parse_ids
 
 
-class PurchaseGetHandler(tornado.web.RequestHandler):
-    def initialize(self, db):
-        self.db = db
+async def update_rollups(conn, stmts, prch_ids, prch_tss, sign):
+    """
+    Add (sign=1) or remove (sign=-1) purchases from entity_daily_rollup
+    prch_tss are the purchases' ts, so only their partitions are read
+    Call with -1 before changing a purchase and 1 afterwards, within the
+    transaction that changes it
+    """
+    if prch_ids:
+        await conn.execute(stmts.apply_rollups, dict(
+            prch_ids=prch_ids, prch_tss=prch_tss, sign=sign))
 
+
+async def notify_purchases(conn, stmts, prch_ids, prch_tss, op):
+    """
+    Publish the purchases to the change feed, op is add or update
+    Call within the transaction that changes them, after the change
+    """
+    if prch_ids:
+        await conn.execute(stmts.purchase_notify, dict(
+            prch_ids=prch_ids, prch_tss=prch_tss, op=op))
+
+
+async def lookup_ts(conn, stmts, prch_ids):
+    """
+    The ts of each purchase in prch_ids, keyed by id, the only lookup by
+    id alone, which reads every partition. Missing ids are left out
+    """
+    cursor = await conn.execute(stmts.purchase_ts, dict(prch_ids=prch_ids))
+    return {row.id: row.ts for row in cursor}
+
+
+async def insert_purchases(conn, stmts, purchase_list, notify=False):
+    """
+    Insert every purchase in purchase_list, and all of their items, with
+    one statement per table. Returns the new prch_ids in input order.
+    With notify, the purchases are also published to the change feed.
+    """
+    if not purchase_list:
+        return []
+    cursor = await conn.execute(stmts.purchase_add_many, {
+        column: [purchase[column] for purchase in purchase_list]
+        for column in PURCHASE_COLUMNS
+    })
+    # in input order, see insert_purchases_in_order
+    rows = cursor.all()
+    prch_ids = [row.id for row in rows]
+    prch_tss = [row.ts for row in rows]
+
+    items = [
+        (row.id, item['comp_id'], item['prod_id'], row.ts)
+        for row, purchase in zip(rows, purchase_list)
+        for item in purchase['item_list'] or []
+    ]
+    if items:
+        prch_col, comp_col, prod_col, ts_col = zip(*items)
+        await conn.execute(stmts.products_purchased_add_many, dict(
+            prch_ids=list(prch_col), comp_ids=list(comp_col), prod_ids=list(prod_col),
+            prch_tss=list(ts_col)))
+    await update_rollups(conn, stmts, prch_ids, prch_tss, 1)
+    if notify:
+        await notify_purchases(conn, stmts, prch_ids, prch_tss, 'add')
+    return prch_ids
+
+
+class PurchaseGetHandler(BaseHandler):
     async def get(self, prch_id):
         """
         Return all details of purchase
         """
         prch_id = int(prch_id)
-        t_purchase = self.db.metadata.tables['purchase']
-        t_products_purchased = self.db.metadata.tables['products_purchased']
-        stmt_purchase = sqlalchemy\
-            .select(t_purchase)\
-            .where(t_purchase.c.id == prch_id)
-        stmt_products_purchased = sqlalchemy\
-            .select(t_products_purchased)\
-            .where(t_products_purchased.c.prch_id == prch_id)
         result = None
-        async with self.db.async_engine.begin() as conn:
-            cursor = await conn.execute(stmt_purchase)
+        async with self.read_engine.begin() as conn:
+            cursor = await conn.execute(self.db.stmts.purchase_get, dict(id=prch_id))
             for row in cursor:
-                result = row._asdict()
+                result = row
+
+        if result is None:
+            raise tornado.web.HTTPError(
+                status_code=400, reason='purchase id not in database')
+        self.write_json(result)
 
-            if result is None:
-                raise tornado.web.HTTPError(
-                    status_code=400, reason='purchase id not in database')
 
-            cursor2 = await conn.execute(stmt_products_purchased)
-            result['item_list'] = []
-            for row in cursor2:
-                result['item_list'].append(row._asdict())
-        result['ts'] = datetime.datetime.timestamp(result['ts'])
-        self.write(json.dumps(result))
+class PurchaseMultiGetHandler(BaseHandler):
+    async def get(self):
+        """
+        Return the purchases in the ids argument, e.g. ?ids=1,2,3,
+        keyed by id, in the same form as /purchase/get/<prch_id>
+        Ids that are not in the database are listed under missing
+        """
+        ids = parse_ids(self.get_argument('ids'))
 
+        result = {
+            'data': {},
+            'missing': []
+        }
+        async with self.read_engine.begin() as conn:
+            cursor = await conn.execute(self.db.stmts.purchase_get_multi, dict(ids=ids))
+            for row in cursor:
+                result['data'][row.id] = row
+        result['missing'] = [id for id in ids if id not in result['data']]
+        self.write_json(result)
 
-class PurchaseAddHandler(tornado.web.RequestHandler):
-    def initialize(self, db):
-        self.db = db
 
+class PurchaseAddHandler(BaseHandler):
     async def post(self):
         """
         If item_list is not provided, just update purchase table
         Otherwise, update products_purchased table as well
+        With coalescing enabled, the purchase is written in one transaction
+        with the others added at about the same time
         """
-        data = json.loads(self.request.body)
+        data = self.load_body()
         result = {
             'status': 'success',
             'data': None
         }
-        t_purchase = self.db.metadata.tables['purchase']
-        t_products_purchased = self.db.metadata.tables['products_purchased']
-
-        stmt_purchase = sqlalchemy\
-            .insert(t_purchase)\
-            .values(
-                buyr_id=data['buyr_id'],
-                selr_id=data['selr_id'],
-                price=data['price'],
-                carbon_cost=data['carbon_cost']
-            )
+        stmts = self.db.stmts
+
+        if self.db.purchase_coalescer is not None:
+            purchase = {column: data[column] for column in PURCHASE_COLUMNS}
+            purchase['item_list'] = data['item_list']
+            prch_id = await self.db.purchase_coalescer.add(purchase)
+            result['data'] = dict(prch_id=prch_id)
+            self.write_json(result)
+            return
 
         async with self.db.async_engine.begin() as conn:
-            cursor = await conn.execute(stmt_purchase)
-            prch_id = cursor.inserted_primary_key[0]
+            cursor = await conn.execute(stmts.purchase_add, {
+                column: data[column] for column in PURCHASE_COLUMNS})
+            prch_id, prch_ts = cursor.one()
 
             # if product info is provided, add them
             if data['item_list']:
                 item_list = list(map(
                     lambda x: dict(
-                        prod_id=x['prod_id'], comp_id=x['comp_id'], prch_id=prch_id),
+                        prod_id=x['prod_id'], comp_id=x['comp_id'],
+                        prch_id=prch_id, prch_ts=prch_ts),
                     data['item_list']
                 ))
-                await conn.execute(
-                    sqlalchemy.insert(t_products_purchased),
-                    item_list
-                )
+                await conn.execute(stmts.products_purchased_add, item_list)
+            await update_rollups(conn, stmts, [prch_id], [prch_ts], 1)
+            if self.db.purchase_feed is not None:
+                await notify_purchases(conn, stmts, [prch_id], [prch_ts], 'add')
 
             result['data'] = dict(prch_id=prch_id)
-            self.write(json.dumps(result))
+            self.write_json(result)
+
+
+class PurchaseBatchAddHandler(BaseHandler):
+    async def post(self):
+        """
+        Add every purchase in purchase_list in a single transaction
+        Each purchase takes the same fields as /purchase/add
+        """
+        data = self.load_body()
+        result = {
+            'status': 'success',
+            'data': None
+        }
+        async with self.db.async_engine.begin() as conn:
+            prch_ids = await insert_purchases(
+                conn, self.db.stmts, data['purchase_list'],
+                notify=self.db.purchase_feed is not None)
 
+        result['data'] = dict(prch_ids=prch_ids)
+        self.write_json(result)
 
-class PurchaseUpdateHandler(tornado.web.RequestHandler):
-    def initialize(self, db):
-        self.db = db
 
+class PurchaseUpdateHandler(BaseHandler):
     async def post(self):
         """
         if item_list is empty, delete everything in products purchased
         otherwise just add to the tables
         """
-        data = json.loads(self.request.body)
+        data = self.load_body()
         prch_id = data['prch_id']
         result = {
             'status': 'success',
             'data': None
         }
-        table_purchase = self.db.metadata.tables['purchase']
-        table_products_purchased = self.db.metadata.tables['products_purchased']
-
-        # check prch_id in purchase table
-        stmt_check = sqlalchemy\
-            .select(table_purchase)\
-            .where(table_purchase.c.id == prch_id)
-
-        # updates purchase table
-        stmt_purchase = sqlalchemy\
-            .update(table_purchase)\
-            .where(table_purchase.c.id == prch_id)\
-            .values(
-                buyr_id=data['buyr_id'],
-                selr_id=data['selr_id'],
-                price=data['price'],
-                carbon_cost=data['carbon_cost']
-            )
-
-        # remove all old records from products_purchased table
-        stmt_products_purchased_1 = sqlalchemy\
-            .delete(table_products_purchased)\
-            .where(table_products_purchased.c.prch_id == prch_id)
+        stmts = self.db.stmts
 
         async with self.db.async_engine.begin() as conn:
-            has_row = False
-            for _ in await conn.execute(stmt_check):
-                has_row = True
-            if not has_row:
+            prch_ts = (await lookup_ts(conn, stmts, [prch_id])).get(prch_id)
+            if prch_ts is None:
+                raise tornado.web.HTTPError(
+                    status_code=400, reason='purchase id not in database')
+            await update_rollups(conn, stmts, [prch_id], [prch_ts], -1)
+            # updates purchase table, no row is returned if prch_id was
+            # deleted since its ts was looked up
+            cursor = await conn.execute(stmts.purchase_update, dict(
+                purchase_id=prch_id, purchase_ts=prch_ts,
+                **{column: data[column] for column in PURCHASE_COLUMNS}))
+            row = cursor.first()
+            if row is None:
                 raise tornado.web.HTTPError(
                     status_code=400, reason='purchase id not in database')
-            await conn.execute(stmt_purchase)
-            await conn.execute(stmt_products_purchased_1)
+            # remove all old records from products_purchased table
+            await conn.execute(stmts.products_purchased_delete, dict(
+                prch_id=prch_id, prch_ts=row.ts))
 
             # if product info is provided, add them
             if data['item_list']:
                 item_list = list(map(
                     lambda x: dict(
-                        prod_id=x['prod_id'], comp_id=x['comp_id'], prch_id=prch_id),
+                        prod_id=x['prod_id'], comp_id=x['comp_id'],
+                        prch_id=prch_id, prch_ts=row.ts),
                     data['item_list']
                 ))
-                await conn.execute(
-                    sqlalchemy.insert(table_products_purchased),
-                    item_list
-                )
+                await conn.execute(stmts.products_purchased_add, item_list)
+            await update_rollups(conn, stmts, [prch_id], [row.ts], 1)
+            if self.db.purchase_feed is not None:
+                await notify_purchases(conn, stmts, [prch_id], [row.ts], 'update')
 
             result['data'] = dict(prch_id=prch_id)
-            self.write(json.dumps(result))
+            self.write_json(result)
+
+
+class PurchaseRecomputeHandler(BaseHandler):
+    async def post(self):
+        """
+        Recompute and store the carbon cost of every purchase in prch_ids
+        with a single UPDATE, returns the new carbon costs keyed by prch_id
+        Ids that are not in the database are listed under missing
+        """
+        data = self.load_body()
+        prch_ids = list(dict.fromkeys(data['prch_ids']))
+        result = {
+            'status': 'success',
+            'data': None
+        }
+        stmts = self.db.stmts
+
+        carbon_costs = {}
+        async with self.db.async_engine.begin() as conn:
+            prch_tss = await lookup_ts(conn, stmts, prch_ids)
+            found = dict(prch_ids=list(prch_tss), prch_tss=list(prch_tss.values()))
+            await update_rollups(conn, stmts, **found, sign=-1)
+            cursor = await conn.execute(stmts.purchase_recompute, found)
+            for row in cursor:
+                carbon_costs[row.id] = row.carbon_cost
+            await update_rollups(conn, stmts, **found, sign=1)
+            if self.db.purchase_feed is not None:
+                await notify_purchases(conn, stmts, **found, op='update')
+
+        result['data'] = dict(
+            carbon_cost=carbon_costs,
+            missing=[id for id in prch_ids if id not in carbon_costs]
+        )
+        self.write_json(result)
+
+
+class PurchaseFeedHandler(BaseHandler):
+    # seconds between comments that keep idle connections open
+    KEEP_ALIVE = 15
+
+    async def get(self):
+        """
+        Stream purchases as they are added or updated, as server-sent
+        events named add or update, whose data is the purchase without
+        its items. Optional arguments buyr_id and selr_id only send the
+        purchases of that buyer or seller
+        """
+        feed = self.db.purchase_feed
+        if feed is None:
+            raise tornado.web.HTTPError(
+                status_code=404, reason='purchase feed is disabled')
+        filters = {}
+        for name in ('buyr_id', 'selr_id'):
+            value = self.get_argument(name, None)
+            if value is not None:
+                try:
+                    filters[name] = int(value)
+                except ValueError:
+                    raise tornado.web.HTTPError(
+                        status_code=400, reason='%s must be an integer' % name)
+
+        self.subscription = await feed.subscribe(**filters)
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        try:
+            self.write(': subscribed\n\n')
+            await self.flush()
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        self.subscription.get(), self.KEEP_ALIVE)
+                except asyncio.TimeoutError:
+                    self.write(': keep-alive\n\n')
+                    await self.flush()
+                    continue
+                if event is None:
+                    break
+                change, data = event
+                self.write(b'event: %s\ndata: %s\n\n' % (change['op'].encode(), data))
+                await self.flush()
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            feed.unsubscribe(self.subscription)
+
+    def on_connection_close(self):
+        subscription = getattr(self, 'subscription', None)
+        if subscription is not None:
+            subscription.close()
+
+
+class PurchaseExportHandler(BaseHandler):
+    CONTENT_TYPES = {
+        'csv': 'text/csv; charset=UTF-8',
+        'ndjson': 'application/x-ndjson; charset=UTF-8'
+    }
+
+    def export_query(self, export_format):
+        """
+        The query COPY runs for the request's arguments, and its arguments
+        """
+        try:
+            start_ts = datetime.datetime.fromtimestamp(
+                float(self.get_argument('start_ts')))
+            end_ts = datetime.datetime.fromtimestamp(
+                float(self.get_argument('end_ts')))
+        except (ValueError, OverflowError, OSError):
+            raise tornado.web.HTTPError(
+                status_code=400, reason='start_ts and end_ts must be unix times')
+        ts_format = self.get_argument('ts_format', 'iso')
+        if ts_format not in EXPORT_TS_FORMATS:
+            raise tornado.web.HTTPError(
+                status_code=400, reason='ts_format must be iso or unix')
+        items = self.get_argument('items', 'false').lower() in ('1', 'true')
+        buyr_id = self.get_argument('buyr_id', None)
+        args = [start_ts, end_ts]
+        if buyr_id is not None:
+            try:
+                args.append(int(buyr_id))
+            except ValueError:
+                raise tornado.web.HTTPError(
+                    status_code=400, reason='buyr_id must be an integer')
+        query = self.db.stmts.purchase_export[
+            export_format, items, buyr_id is not None, ts_format]
+        return query, args
+
+    async def get(self):
+        """
+        Export the purchases between start_ts and end_ts, ordered by
+        (ts, id), streamed from COPY as the database produces them, so
+        memory use does not grow with the size of the export
+        Optional arguments:
+        format: csv (with a header, the default) or ndjson
+        items: if true, include items, csv then has a row per item with
+            its comp_id and prod_id, ndjson an item_list per purchase
+        buyr_id: only export the purchases of this buyer
+        ts_format: iso (the default) writes ts as stored, unix as seconds
+            since the epoch, like start_ts and end_ts
+        """
+        export_format = self.get_argument('format', 'csv')
+        if export_format not in self.CONTENT_TYPES:
+            raise tornado.web.HTTPError(
+                status_code=400, reason='format must be csv or ndjson')
+        query, args = self.export_query(export_format)
+        copy_options = dict(format='csv', header=True) if export_format == 'csv' \
+            else dict(format='text')
+
+        self.set_header('Content-Type', self.CONTENT_TYPES[export_format])
+        self.set_header(
+            'Content-Disposition', 'attachment; filename="purchases.%s"' % export_format)
+
+        async def write_chunk(chunk):
+            # asyncpg passes a bytearray, which write does not accept
+            # waiting for the flush keeps COPY from outrunning the client
+            self.write(bytes(chunk))
+            await self.flush()
+
+        async with self.read_engine.connect() as conn:
+            raw = await conn.get_raw_connection()
+            try:
+                await raw.driver_connection.copy_from_query(
+                    query, *args, output=write_chunk, **copy_options)
+            except tornado.iostream.StreamClosedError:
+                # the client left mid COPY, the connection cannot be reused
+                await conn.invalidate()
+            except BaseException:
+                # nor returned to the pool in the middle of a COPY
+                await conn.invalidate()
+                raise
@@ -0,0 +1,430 @@
+"""
+The statements the handlers execute, built once when the app starts and
+attached to the db namespace as db.stmts
+Every value a request supplies is a named bind parameter, passed when the
+statement is executed, e.g.
+    await conn.execute(self.db.stmts.entity_get, dict(id=user_id))
+so a request neither builds a statement nor generates new SQL text, and the
+compiled form and the server-side prepared statement are reused
+"""
+import itertools
+from types import SimpleNamespace
+import sqlalchemy
+from sqlalchemy import bindparam
+from sqlalchemy.dialects import postgresql
+from handlers.util import int_array, unnest
+
+
+PURCHASE_COLUMNS = ['buyr_id', 'selr_id', 'price', 'carbon_cost']
+# the products_purchased columns in a purchase's item_list, prch_ts is
+# only there to partition the table and always equals the purchase's ts
+ITEM_COLUMNS = ['prch_id', 'comp_id', 'prod_id']
+CARBON_BUCKETS = ('day', 'week', 'month')
+# NOTIFY channel of purchase_notify, see handlers/feed.py
+PURCHASE_FEED_CHANNEL = 'purchase_change'
+# NOTIFY channel of product_cache_notify, see handlers/cache.py
+PRODUCT_CACHE_CHANNEL = 'product_cache_invalidate'
+# how /purchase/export writes ts: iso as stored, unix as seconds since the
+# epoch, reading the stored ts in the database's time zone
+EXPORT_TS_FORMATS = {
+    'iso': 'p.ts',
+    'unix': 'extract(epoch FROM p.ts::timestamptz)'
+}
+
+
+def row_version(table):
+    """
+    The xmin of table's rows as text, which changes whenever a row is
+    written, labelled version. Handlers use it as the row's ETag
+    """
+    return sqlalchemy.cast(
+        sqlalchemy.literal_column('%s.xmin' % table.name), sqlalchemy.Text
+    ).label('version')
+
+
+def select_purchases_with_items(t_purchase, t_products_purchased):
+    """
+    Select purchases with an item_list column that aggregates their
+    products_purchased rows, so a purchase and its items take one query
+    """
+    # keys are rendered inline, json_build_object cannot infer the type
+    # of a bound parameter
+    item = sqlalchemy.func.json_build_object(*[
+        arg
+        for name in ITEM_COLUMNS
+        for arg in (sqlalchemy.literal_column("'%s'" % name), t_products_purchased.c[name])
+    ])
+    item_list = sqlalchemy.func.coalesce(
+        sqlalchemy.func.json_agg(item)
+        .filter(t_products_purchased.c.prch_id.isnot(None)),
+        sqlalchemy.literal_column("'[]'::json"),
+        type_=postgresql.JSON
+    )
+    return sqlalchemy\
+        .select(t_purchase, item_list.label('item_list'))\
+        .select_from(t_purchase.outerjoin(
+            t_products_purchased, sqlalchemy.and_(
+                t_purchase.c.id == t_products_purchased.c.prch_id,
+                # lets the planner skip item partitions of other months
+                t_purchase.c.ts == t_products_purchased.c.prch_ts
+            )))\
+        .group_by(*t_purchase.c)
+
+
+def purchase_keys():
+    """
+    The (id, ts) pairs bound to prch_ids and prch_tss as rows. Joining
+    purchase to them on both columns reads each purchase from its own
+    partition, where id = ANY(...) reads every partition
+    """
+    return sqlalchemy.func.unnest(
+        int_array('prch_ids'), int_array('prch_tss', sqlalchemy.DateTime)
+    ).table_valued(
+        sqlalchemy.column('id', sqlalchemy.Integer),
+        sqlalchemy.column('ts', sqlalchemy.DateTime)
+    ).render_derived()
+
+
+def join_purchase_keys(keys, t_purchase):
+    return keys.join(t_purchase, sqlalchemy.and_(
+        t_purchase.c.id == keys.c.id, t_purchase.c.ts == keys.c.ts))
+
+
+def select_carbon_costs(tables, keys):
+    """
+    Select the carbon cost of each purchase in keys, see purchase_keys,
+    using the same precedence as ProductUpdateHandler: an item costs its
+    company_product carbon cost, then its product carbon cost.
+    Purchases with no costed items fall back to the seller's g / dollar
+    times the price in cents.
+    """
+    t_purchase = tables['purchase']
+    t_products_purchased = tables['products_purchased']
+    t_product = tables['product']
+    t_company_product = tables['company_product']
+    t_seller = tables['entity'].alias('seller')
+
+    item_cost = sqlalchemy.func.coalesce(
+        t_company_product.c.carbon_cost, t_product.c.carbon_cost)
+    carbon_cost = sqlalchemy.func.coalesce(
+        sqlalchemy.func.sum(item_cost),
+        # integer division, carbon_cost is stored in whole grams
+        t_seller.c.carbon_cost * t_purchase.c.price / 100
+    )
+    return sqlalchemy\
+        .select(t_purchase.c.id, t_purchase.c.ts, carbon_cost.label('carbon_cost'))\
+        .select_from(
+            join_purchase_keys(keys, t_purchase)
+            .join(t_seller, t_seller.c.id == t_purchase.c.selr_id)
+            .outerjoin(t_products_purchased, sqlalchemy.and_(
+                t_products_purchased.c.prch_id == t_purchase.c.id,
+                t_products_purchased.c.prch_ts == t_purchase.c.ts
+            ))
+            .outerjoin(
+                t_product,
+                t_product.c.id == t_products_purchased.c.prod_id)
+            .outerjoin(t_company_product, sqlalchemy.and_(
+                t_company_product.c.comp_id == t_products_purchased.c.comp_id,
+                t_company_product.c.prod_id == t_products_purchased.c.prod_id
+            ))
+        )\
+        .group_by(
+            t_purchase.c.id, t_purchase.c.ts, t_purchase.c.price, t_seller.c.carbon_cost)
+
+
+def entity_statements(tables):
+    t_entity = tables['entity']
+    return dict(
+        entity_get=sqlalchemy
+        .select(t_entity, row_version(t_entity))
+        .where(t_entity.c.id == bindparam('id')),
+        entity_version=sqlalchemy
+        .select(row_version(t_entity))
+        .where(t_entity.c.id == bindparam('id')),
+        entity_get_multi=sqlalchemy
+        .select(t_entity)
+        .where(t_entity.c.id == sqlalchemy.any_(int_array('ids'))),
+        entity_update=sqlalchemy
+        .update(t_entity)
+        .where(t_entity.c.id == bindparam('entity_id'))
+        .values(
+            carbon_offset=bindparam('carbon_offset'),
+            carbon_cost=bindparam('carbon_cost'))
+        .returning(t_entity.c.id),
+        # ProductUpdateHandler with no prod_id
+        entity_update_carbon_cost=sqlalchemy
+        .update(t_entity)
+        .where(t_entity.c.id == bindparam('entity_id'))
+        .values(carbon_cost=bindparam('carbon_cost'))
+        .returning(t_entity.c.id),
+        entity_purchases=entity_purchases_statements(tables),
+        entity_carbon=entity_carbon_statements(tables)
+    )
+
+
+def entity_purchases_statements(tables):
+    """
+    The purchases of buyr_id between start_ts and end_ts, keyed by whether
+    they start after a page cursor and whether they take a limit
+    """
+    t_purchase = tables['purchase']
+    base = sqlalchemy\
+        .select(t_purchase)\
+        .where(
+            t_purchase.c.buyr_id == bindparam('buyr_id'),
+            t_purchase.c.ts > bindparam('start_ts'),
+            t_purchase.c.ts < bindparam('end_ts')
+        )\
+        .order_by(t_purchase.c.ts, t_purchase.c.id)
+    statements = {}
+    for paged in (False, True):
+        stmt = base
+        if paged:
+            stmt = stmt.where(
+                sqlalchemy.tuple_(t_purchase.c.ts, t_purchase.c.id) >
+                sqlalchemy.tuple_(
+                    bindparam('cursor_ts', type_=sqlalchemy.DateTime),
+                    bindparam('cursor_id', type_=sqlalchemy.Integer)))
+        for limited in (False, True):
+            statements[paged, limited] = stmt.limit(
+                bindparam('limit', type_=sqlalchemy.Integer)) if limited else stmt
+    return statements
+
+
+def entity_carbon_statements(tables):
+    """
+    The rollup totals of entity_id between start_day and end_day, keyed by
+    bucket. The bucket is rendered inline, so the date_trunc expression in
+    the select list and the group by is the same
+    """
+    t_rollup = tables['entity_daily_rollup']
+    statements = {}
+    for bucket in CARBON_BUCKETS:
+        bucket_start = sqlalchemy.func.date_trunc(
+            sqlalchemy.literal_column("'%s'" % bucket),
+            sqlalchemy.cast(t_rollup.c.day, sqlalchemy.DateTime),
+            type_=sqlalchemy.DateTime)
+        statements[bucket] = sqlalchemy\
+            .select(
+                bucket_start.label('ts'),
+                sqlalchemy.func.sum(t_rollup.c.purchase_count).label('purchase_count'),
+                sqlalchemy.func.sum(t_rollup.c.price_total).label('price'),
+                sqlalchemy.func.sum(t_rollup.c.carbon_cost_total).label('carbon_cost')
+            )\
+            .where(
+                t_rollup.c.entity_id == bindparam('entity_id'),
+                t_rollup.c.day >= bindparam('start_day'),
+                t_rollup.c.day <= bindparam('end_day')
+            )\
+            .group_by(bucket_start)\
+            .order_by(bucket_start)
+    return statements
+
+
+def product_statements(tables):
+    t_product = tables['product']
+    t_company_product = tables['company_product']
+    pairs = sqlalchemy\
+        .select(unnest('comp_ids').label('comp_id'), unnest('prod_ids').label('prod_id'))\
+        .subquery()
+    # every statement whose rows go into the product cache selects the
+    # version, so a cached row can be validated without a query
+    return dict(
+        product_get=sqlalchemy
+        .select(t_product, row_version(t_product))
+        .where(t_product.c.id == bindparam('id')),
+        product_get_multi=sqlalchemy
+        .select(t_product, row_version(t_product))
+        .where(t_product.c.id == sqlalchemy.any_(int_array('ids'))),
+        product_version=sqlalchemy
+        .select(row_version(t_product))
+        .where(t_product.c.id == bindparam('id')),
+        product_update=sqlalchemy
+        .update(t_product)
+        .where(t_product.c.id == bindparam('product_id'))
+        .values(carbon_cost=bindparam('carbon_cost'))
+        .returning(t_product.c.id),
+        company_product_get=sqlalchemy
+        .select(t_company_product, row_version(t_company_product))
+        .where(
+            t_company_product.c.comp_id == bindparam('comp_id'),
+            t_company_product.c.prod_id == bindparam('prod_id')),
+        company_product_version=sqlalchemy
+        .select(row_version(t_company_product))
+        .where(
+            t_company_product.c.comp_id == bindparam('comp_id'),
+            t_company_product.c.prod_id == bindparam('prod_id')),
+        company_product_get_multi=sqlalchemy
+        .select(t_company_product, row_version(t_company_product))
+        .join(pairs, sqlalchemy.and_(
+            t_company_product.c.comp_id == pairs.c.comp_id,
+            t_company_product.c.prod_id == pairs.c.prod_id)),
+        company_product_add=sqlalchemy.insert(t_company_product),
+        company_product_update=sqlalchemy
+        .update(t_company_product)
+        .where(
+            t_company_product.c.comp_id == bindparam('company_id'),
+            t_company_product.c.prod_id == bindparam('product_id'))
+        .values(carbon_cost=bindparam('carbon_cost'))
+        .returning(t_company_product.c.comp_id),
+        # key is a cache key encoded by handlers.cache.encode_key, the
+        # notification is only delivered if the transaction commits
+        product_cache_notify=sqlalchemy.select(sqlalchemy.func.pg_notify(
+            sqlalchemy.literal_column("'%s'" % PRODUCT_CACHE_CHANNEL),
+            sqlalchemy.cast(bindparam('key'), sqlalchemy.Text)))
+    )
+
+
+def purchase_statements(tables):
+    t_purchase = tables['purchase']
+    t_products_purchased = tables['products_purchased']
+    costs = select_carbon_costs(tables, purchase_keys()).subquery()
+    return dict(
+        purchase_get=select_purchases_with_items(t_purchase, t_products_purchased)
+        .where(t_purchase.c.id == bindparam('id')),
+        purchase_get_multi=select_purchases_with_items(t_purchase, t_products_purchased)
+        .where(t_purchase.c.id == sqlalchemy.any_(int_array('ids'))),
+        purchase_add=sqlalchemy
+        .insert(t_purchase)
+        .returning(t_purchase.c.id, t_purchase.c.ts),
+        purchase_add_many=insert_purchases_in_order(t_purchase),
+        purchase_ts=sqlalchemy
+        .select(t_purchase.c.id, t_purchase.c.ts)
+        .where(t_purchase.c.id == sqlalchemy.any_(int_array('prch_ids'))),
+        purchase_update=sqlalchemy
+        .update(t_purchase)
+        .where(
+            t_purchase.c.id == bindparam('purchase_id'),
+            t_purchase.c.ts == bindparam('purchase_ts'))
+        .values(**{column: bindparam(column) for column in PURCHASE_COLUMNS})
+        .returning(t_purchase.c.id, t_purchase.c.ts),
+        purchase_recompute=sqlalchemy
+        .update(t_purchase)
+        .where(t_purchase.c.id == costs.c.id, t_purchase.c.ts == costs.c.ts)
+        .values(carbon_cost=costs.c.carbon_cost)
+        .returning(t_purchase.c.id, t_purchase.c.carbon_cost),
+        products_purchased_add=sqlalchemy.insert(t_products_purchased),
+        products_purchased_add_many=sqlalchemy
+        .insert(t_products_purchased)
+        .from_select(
+            ITEM_COLUMNS + ['prch_ts'],
+            sqlalchemy.select(
+                unnest('prch_ids'), unnest('comp_ids'), unnest('prod_ids'),
+                unnest('prch_tss', sqlalchemy.DateTime))),
+        products_purchased_delete=sqlalchemy
+        .delete(t_products_purchased)
+        .where(
+            t_products_purchased.c.prch_id == bindparam('prch_id'),
+            t_products_purchased.c.prch_ts == bindparam('prch_ts')),
+        apply_rollups=sqlalchemy.select(sqlalchemy.func.apply_purchase_rollups(
+            int_array('prch_ids'), int_array('prch_tss', sqlalchemy.DateTime),
+            bindparam('sign', type_=sqlalchemy.Integer))),
+        purchase_notify=select_purchase_notify(t_purchase),
+        purchase_export=purchase_export_queries()
+    )
+
+
+def insert_purchases_in_order(t_purchase):
+    """
+    Insert a purchase per element of the arrays bound to each column name
+    and select the id and ts of each, in the order of the arrays
+    Neither the order rows are inserted in nor the order of RETURNING is
+    defined, so each row's id is drawn alongside its position in the
+    arrays and the inserted rows are matched back to it by id
+    """
+    rows = sqlalchemy.func.unnest(*[int_array(column) for column in PURCHASE_COLUMNS])\
+        .table_valued(*PURCHASE_COLUMNS, with_ordinality='position')\
+        .render_derived()
+    new_rows = sqlalchemy\
+        .select(
+            sqlalchemy.func.nextval(sqlalchemy.func.pg_get_serial_sequence(
+                sqlalchemy.literal_column("'purchase'"),
+                sqlalchemy.literal_column("'id'"))).label('id'),
+            rows.c.position,
+            *[rows.c[column] for column in PURCHASE_COLUMNS])\
+        .cte('new_rows')
+    inserted = sqlalchemy\
+        .insert(t_purchase)\
+        .from_select(
+            ['id'] + PURCHASE_COLUMNS,
+            sqlalchemy.select(
+                new_rows.c.id, *[new_rows.c[column] for column in PURCHASE_COLUMNS]))\
+        .returning(t_purchase.c.id, t_purchase.c.ts)\
+        .cte('inserted')
+    return sqlalchemy\
+        .select(inserted.c.id, inserted.c.ts)\
+        .join(new_rows, new_rows.c.id == inserted.c.id)\
+        .order_by(new_rows.c.position)
+
+
+def select_purchase_notify(t_purchase):
+    """
+    NOTIFY PURCHASE_FEED_CHANNEL of each purchase in prch_ids, whose ts
+    are in prch_tss, see purchase_keys, with a JSON payload of op (add or
+    update) and the purchase's columns. Notifications are only delivered
+    if the transaction commits
+    """
+    fields = dict(
+        op=sqlalchemy.cast(bindparam('op'), sqlalchemy.Text),
+        **{column: t_purchase.c[column] for column in ['id'] + PURCHASE_COLUMNS},
+        # always with microseconds, which datetime.fromisoformat expects
+        ts=sqlalchemy.func.to_char(
+            t_purchase.c.ts, sqlalchemy.literal_column("'YYYY-MM-DD\"T\"HH24:MI:SS.US'"))
+    )
+    payload = sqlalchemy.func.json_build_object(*[
+        arg
+        for name, value in fields.items()
+        for arg in (sqlalchemy.literal_column("'%s'" % name), value)
+    ])
+    return sqlalchemy\
+        .select(sqlalchemy.func.pg_notify(
+            sqlalchemy.literal_column("'%s'" % PURCHASE_FEED_CHANNEL),
+            sqlalchemy.cast(payload, sqlalchemy.Text)))\
+        .select_from(join_purchase_keys(purchase_keys(), t_purchase))
+
+
+def purchase_export_queries():
+    """
+    The queries /purchase/export copies out, keyed by format, whether they
+    include items, whether they are filtered by buyer and the ts format.
+    COPY takes SQL text rather than a statement, $1 and $2 bound the ts
+    range and $3 is the buyer. csv has a row per item, ndjson an item_list
+    per purchase. ndjson is copied in COPY's text format, which would
+    escape backslashes and tabs, but the objects only hold numbers and
+    timestamps
+    """
+    columns = ['id'] + PURCHASE_COLUMNS
+    item_list = \
+        "coalesce((SELECT json_agg(json_build_object(%s)) FROM products_purchased pp" \
+        " WHERE pp.prch_id = p.id AND pp.prch_ts = p.ts), '[]'::json)" % ', '.join(
+            "'%s', pp.%s" % (name, name) for name in ITEM_COLUMNS)
+    queries = {}
+    for items, by_buyer, ts_format in itertools.product(
+            (False, True), (False, True), EXPORT_TS_FORMATS):
+        where = 'p.ts >= $1 AND p.ts < $2' + (' AND p.buyr_id = $3' if by_buyer else '')
+        ts = EXPORT_TS_FORMATS[ts_format]
+        csv_columns = ['p.%s' % name for name in columns] + ['%s AS ts' % ts]
+        from_clause = 'purchase p'
+        if items:
+            csv_columns += ['pp.comp_id', 'pp.prod_id']
+            from_clause += ' LEFT JOIN products_purchased pp' \
+                ' ON pp.prch_id = p.id AND pp.prch_ts = p.ts'
+        queries['csv', items, by_buyer, ts_format] = \
+            'SELECT %s FROM %s WHERE %s ORDER BY p.ts, p.id' % (
+                ', '.join(csv_columns), from_clause, where)
+        fields = ["'%s', p.%s" % (name, name) for name in columns] + ["'ts', " + ts]
+        if items:
+            fields.append("'item_list', " + item_list)
+        queries['ndjson', items, by_buyer, ts_format] = \
+            'SELECT json_build_object(%s) FROM purchase p WHERE %s ORDER BY p.ts, p.id' % (
+                ', '.join(fields), where)
+    return queries
+
+
+def build_statements(metadata):
+    tables = metadata.tables
+    return SimpleNamespace(
+        **entity_statements(tables),
+        **product_statements(tables),
+        **purchase_statements(tables)
+    )
@@ -0,0 +1,48 @@
+from handlers.base import BaseHandler
+
+
+class CacheStatsHandler(BaseHandler):
+    def get(self):
+        """
+        Return the size and hit/miss counters of the in-process caches
+        """
+        result = {
+            'product_cache': self.db.product_cache.stats()
+        }
+        self.write_json(result)
+
+
+class PoolStatsHandler(BaseHandler):
+    def get(self):
+        """
+        Return the connection pool gauges, checkout wait times are in seconds
+        The replica's pool is under replica, if one is configured
+        """
+        result = self.db.async_engine.pool.stats()
+        if self.db.read_engine is not self.db.async_engine:
+            result['replica'] = self.db.read_engine.pool.stats()
+        self.write_json(result)
+
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+        """
+        Return the request, query and pool metrics of this process, and
+        those of the purchase coalescer and feed if they are enabled, in
+        the Prometheus text format
+        """
+        metrics = self.application.metrics
+        pools = dict(primary=self.db.async_engine)
+        if self.db.read_engine is not self.db.async_engine:
+            pools['replica'] = self.db.read_engine
+        for name, engine in pools.items():
+            for stat, value in engine.pool.stats().items():
+                metrics.pool.set(name, stat, value=value)
+        if self.db.purchase_coalescer is not None:
+            for stat, value in self.db.purchase_coalescer.stats().items():
+                metrics.purchase_coalescer.set(stat, value=value)
+        if self.db.purchase_feed is not None:
+            for stat, value in self.db.purchase_feed.stats().items():
+                metrics.purchase_feed.set(stat, value=int(value))
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.render())
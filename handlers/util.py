@@ -0,0 +1,61 @@
+import tornado.web
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+
+def int_array(key, item_type=sqlalchemy.Integer):
+    """
+    A single INT[] bind parameter called key, which takes a python list
+    Pass item_type for arrays of another type, e.g. TIMESTAMP[]
+    """
+    return sqlalchemy.cast(
+        sqlalchemy.bindparam(key), postgresql.ARRAY(item_type))
+
+
+def unnest(key, item_type=sqlalchemy.Integer):
+    """
+    Expand the python list bound to key into rows with a single array bind
+    parameter, so a statement uses a fixed number of parameters however
+    many rows it inserts
+    """
+    return sqlalchemy.func.unnest(int_array(key, item_type), type_=item_type)
+
+
+def without_version(row):
+    """
+    The columns of a row selected with its version, for the response body
+    """
+    data = row._asdict()
+    del data['version']
+    return data
+
+
+def parse_ids(value):
+    """
+    Parse a comma separated list of ids from a query argument,
+    duplicates are dropped but the order is kept
+    """
+    try:
+        ids = [int(x) for x in value.split(',') if x.strip()]
+    except ValueError:
+        raise tornado.web.HTTPError(
+            status_code=400, reason='ids must be comma separated integers')
+    return list(dict.fromkeys(ids))
+
+
+def parse_pairs(value):
+    """
+    Parse a comma separated list of comp_id:prod_id pairs from a query
+    argument, duplicates are dropped but the order is kept
+    """
+    try:
+        pairs = [
+            tuple(int(id) for id in x.split(':'))
+            for x in value.split(',') if x.strip()
+        ]
+    except ValueError:
+        pairs = None
+    if pairs is None or any(len(pair) != 2 for pair in pairs):
+        raise tornado.web.HTTPError(
+            status_code=400, reason='pairs must be comma separated comp_id:prod_id')
+    return list(dict.fromkeys(pairs))
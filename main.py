@@ -1,70 +1,445 @@
+import asyncio
 import configparser
+import functools
 import logging
+import os
+import signal
+import sys
+import time
 from types import SimpleNamespace
+import tornado.httpserver
+import tornado.httputil
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
-import sqlalchemy
-from handlers.entity import EntityGetHandler, EntityPurchasesGetHandler, EntityUpdateHandler
+import metrics
+import migrate
+import pool
+import schema
+from handlers.base import get_serializer
+from handlers.cache import CacheInvalidator, LRUCache
+from handlers.coalesce import PurchaseCoalescer
+from handlers.feed import PurchaseFeed
+from handlers.entity import EntityCarbonGetHandler, EntityGetHandler, EntityMultiGetHandler, \
+    EntityPurchasesGetHandler, EntityUpdateHandler
 from handlers.ping import PingHandler
-from handlers.product import ProductAddHandler, ProductCompanyGetHandler, ProductGetHandler, ProductUpdateHandler
-from handlers.purchase import PurchaseGetHandler, PurchaseUpdateHandler, PurchaseAddHandler
+from handlers.statements import build_statements
+from handlers.product import ProductAddHandler, ProductCompanyGetHandler, ProductCompanyMultiGetHandler, ProductGetHandler, \
+    ProductMultiGetHandler, ProductUpdateHandler
+from handlers.purchase import PurchaseBatchAddHandler, PurchaseExportHandler, PurchaseFeedHandler, \
+    PurchaseGetHandler, PurchaseMultiGetHandler, PurchaseRecomputeHandler, PurchaseUpdateHandler, \
+    PurchaseAddHandler
+from handlers.stats import CacheStatsHandler, MetricsHandler, PoolStatsHandler
 from tornado.log import enable_pretty_logging
 from sqlalchemy.ext.asyncio import create_async_engine
 
 
+# exit status of a worker that drained after SIGHUP and wants replacing
+EXIT_RESTART = 3
+
+logger = logging.getLogger('tornado.application')
+
+
+class Application(tornado.web.Application):
+    """
+    Counts the requests in flight, so a worker can wait for them to
+    finish before it shuts down, and records the metrics of each request
+    against the route pattern it matched
+    """
+    in_flight = 0
+
+    def __init__(self, handlers, **settings):
+        super().__init__(handlers, **settings)
+        self.metrics = metrics.Metrics()
+        self.route_names = {
+            rule.target: rule.matcher.regex.pattern.rstrip('$')
+            for rule in self.wildcard_router.rules
+        }
+
+    def route_name(self, handler_class):
+        return self.route_names.get(handler_class, 'unmatched')
+
+    def find_handler(self, request, **kwargs):
+        self.in_flight += 1
+        delegate = super().find_handler(request, **kwargs)
+        route = self.route_name(delegate.handler_class)
+        self.metrics.request_started(route)
+        return CountingDelegate(self, delegate, route)
+
+    def request_abandoned(self, route):
+        """
+        End the count of a request whose handler never ran
+        """
+        self.in_flight -= 1
+        self.metrics.request_abandoned(route)
+
+    def log_request(self, handler):
+        self.in_flight -= 1
+        self.metrics.request_finished(
+            self.route_name(type(handler)), handler.request.method,
+            handler.get_status(), handler.request.request_time())
+        super().log_request(handler)
+
+
+class CountingDelegate(tornado.httputil.HTTPMessageDelegate):
+    """
+    Passes a request on to the delegate that runs its handler
+    A request is counted as soon as its headers arrive, and uncounted in
+    log_request once its handler finishes. The handler only runs once the
+    body has arrived, so if the connection closes before then, e.g. the
+    client gave up mid upload, the count is ended here instead
+    """
+
+    def __init__(self, app, delegate, route):
+        self.app = app
+        self.delegate = delegate
+        self.route = route
+        self.executed = False
+
+    def headers_received(self, start_line, headers):
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        self.executed = True
+        self.delegate.finish()
+
+    def on_connection_close(self):
+        if not self.executed:
+            self.executed = True
+            self.app.request_abandoned(self.route)
+        self.delegate.on_connection_close()
+
+
 def initialise_database(config):
+    """
+    Tables come from the static definitions in schema.py, so no database
+    round trip is needed before the service can start, and the statements
+    the handlers execute are built from them once here
+    read_engine connects to database_url_async_read, a read-only replica,
+    if it is set, otherwise it is the primary's async_engine
+    """
     mode = config['MODE']['mode']
-    debug=config[mode].getboolean('debug')
-    engine = sqlalchemy.create_engine(
-        config[mode]['database_url'], echo=debug, future=True)
-    metadata = sqlalchemy.MetaData()
-    sqlalchemy.Table(
-        'entity', metadata, autoload=True, autoload_with=engine)
-    sqlalchemy.Table(
-        'product', metadata, autoload=True, autoload_with=engine)
-    sqlalchemy.Table(
-        'company_product', metadata, autoload=True, autoload_with=engine)
-    sqlalchemy.Table(
-        'purchase', metadata, autoload=True, autoload_with=engine)
-    sqlalchemy.Table(
-        'products_purchased', metadata, autoload=True, autoload_with=engine)
+    debug = config[mode].getboolean('debug')
     async_engine = create_async_engine(
-        config[mode]['database_url_async'], echo=debug, future=True)
-    return SimpleNamespace(engine=engine, async_engine=async_engine, metadata=metadata)
+        config[mode]['database_url_async'], echo=debug, future=True,
+        **pool.pool_options(config[mode]))
+    read_engine = async_engine
+    if config[mode].get('database_url_async_read'):
+        read_engine = create_async_engine(
+            config[mode]['database_url_async_read'], echo=debug, future=True,
+            **pool.pool_options(config[mode], prefix='read_'))
+    return SimpleNamespace(
+        async_engine=async_engine, read_engine=read_engine,
+        metadata=schema.metadata, stmts=build_statements(schema.metadata))
 
 
-def make_app(config):
+def engines(db):
+    """
+    The distinct engines of db, the primary first
+    """
+    return [db.async_engine] + (
+        [db.read_engine] if db.read_engine is not db.async_engine else [])
+
+
+def make_app(config, **settings):
     mode = config['MODE']['mode']
+    if config[mode].getboolean('migrate_on_start', fallback=False):
+        tornado.ioloop.IOLoop.current().run_sync(
+            functools.partial(migrate.migrate, config[mode]['database_url']))
     db = initialise_database(config)
+    db.product_cache = LRUCache(
+        maxsize=config[mode].getint('product_cache_size', fallback=10000),
+        ttl=config[mode].getfloat('product_cache_ttl', fallback=60))
+    db.product_cache_invalidator = None
+    if db.product_cache.maxsize > 0:
+        # LISTEN is not replicated either, and writes go to the primary
+        db.product_cache_invalidator = CacheInvalidator(
+            config[mode]['database_url'], db.product_cache)
+        tornado.ioloop.IOLoop.current().spawn_callback(
+            db.product_cache_invalidator.listen)
+    serializer = get_serializer(config[mode].get('serializer', 'json'))
+    db.purchase_feed = None
+    if config[mode].getboolean('purchase_feed', fallback=False):
+        # NOTIFY is not replicated, so the feed listens on the primary
+        db.purchase_feed = PurchaseFeed(
+            config[mode]['database_url'], serializer,
+            queue_size=config[mode].getint('purchase_feed_queue_size', fallback=1000))
+    db.purchase_coalescer = None
+    if config[mode].getboolean('purchase_coalesce', fallback=False):
+        db.purchase_coalescer = PurchaseCoalescer(
+            db.async_engine, db.stmts,
+            window_ms=config[mode].getfloat('purchase_coalesce_window_ms', fallback=2),
+            max_batch=config[mode].getint('purchase_coalesce_max_batch', fallback=100),
+            notify=db.purchase_feed is not None)
+    if config[mode].getboolean('schema_check', fallback=True):
+        tornado.ioloop.IOLoop.current().spawn_callback(
+            schema.check_schema, db.async_engine)
+    if config[mode].getboolean('pool_warm_up', fallback=False):
+        for engine in engines(db):
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                pool.warm_up, engine, engine.pool.size())
     d = dict(db=db)
 
-    return tornado.web.Application([
+    app = Application([
         (r'/ping', PingHandler),
+        (r'/stats/cache', CacheStatsHandler, d),
+        (r'/stats/pool', PoolStatsHandler, d),
+        (r'/metrics', MetricsHandler, d),
         (r'/purchase/get/(?P<prch_id>[0-9]*)', PurchaseGetHandler, d),
+        (r'/purchase/get', PurchaseMultiGetHandler, d),
         (r'/purchase/add', PurchaseAddHandler, d),
+        (r'/purchase/add/batch', PurchaseBatchAddHandler, d),
         (r'/purchase/update', PurchaseUpdateHandler, d),
+        (r'/purchase/recompute', PurchaseRecomputeHandler, d),
+        (r'/purchase/feed', PurchaseFeedHandler, d),
+        (r'/purchase/export', PurchaseExportHandler, d),
         (r'/product/get/(?P<comp_id>[0-9]*)/(?P<prod_id>[0-9]*)',
          ProductCompanyGetHandler, d),
          (r'/product/get/(?P<prod_id>[0-9]*)', ProductGetHandler, d),
+        (r'/product/get', ProductMultiGetHandler, d),
+        (r'/product/company/get', ProductCompanyMultiGetHandler, d),
         (r'/product/add', ProductAddHandler, d),
         (r'/product/update', ProductUpdateHandler, d),
         (r'/entity/get/(?P<user_id>[0-9]*)', EntityGetHandler, d),
+        (r'/entity/get', EntityMultiGetHandler, d),
         (r'/entity/update', EntityUpdateHandler, d),
-        (r'/entity/purchases/get/(?P<user_id>[0-9]*)', EntityPurchasesGetHandler, d)
+        (r'/entity/purchases/get/(?P<user_id>[0-9]*)', EntityPurchasesGetHandler, d),
+        (r'/entity/carbon/get/(?P<user_id>[0-9]*)', EntityCarbonGetHandler, d)
     ],
-        debug=config[mode].getboolean('debug')
-    ), db
+        debug=config[mode].getboolean('debug'),
+        serializer=serializer,
+        **settings
+    )
+    for engine in engines(db):
+        metrics.instrument_engine(
+            engine, app.metrics,
+            slow_query_ms=config[mode].getfloat('slow_query_ms', fallback=None))
+    return app, db
+
+
+def listen_connections(section):
+    """
+    The connections each worker holds to the primary outside its pools,
+    for the LISTEN of the product cache invalidator and the purchase feed
+    """
+    return int(section.getint('product_cache_size', fallback=10000) > 0) \
+        + int(section.getboolean('purchase_feed', fallback=False))
+
+
+def budget_pool(section, prefix, budget):
+    """
+    Shrink the pool configured by the prefix + pool_size and prefix +
+    pool_max_overflow options of section so that it opens at most budget
+    connections, the read_ options default to the primary's
+    """
+    if budget < 1:
+        raise ValueError('max_connections is too low for the number of workers')
+    pool_size = min(section.getint(
+        prefix + 'pool_size', fallback=section.getint('pool_size', fallback=5)), budget)
+    max_overflow = min(section.getint(
+        prefix + 'pool_max_overflow', fallback=section.getint('pool_max_overflow', fallback=10)),
+        budget - pool_size)
+    section[prefix + 'pool_size'] = str(pool_size)
+    section[prefix + 'pool_max_overflow'] = str(max_overflow)
+    logger.info('worker %spool: size %d, overflow %d', prefix, pool_size, max_overflow)
+
+
+def apply_connection_budget(config, workers):
+    """
+    Shrink each worker's pools so that all workers together stay within
+    max_connections on the primary, after their LISTEN connections, and
+    within max_connections_read, which defaults to max_connections, on
+    the read replica if one is configured
+    """
+    mode = config['MODE']['mode']
+    section = config[mode]
+    # sized first, as read_ options left unset take the primary's sizes
+    if section.get('database_url_async_read'):
+        budget_pool(section, 'read_', section.getint(
+            'max_connections_read',
+            fallback=section.getint('max_connections', fallback=90)) // workers)
+    budget_pool(
+        section, '',
+        section.getint('max_connections', fallback=90) // workers - listen_connections(section))
+
+
+class Supervisor:
+    """
+    The parent process's side of fork_workers: the worker id of each
+    child pid, the workers left to replace in a rolling restart after
+    SIGHUP, and whether SIGTERM or SIGINT is stopping the service
+    """
+
+    def __init__(self, max_restarts, kill=os.kill):
+        self.max_restarts = max_restarts
+        self.kill = kill
+        self.children = {}
+        self.rolling = []
+        self.stopping = False
+        self.restarts = 0
+
+    def signal_worker(self, pid, signum):
+        try:
+            self.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def on_signal(self, signum, frame=None):
+        if signum == signal.SIGHUP:
+            if self.stopping:
+                return
+            # replace one worker at a time, so the others keep serving
+            self.rolling[:] = list(self.children)
+            if self.rolling:
+                self.signal_worker(self.rolling.pop(0), signal.SIGHUP)
+        else:
+            self.stopping = True
+            self.rolling.clear()
+            for pid in list(self.children):
+                self.signal_worker(pid, signum)
+
+    def started(self, pid, id):
+        """
+        Record a started worker and carry on with a rolling restart, or
+        stop it straight away if SIGTERM arrived while it was starting
+        """
+        self.children[pid] = id
+        if self.stopping:
+            self.signal_worker(pid, signal.SIGTERM)
+        elif self.rolling:
+            self.signal_worker(self.rolling.pop(0), signal.SIGHUP)
+
+    def exited(self, pid, status):
+        """
+        Record a child's exit, returns the id of the worker to start in
+        its place, or None. Raises RuntimeError after max_restarts crashes
+        """
+        if pid not in self.children:
+            return None
+        id = self.children.pop(pid)
+        if self.stopping or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0):
+            logger.info('worker %d (pid %d) stopped', id, pid)
+            return None
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == EXIT_RESTART:
+            logger.info('worker %d (pid %d) drained, restarting', id, pid)
+            return id
+        self.restarts += 1
+        logger.warning(
+            'worker %d (pid %d) died with status %d, restarting', id, pid, status)
+        if self.restarts > self.max_restarts:
+            raise RuntimeError('too many worker restarts, giving up')
+        return id
+
+
+def fork_workers(workers, max_restarts):
+    """
+    Fork the worker processes and supervise them from the parent, like
+    tornado.process.fork_processes, but keeping the worker pids so the
+    parent can pass signals on. Returns the worker id in each worker.
+    A worker that exits with EXIT_RESTART is replaced, as is one that
+    crashes, up to max_restarts times, until SIGTERM or SIGINT, after
+    which exited workers are not replaced. The parent exits once every
+    worker has exited.
+    """
+    supervisor = Supervisor(max_restarts)
+    signums = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+
+    def start_worker(id):
+        pid = os.fork()
+        if pid == 0:
+            for signum in signums:
+                signal.signal(signum, signal.SIG_DFL)
+            return True
+        supervisor.started(pid, id)
+        return False
+
+    for signum in signums:
+        signal.signal(signum, supervisor.on_signal)
+    for id in range(workers):
+        if start_worker(id):
+            return id
+    while supervisor.children:
+        id = supervisor.exited(*os.wait())
+        if id is not None and start_worker(id):
+            return id
+    sys.exit(0)
+
+
+def serve(config):
+    """
+    Serve on the configured port with the configured number of worker
+    processes, each of which builds its own app and async engine after
+    the fork, since asyncpg connections cannot be shared between processes
+    SIGTERM or SIGINT drains the workers and stops the service. With
+    more than one worker, SIGHUP drains the workers and replaces them.
+    Signals may be sent to the parent process, which passes SIGHUP on to
+    one worker at a time and the others to every worker, or to a single
+    worker.
+    """
+    mode = config['MODE']['mode']
+    section = config[mode]
+    port = section.getint('port', fallback=8888)
+    workers = section.getint('workers', fallback=1)
+    if workers <= 0:
+        workers = tornado.process.cpu_count()
+    settings = {}
+    # bound before forking, so every worker accepts on the same socket and
+    # connections queue in its backlog while a worker is being replaced
+    sockets = tornado.netutil.bind_sockets(port)
+    if workers > 1:
+        fork_workers(workers, section.getint('max_restarts', fallback=100))
+        # autoreload restarts the process in place, which breaks the fork
+        settings['autoreload'] = False
+
+    apply_connection_budget(config, workers)
+    app, db = make_app(config, **settings)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    io_loop = tornado.ioloop.IOLoop.current()
+    exit_status = None
+
+    async def shutdown(status):
+        nonlocal exit_status
+        if exit_status is not None:
+            return
+        exit_status = status
+        server.stop()
+        # ends the feed streams, which would otherwise stay in flight
+        if db.purchase_feed is not None:
+            await db.purchase_feed.close()
+        if db.product_cache_invalidator is not None:
+            await db.product_cache_invalidator.close()
+        deadline = time.monotonic() + section.getfloat('shutdown_timeout', fallback=10)
+        while app.in_flight > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await server.close_all_connections()
+        for engine in engines(db):
+            await engine.dispose()
+        io_loop.stop()
+
+    def on_signal(signum, frame):
+        status = EXIT_RESTART if signum == signal.SIGHUP else 0
+        io_loop.add_callback_from_signal(shutdown, status)
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, on_signal)
+    # only a forked worker has a parent to replace it
+    if workers > 1:
+        signal.signal(signal.SIGHUP, on_signal)
+    io_loop.start()
+    sys.exit(exit_status)
 
 
 if __name__ == '__main__':
     config = configparser.ConfigParser()
     config.read('config.ini')
     
-    logger = logging.getLogger('tornado.application')
     enable_pretty_logging()
     logger.addHandler(logging.StreamHandler())
     logger.addHandler(logging.FileHandler('database.log'))
 
-    app, _ = make_app(config)
-    app.listen(8888)
-    tornado.ioloop.IOLoop.current().start()
+    serve(config)
@@ -0,0 +1,182 @@
+"""
+In-process request and database metrics, rendered in the Prometheus text
+exposition format by /metrics
+Each worker process keeps its own metrics, so with more than one worker a
+scrape only sees the worker that answered it
+"""
+import bisect
+import collections
+import logging
+import time
+from sqlalchemy import event
+import profiling
+
+
+logger = logging.getLogger('tornado.application')
+
+
+# seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, escape(value)) for name, value in zip(names, values))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = collections.defaultdict(int)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] += amount
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.labels, labels), value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.values[labels] -= amount
+
+    def set(self, *labels, value):
+        self.values[labels] = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # per label set: a count for each bucket plus +Inf, and the sum
+        self.counts = {}
+        self.sums = collections.defaultdict(float)
+
+    def observe(self, *labels, value):
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for labels, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield (self.name + '_bucket',
+                       format_labels(names, labels + (bound,)), total)
+            yield self.name + '_sum', format_labels(self.labels, labels), self.sums[labels]
+            yield self.name + '_count', format_labels(self.labels, labels), total
+
+
+class Metrics:
+    """
+    The metrics of one process, requests are labelled by the route pattern
+    they matched in make_app and queries by their SQL verb
+    """
+
+    def __init__(self):
+        self.requests = Counter(
+            'http_requests_total', 'Requests finished',
+            ('route', 'method', 'status'))
+        self.request_duration = Histogram(
+            'http_request_duration_seconds', 'Request latency',
+            ('route', 'method'))
+        self.in_flight = Gauge(
+            'http_requests_in_flight', 'Requests being handled', ('route',))
+        self.query_duration = Histogram(
+            'db_query_duration_seconds', 'Statement execution time, including the round trip',
+            ('operation',))
+        self.query_errors = Counter(
+            'db_query_errors_total', 'Statements that raised', ('operation',))
+        self.pool = Gauge(
+            'db_pool', 'Connection pool gauges and counters from /stats/pool',
+            ('pool', 'stat'))
+        self.purchase_coalescer = Gauge(
+            'purchase_coalescer', 'Coalesced purchase add batches and purchases',
+            ('stat',))
+        self.purchase_feed = Gauge(
+            'purchase_feed', 'Purchase feed subscribers, notifications and reconnects',
+            ('stat',))
+
+    def all(self):
+        return [self.requests, self.request_duration, self.in_flight,
+                self.query_duration, self.query_errors, self.pool,
+                self.purchase_coalescer, self.purchase_feed]
+
+    def request_started(self, route):
+        self.in_flight.inc(route)
+
+    def request_abandoned(self, route):
+        self.in_flight.dec(route)
+
+    def request_finished(self, route, method, status, duration):
+        self.in_flight.dec(route)
+        self.requests.inc(route, method, str(status))
+        self.request_duration.observe(route, method, value=duration)
+
+    def render(self):
+        lines = []
+        for metric in self.all():
+            lines.append('# HELP %s %s' % (metric.name, metric.doc))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %r' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+def operation(statement):
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else ''
+
+
+def instrument_engine(async_engine, metrics, slow_query_ms=None):
+    """
+    Time every statement the engine executes, from before the cursor
+    executes it until the driver returns, and charge it to the profile
+    of the request that made it
+    Statements slower than slow_query_ms are logged with their parameters
+    """
+    engine = async_engine.sync_engine
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['query_start'].pop()
+        metrics.query_duration.observe(operation(statement), value=duration)
+        profile = profiling.current.get()
+        if profile is not None:
+            profile.record_query(statement, duration)
+        if slow_query_ms is not None and duration * 1000 >= slow_query_ms:
+            logger.warning(
+                'slow query (%.1fms): %s parameters: %r',
+                duration * 1000, statement, parameters)
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        starts = context.connection.info.get('query_start') if context.connection else None
+        if starts:
+            starts.pop()
+        metrics.query_errors.inc(operation(context.statement or ''))
@@ -0,0 +1,160 @@
+"""
+Apply the schema migrations in migrations/ that have not been applied yet
+
+$ python migrate.py
+$ python migrate.py --list
+
+Migrations are named <version>_<name>.sql and applied in version order.
+Each one runs in its own transaction, unless its first line is
+"-- no-transaction", which is needed for CREATE INDEX CONCURRENTLY. Those
+migrations must hold a single statement. Statements should be written so
+that running them twice is harmless.
+"""
+import argparse
+import asyncio
+import configparser
+import hashlib
+import logging
+import os
+import asyncpg
+
+
+logger = logging.getLogger('migrate')
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+NO_TRANSACTION = '-- no-transaction'
+# any constant shared by every process that runs migrations
+LOCK_ID = 5432001
+
+
+def load_migrations(path=MIGRATIONS_DIR):
+    """
+    Return (version, name, sql, checksum) for every migration file,
+    ordered by version
+    """
+    migrations = []
+    for filename in os.listdir(path):
+        if not filename.endswith('.sql'):
+            continue
+        version, name = filename[:-len('.sql')].split('_', 1)
+        with open(os.path.join(path, filename)) as f:
+            sql = f.read()
+        checksum = hashlib.sha256(sql.encode()).hexdigest()
+        migrations.append((int(version), name, sql, checksum))
+    return sorted(migrations)
+
+
+async def applied_migrations(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations(
+            version INT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            checksum CHAR(64) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT current_timestamp
+        )
+    ''')
+    rows = await conn.fetch('SELECT version, checksum FROM schema_migrations')
+    return {row['version']: row['checksum'] for row in rows}
+
+
+async def drop_invalid_indexes(conn, sql):
+    """
+    A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind,
+    which IF NOT EXISTS would then skip, so drop it before retrying
+    """
+    rows = await conn.fetch('''
+        SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE NOT i.indisvalid
+    ''')
+    for row in rows:
+        if row['relname'] in sql:
+            logger.warning('dropping invalid index %s', row['relname'])
+            await conn.execute(
+                'DROP INDEX CONCURRENTLY IF EXISTS "%s"' % row['relname'])
+
+
+async def apply_migration(conn, version, name, sql, checksum):
+    logger.info('applying migration %04d_%s', version, name)
+    record = '''
+        INSERT INTO schema_migrations(version, name, checksum)
+        VALUES ($1, $2, $3)
+    '''
+    if sql.startswith(NO_TRANSACTION):
+        await drop_invalid_indexes(conn, sql)
+        try:
+            await conn.execute(sql)
+        except asyncpg.PostgresError as e:
+            # e.g. a unique index over duplicate rows. The invalid index
+            # would still be written, and still enforce uniqueness, until
+            # the next run dropped it
+            logger.error(
+                'migration %04d_%s failed, fix the data and migrate again: %s %s',
+                version, name, e, e.detail or '')
+            await drop_invalid_indexes(conn, sql)
+            raise
+        await conn.execute(record, version, name, checksum)
+    else:
+        async with conn.transaction():
+            await conn.execute(sql)
+            await conn.execute(record, version, name, checksum)
+
+
+async def migrate(dsn, path=MIGRATIONS_DIR):
+    """
+    Apply all pending migrations, returns the versions that were applied
+    An advisory lock stops several processes from migrating at once
+    """
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute('SELECT pg_advisory_lock($1)', LOCK_ID)
+        applied = await applied_migrations(conn)
+        new_versions = []
+        for version, name, sql, checksum in load_migrations(path):
+            if version in applied:
+                if applied[version] != checksum:
+                    logger.warning(
+                        'migration %04d_%s changed after it was applied',
+                        version, name)
+                continue
+            await apply_migration(conn, version, name, sql, checksum)
+            new_versions.append(version)
+        return new_versions
+    finally:
+        await conn.close()
+
+
+async def status(dsn, path=MIGRATIONS_DIR):
+    conn = await asyncpg.connect(dsn)
+    try:
+        applied = await applied_migrations(conn)
+    finally:
+        await conn.close()
+    return [
+        (version, name, version in applied)
+        for version, name, _, _ in load_migrations(path)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='apply schema migrations')
+    parser.add_argument('--config', default='config.ini')
+    parser.add_argument('--list', action='store_true',
+                        help='only list migrations and whether they are applied')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    mode = config['MODE']['mode']
+    dsn = config[mode]['database_url']
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    if args.list:
+        for version, name, is_applied in asyncio.run(status(dsn)):
+            print('%04d_%s %s' % (version, name, 'applied' if is_applied else 'pending'))
+    else:
+        applied = asyncio.run(migrate(dsn))
+        logger.info('applied %d migrations', len(applied))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+-- no-transaction
+-- serves EntityPurchasesGetHandler, including its (ts, id) keyset order
+CREATE INDEX CONCURRENTLY IF NOT EXISTS purchase_buyr_id_ts_idx
+    ON purchase (buyr_id, ts, id);
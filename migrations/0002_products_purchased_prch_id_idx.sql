@@ -0,0 +1,4 @@
+-- no-transaction
+-- serves PurchaseGetHandler and the item rewrite in PurchaseUpdateHandler
+CREATE INDEX CONCURRENTLY IF NOT EXISTS products_purchased_prch_id_idx
+    ON products_purchased (prch_id);
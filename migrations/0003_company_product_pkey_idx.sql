@@ -0,0 +1,5 @@
+-- no-transaction
+-- built concurrently so 0004 can promote it to the primary key without
+-- locking company_product for the length of the build
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS company_product_pkey
+    ON company_product (comp_id, prod_id);
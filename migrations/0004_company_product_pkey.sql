@@ -0,0 +1,11 @@
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+        WHERE conrelid = 'company_product'::regclass AND contype = 'p'
+    ) THEN
+        ALTER TABLE company_product
+            ADD CONSTRAINT company_product_pkey
+            PRIMARY KEY USING INDEX company_product_pkey;
+    END IF;
+END $$;
@@ -0,0 +1,59 @@
+-- per buyer, per day totals of their purchases
+CREATE TABLE IF NOT EXISTS entity_daily_rollup(
+    entity_id INT NOT NULL,
+    day DATE NOT NULL,
+    purchase_count INT NOT NULL,
+    -- cents
+    price_total BIGINT NOT NULL,
+    -- grams
+    carbon_cost_total BIGINT NOT NULL,
+    PRIMARY KEY (entity_id, day),
+    CONSTRAINT fk_entity FOREIGN KEY(entity_id) REFERENCES entity(id)
+);
+
+-- adds (p_sign = 1) or removes (p_sign = -1) purchases from the rollups,
+-- writers call it with -1 before changing a purchase and 1 afterwards,
+-- in the same transaction. The purchase rows are locked so a concurrent
+-- update cannot change them in between. Rows a removal empties are deleted.
+CREATE OR REPLACE FUNCTION apply_purchase_rollups(p_prch_ids INT[], p_sign INT)
+RETURNS VOID LANGUAGE SQL AS $$
+    INSERT INTO entity_daily_rollup AS r
+        (entity_id, day, purchase_count, price_total, carbon_cost_total)
+    SELECT
+        buyr_id,
+        ts::date,
+        p_sign * count(*),
+        p_sign * sum(price),
+        p_sign * coalesce(sum(carbon_cost), 0)
+    FROM (
+        SELECT buyr_id, ts, price, carbon_cost FROM purchase
+        WHERE id = ANY(p_prch_ids) AND ts IS NOT NULL
+        FOR UPDATE
+    ) p
+    GROUP BY buyr_id, ts::date
+    -- a fixed order keeps concurrent writers from deadlocking on rollup rows
+    ORDER BY buyr_id, ts::date
+    ON CONFLICT (entity_id, day) DO UPDATE SET
+        purchase_count = r.purchase_count + excluded.purchase_count,
+        price_total = r.price_total + excluded.price_total,
+        carbon_cost_total = r.carbon_cost_total + excluded.carbon_cost_total;
+
+    -- a statement cannot see the rows its own ON CONFLICT updated, so the
+    -- emptied rows are deleted by a second one
+    DELETE FROM entity_daily_rollup r
+    USING (
+        SELECT DISTINCT buyr_id, ts::date AS day FROM purchase
+        WHERE id = ANY(p_prch_ids) AND ts IS NOT NULL
+    ) p
+    WHERE p_sign < 0
+        AND r.entity_id = p.buyr_id AND r.day = p.day
+        AND r.purchase_count = 0;
+$$;
+
+INSERT INTO entity_daily_rollup
+    (entity_id, day, purchase_count, price_total, carbon_cost_total)
+SELECT buyr_id, ts::date, count(*), sum(price), coalesce(sum(carbon_cost), 0)
+FROM purchase
+WHERE ts IS NOT NULL
+GROUP BY buyr_id, ts::date
+ON CONFLICT (entity_id, day) DO NOTHING;
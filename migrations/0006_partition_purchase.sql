@@ -0,0 +1,134 @@
+-- partitions purchase by month of ts, so queries over a time range only
+-- read the months they cover and old months can be detached whole.
+-- products_purchased gets prch_ts, a copy of its purchase's ts, and is
+-- partitioned on the same monthly bounds, so a month of items is detached
+-- with its month of purchases. Writers must now set prch_ts.
+-- apply_purchase_rollups takes each purchase's ts along with its id, so
+-- it reads only the partitions of those purchases.
+-- Rows are copied into the new tables, which locks them for the duration.
+
+-- creates the partitions of both tables for the month containing p_month
+CREATE OR REPLACE FUNCTION create_purchase_partitions(p_month DATE)
+RETURNS VOID LANGUAGE plpgsql AS $$
+DECLARE
+    start_ts TIMESTAMP := date_trunc('month', p_month);
+    end_ts TIMESTAMP := date_trunc('month', p_month) + interval '1 month';
+    suffix TEXT := to_char(p_month, 'YYYY_MM');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF purchase FOR VALUES FROM (%L) TO (%L)',
+        'purchase_p' || suffix, start_ts, end_ts);
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF products_purchased FOR VALUES FROM (%L) TO (%L)',
+        'products_purchased_p' || suffix, start_ts, end_ts);
+END $$;
+
+DO $$
+DECLARE
+    month DATE;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'purchase'::regclass) = 'p' THEN
+        RETURN;
+    END IF;
+
+    UPDATE purchase SET ts = current_timestamp WHERE ts IS NULL;
+
+    -- the new tables take over the old names, constraint and index names
+    ALTER TABLE products_purchased DROP CONSTRAINT fk_prch;
+    ALTER TABLE purchase RENAME TO purchase_old;
+    ALTER TABLE purchase_old RENAME CONSTRAINT purchase_pkey TO purchase_old_pkey;
+    ALTER INDEX purchase_buyr_id_ts_idx RENAME TO purchase_old_buyr_id_ts_idx;
+    ALTER TABLE products_purchased RENAME TO products_purchased_old;
+    ALTER INDEX products_purchased_prch_id_idx RENAME TO products_purchased_old_prch_id_idx;
+
+    CREATE TABLE purchase(
+        id INT NOT NULL DEFAULT nextval('purchase_id_seq'),
+        buyr_id INT NOT NULL,
+        selr_id INT NOT NULL,
+        -- cents
+        price INT NOT NULL,
+        carbon_cost INT,
+        ts TIMESTAMP NOT NULL DEFAULT current_timestamp,
+        -- a unique constraint on a partitioned table must include its key
+        CONSTRAINT purchase_pkey PRIMARY KEY (id, ts),
+        CONSTRAINT fk_buyr FOREIGN KEY(buyr_id) REFERENCES entity(id),
+        CONSTRAINT fk_selr FOREIGN KEY(selr_id) REFERENCES entity(id)
+    ) PARTITION BY RANGE (ts);
+    ALTER SEQUENCE purchase_id_seq OWNED BY purchase.id;
+    CREATE INDEX purchase_buyr_id_ts_idx ON purchase (buyr_id, ts, id);
+
+    CREATE TABLE products_purchased(
+        prch_id INT NOT NULL,
+        comp_id INT,
+        prod_id INT,
+        prch_ts TIMESTAMP NOT NULL,
+        CONSTRAINT fk_prch FOREIGN KEY(prch_id, prch_ts) REFERENCES purchase(id, ts),
+        CONSTRAINT fk_comp FOREIGN KEY(comp_id) REFERENCES entity(id),
+        CONSTRAINT fk_prod FOREIGN KEY(prod_id) REFERENCES product(id)
+    ) PARTITION BY RANGE (prch_ts);
+    CREATE INDEX products_purchased_prch_id_idx ON products_purchased (prch_id);
+
+    -- every month with purchases, and the next three, so inserts in the
+    -- meantime land in a monthly partition rather than the default one
+    FOR month IN
+        SELECT generate_series(
+            date_trunc('month', coalesce(min(ts), current_timestamp)),
+            date_trunc('month', greatest(max(ts), current_timestamp)) + interval '3 months',
+            interval '1 month')::date
+        FROM purchase_old
+    LOOP
+        PERFORM create_purchase_partitions(month);
+    END LOOP;
+    CREATE TABLE purchase_default PARTITION OF purchase DEFAULT;
+    CREATE TABLE products_purchased_default PARTITION OF products_purchased DEFAULT;
+
+    INSERT INTO purchase (id, buyr_id, selr_id, price, carbon_cost, ts)
+    SELECT id, buyr_id, selr_id, price, carbon_cost, ts FROM purchase_old;
+    INSERT INTO products_purchased (prch_id, comp_id, prod_id, prch_ts)
+    SELECT pp.prch_id, pp.comp_id, pp.prod_id, p.ts
+    FROM products_purchased_old pp JOIN purchase_old p ON p.id = pp.prch_id;
+
+    DROP TABLE products_purchased_old;
+    DROP TABLE purchase_old;
+END $$;
+
+
+DROP FUNCTION IF EXISTS apply_purchase_rollups(INT[], INT);
+
+-- p_prch_tss holds the ts of each purchase in p_prch_ids. Purchases are
+-- joined to the (id, ts) pairs, so each is read from its own partition
+CREATE OR REPLACE FUNCTION apply_purchase_rollups(
+    p_prch_ids INT[], p_prch_tss TIMESTAMP[], p_sign INT
+) RETURNS VOID LANGUAGE SQL AS $$
+    INSERT INTO entity_daily_rollup AS r
+        (entity_id, day, purchase_count, price_total, carbon_cost_total)
+    SELECT
+        buyr_id,
+        ts::date,
+        p_sign * count(*),
+        p_sign * sum(price),
+        p_sign * coalesce(sum(carbon_cost), 0)
+    FROM (
+        SELECT p.buyr_id, p.ts, p.price, p.carbon_cost
+        FROM unnest(p_prch_ids, p_prch_tss) k(id, ts)
+        JOIN purchase p ON p.id = k.id AND p.ts = k.ts
+        FOR UPDATE OF p
+    ) p
+    GROUP BY buyr_id, ts::date
+    -- a fixed order keeps concurrent writers from deadlocking on rollup rows
+    ORDER BY buyr_id, ts::date
+    ON CONFLICT (entity_id, day) DO UPDATE SET
+        purchase_count = r.purchase_count + excluded.purchase_count,
+        price_total = r.price_total + excluded.price_total,
+        carbon_cost_total = r.carbon_cost_total + excluded.carbon_cost_total;
+
+    DELETE FROM entity_daily_rollup r
+    USING (
+        SELECT DISTINCT p.buyr_id, p.ts::date AS day
+        FROM unnest(p_prch_ids, p_prch_tss) k(id, ts)
+        JOIN purchase p ON p.id = k.id AND p.ts = k.ts
+    ) p
+    WHERE p_sign < 0
+        AND r.entity_id = p.buyr_id AND r.day = p.day
+        AND r.purchase_count = 0;
+$$;
@@ -0,0 +1,246 @@
+"""
+Manage the monthly partitions of purchase and products_purchased
+
+$ python partitions.py list
+$ python partitions.py create --ahead 3
+$ python partitions.py detach --before 2021-01 --archive archive
+$ python partitions.py detach --before 2021-01 --drop
+
+Purchases are partitioned on ts and their items on prch_ts, a month per
+partition, named purchase_pYYYY_MM and products_purchased_pYYYY_MM.
+Rows outside every monthly partition land in purchase_default and
+products_purchased_default, so run create (e.g. monthly from cron) to
+keep partitions ahead of the clock.
+
+detach removes every month before --before from both tables, so queries
+no longer see it. The detached tables are kept as they are, moved to the
+--archive schema, or dropped with --drop, which is how old purchases are
+deleted without a bulk DELETE. entity_daily_rollup is left alone, so the
+carbon totals of detached months are kept.
+"""
+import argparse
+import asyncio
+import configparser
+import datetime
+import logging
+import re
+import asyncpg
+
+
+logger = logging.getLogger('partitions')
+
+MONTH_PARTITION = re.compile(r'^purchase_p(\d{4})_(\d{2})$')
+
+
+def add_months(month, n):
+    """
+    The first day of the month n months after month
+    """
+    index = month.year * 12 + month.month - 1 + n
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def parse_month(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('months are written YYYY-MM')
+
+
+async def month_partitions(conn):
+    """
+    The first day of each month that has a purchase partition, in order
+    """
+    rows = await conn.fetch('''
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'purchase'::regclass
+    ''')
+    months = []
+    for row in rows:
+        match = MONTH_PARTITION.match(row['relname'])
+        if match:
+            months.append(datetime.date(int(match[1]), int(match[2]), 1))
+    return sorted(months)
+
+
+async def create_month(conn, month):
+    """
+    Create the partitions of both tables for month
+    Rows of that month already in the default partitions would violate
+    the new partition's bounds, so they are moved into it in the same
+    transaction, which may be nested in the caller's
+    """
+    start = datetime.datetime.combine(month, datetime.time())
+    end = datetime.datetime.combine(add_months(month, 1), datetime.time())
+    async with conn.transaction():
+        stray = await conn.fetchval(
+            'SELECT count(*) FROM purchase_default WHERE ts >= $1 AND ts < $2',
+            start, end)
+        if stray:
+            logger.warning(
+                'moving %d purchases of %s out of the default partition',
+                stray, month.strftime('%Y-%m'))
+            await conn.execute('''
+                CREATE TEMP TABLE moved_purchase ON COMMIT DROP AS
+                SELECT * FROM purchase_default WHERE ts >= $1 AND ts < $2
+            ''', start, end)
+            await conn.execute('''
+                CREATE TEMP TABLE moved_products_purchased ON COMMIT DROP AS
+                SELECT * FROM products_purchased_default
+                WHERE prch_ts >= $1 AND prch_ts < $2
+            ''', start, end)
+            await conn.execute('''
+                DELETE FROM products_purchased_default
+                WHERE prch_ts >= $1 AND prch_ts < $2
+            ''', start, end)
+            await conn.execute(
+                'DELETE FROM purchase_default WHERE ts >= $1 AND ts < $2', start, end)
+        await conn.execute('SELECT create_purchase_partitions($1)', month)
+        if stray:
+            await conn.execute('INSERT INTO purchase SELECT * FROM moved_purchase')
+            await conn.execute(
+                'INSERT INTO products_purchased SELECT * FROM moved_products_purchased')
+            # dropped now rather than on commit, in case the caller's
+            # transaction creates another month
+            await conn.execute('DROP TABLE moved_purchase, moved_products_purchased')
+
+
+async def create(dsn, ahead=3, today=None):
+    """
+    Make sure the current month and the next ahead months have partitions,
+    returns the months that were created
+    """
+    this_month = (today or datetime.date.today()).replace(day=1)
+    conn = await asyncpg.connect(dsn)
+    try:
+        existing = set(await month_partitions(conn))
+        created = []
+        for n in range(ahead + 1):
+            month = add_months(this_month, n)
+            if month not in existing:
+                await create_month(conn, month)
+                logger.info('created partitions for %s', month.strftime('%Y-%m'))
+                created.append(month)
+        return created
+    finally:
+        await conn.close()
+
+
+async def detach_month(conn, month, archive=None, drop=False):
+    """
+    Detach the partitions of month from both tables, items first
+    The detached items keep a foreign key to purchase, which would stop
+    the purchases being detached, so it is dropped in between. Detaching
+    takes an exclusive lock on the parent tables until the transaction
+    commits, which is short as no rows are moved
+    """
+    suffix = month.strftime('%Y_%m')
+    purchase_partition = 'purchase_p' + suffix
+    items_partition = 'products_purchased_p' + suffix
+    async with conn.transaction():
+        await conn.execute(
+            'ALTER TABLE products_purchased DETACH PARTITION "%s"' % items_partition)
+        constraints = await conn.fetch('''
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = $1::regclass AND confrelid = 'purchase'::regclass
+        ''', items_partition)
+        for row in constraints:
+            await conn.execute('ALTER TABLE "%s" DROP CONSTRAINT "%s"' % (
+                items_partition, row['conname']))
+        await conn.execute(
+            'ALTER TABLE purchase DETACH PARTITION "%s"' % purchase_partition)
+
+        for table in (items_partition, purchase_partition):
+            if drop:
+                await conn.execute('DROP TABLE "%s"' % table)
+            elif archive is not None:
+                await conn.execute('CREATE SCHEMA IF NOT EXISTS "%s"' % archive)
+                await conn.execute('ALTER TABLE "%s" SET SCHEMA "%s"' % (table, archive))
+
+
+async def detach(dsn, before, archive=None, drop=False):
+    """
+    Detach every monthly partition before the month of before, oldest
+    first, returns the months that were detached
+    """
+    conn = await asyncpg.connect(dsn)
+    try:
+        months = [
+            month for month in await month_partitions(conn)
+            if month < before.replace(day=1)
+        ]
+        for month in months:
+            await detach_month(conn, month, archive, drop)
+            logger.info('detached partitions for %s', month.strftime('%Y-%m'))
+        return months
+    finally:
+        await conn.close()
+
+
+async def status(dsn):
+    """
+    (table, partition, bounds, estimated rows) of every partition of
+    purchase and products_purchased
+    """
+    conn = await asyncpg.connect(dsn)
+    try:
+        rows = await conn.fetch('''
+            SELECT p.relname AS parent, c.relname AS partition,
+                pg_get_expr(c.relpartbound, c.oid) AS bounds, c.reltuples AS rows
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname IN ('purchase', 'products_purchased')
+            ORDER BY p.relname, c.relname
+        ''')
+        for table in ('purchase_default', 'products_purchased_default'):
+            if await conn.fetchval('SELECT EXISTS (SELECT 1 FROM %s)' % table):
+                logger.warning(
+                    '%s has rows, run create so their months get partitions', table)
+    finally:
+        await conn.close()
+    return [
+        (row['parent'], row['partition'], row['bounds'], max(int(row['rows']), 0))
+        for row in rows
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='manage the monthly partitions of purchase and products_purchased')
+    parser.add_argument('--config', default='config.ini')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='list partitions with their bounds and row estimates')
+    create_parser = commands.add_parser(
+        'create', help='create partitions up to --ahead months from now')
+    create_parser.add_argument('--ahead', type=int, default=3)
+    detach_parser = commands.add_parser(
+        'detach', help='detach the partitions of every month before --before')
+    detach_parser.add_argument('--before', type=parse_month, required=True,
+                               help='YYYY-MM, the first month to keep')
+    fate = detach_parser.add_mutually_exclusive_group()
+    fate.add_argument('--archive', metavar='SCHEMA',
+                      help='move the detached tables to this schema')
+    fate.add_argument('--drop', action='store_true',
+                      help='drop the detached tables')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    mode = config['MODE']['mode']
+    dsn = config[mode]['database_url']
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    if args.command == 'list':
+        for parent, partition, bounds, rows in asyncio.run(status(dsn)):
+            print('%-20s %-32s %-70s %d' % (parent, partition, bounds, rows))
+    elif args.command == 'create':
+        created = asyncio.run(create(dsn, args.ahead))
+        logger.info('created partitions for %d months', len(created))
+    else:
+        detached = asyncio.run(detach(dsn, args.before, args.archive, args.drop))
+        logger.info('detached partitions for %d months', len(detached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+import profiling
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """
+    Async queue pool that also records how long checkouts wait for a
+    connection, including the time to open a new one
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - start
+            self.checkouts += 1
+            self.checkout_wait_total += wait
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+            profile = profiling.current.get()
+            if profile is not None:
+                profile.pool_wait += wait
+
+    def stats(self):
+        return dict(
+            size=self.size(),
+            checked_out=self.checkedout(),
+            checked_in=self.checkedin(),
+            overflow=max(self.overflow(), 0),
+            checkouts=self.checkouts,
+            checkout_timeouts=self.checkout_timeouts,
+            checkout_wait_total=self.checkout_wait_total,
+            checkout_wait_max=self.checkout_wait_max
+        )
+
+
+def pool_options(section, prefix=''):
+    """
+    create_async_engine keyword arguments from a config.ini mode section
+    prefix='read_' sizes the read replica's pool from read_pool_size and
+    read_pool_max_overflow, which default to the primary's
+    """
+    return dict(
+        poolclass=TimedQueuePool,
+        pool_size=section.getint(
+            prefix + 'pool_size', fallback=section.getint('pool_size', fallback=5)),
+        max_overflow=section.getint(
+            prefix + 'pool_max_overflow', fallback=section.getint('pool_max_overflow', fallback=10)),
+        pool_timeout=section.getfloat('pool_timeout', fallback=30),
+        pool_recycle=section.getint('pool_recycle', fallback=-1),
+        pool_pre_ping=section.getboolean('pool_pre_ping', fallback=False),
+        connect_args=dict(
+            prepared_statement_cache_size=section.getint(
+                'statement_cache_size', fallback=100))
+    )
+
+
+async def warm_up(async_engine, n):
+    """
+    Open n connections at once and return them to the pool, so the first
+    requests do not pay for connecting
+    """
+    conns = await asyncio.gather(*[async_engine.connect() for _ in range(n)])
+    for conn in conns:
+        await conn.close()
@@ -0,0 +1,64 @@
+"""
+Per-request profiling: where a request spent its time, reported back in a
+Server-Timing header
+The profile of the request being handled is held in a context variable,
+which SQLAlchemy's greenlets and the pool see, so the engine events can
+charge each statement and checkout to the request that made it
+"""
+import contextvars
+import re
+import time
+
+
+current = contextvars.ContextVar('request_profile', default=None)
+
+# how many statements are kept per request for the debug Server-Timing entries
+MAX_STATEMENTS = 20
+MAX_DESCRIPTION = 200
+
+
+class RequestProfile:
+    def __init__(self, keep_statements=False):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+        self.serialize_time = 0.0
+        self.keep_statements = keep_statements
+        self.statements = []
+
+    def record_query(self, statement, duration):
+        self.queries += 1
+        self.db_time += duration
+        if self.keep_statements and len(self.statements) < MAX_STATEMENTS:
+            self.statements.append((statement, duration))
+
+    def server_timing(self):
+        """
+        The value of the Server-Timing header, durations are in milliseconds
+        """
+        entries = [
+            'db;dur=%.2f;desc="%d queries"' % (self.db_time * 1000, self.queries),
+            'pool;dur=%.2f' % (self.pool_wait * 1000),
+            'serialize;dur=%.2f' % (self.serialize_time * 1000),
+            'total;dur=%.2f' % ((time.perf_counter() - self.start) * 1000)
+        ]
+        for i, (statement, duration) in enumerate(self.statements):
+            entries.append('q%d;dur=%.2f;desc="%s"' % (
+                i, duration * 1000, describe(statement)))
+        return ', '.join(entries)
+
+
+def describe(statement):
+    """
+    Statement text that is safe in a quoted header value
+    """
+    text = re.sub(r'\s+', ' ', statement).strip()
+    text = re.sub(r'["\\]|[^\x20-\x7e]', '', text)
+    return text[:MAX_DESCRIPTION]
+
+
+def start(keep_statements=False):
+    profile = RequestProfile(keep_statements)
+    current.set(profile)
+    return profile
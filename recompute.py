@@ -0,0 +1,267 @@
+"""
+Recompute the stored carbon cost of purchases in bulk, e.g. after the
+carbon costs in product, company_product or entity have changed
+
+$ python recompute.py --dry-run
+$ python recompute.py --since 2021-01 --until 2021-12 --deltas deltas.csv
+
+Costs follow the same precedence as /purchase/recompute (select_carbon_costs
+in handlers/statements.py): an item costs its company_product carbon cost,
+then its product carbon cost, and purchases with no costed items cost the
+seller's g / dollar times the price in cents, divided by 100.
+
+The cost tables are read once, then purchases are recomputed a month at a
+time, the same months as the partitions of purchase. A month's purchases
+and items are copied out into NumPy arrays and costed with vectorized
+lookups. The purchases whose cost changed are copied into a temporary
+table and written with one UPDATE ... FROM, and their buyers' rollups are
+adjusted, in a transaction per month. A purchase whose cost was changed
+by someone else since it was read is left as it is.
+
+--dry-run only reports what would change. --deltas writes the id, old and
+new carbon cost of every changed purchase to a CSV file.
+"""
+import argparse
+import asyncio
+import configparser
+import csv
+import datetime
+import io
+import logging
+import asyncpg
+import numpy as np
+import partitions
+
+
+logger = logging.getLogger('recompute')
+
+# comp_id and prod_id are packed into one key, both are INT so fit in 32 bits
+KEY_SHIFT = 32
+# purchase ts are copied out as microseconds since EPOCH, ts has no time zone
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+async def copy_array(conn, query, *args, columns):
+    """
+    The rows of query as an int64 array with one column per selected
+    column. NULLs must be replaced in the query, e.g. with coalesce
+    """
+    buffer = io.BytesIO()
+    await conn.copy_from_query(query, *args, output=buffer, format='csv')
+    if not buffer.tell():
+        return np.empty((0, columns), dtype=np.int64)
+    buffer.seek(0)
+    return np.loadtxt(buffer, delimiter=',', dtype=np.int64, ndmin=2)
+
+
+class Lookup:
+    """
+    Maps int64 keys to values with a sorted array of keys, so a whole
+    array of keys is looked up with one searchsorted
+    """
+
+    def __init__(self, keys, values):
+        order = np.argsort(keys)
+        self.keys = keys[order]
+        self.values = values[order]
+
+    def get(self, keys):
+        """
+        The value of each key, and a mask of the keys that were found
+        Missing keys get 0
+        """
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[positions] == keys
+        return np.where(found, self.values[positions], 0), found
+
+
+def company_product_keys(comp_ids, prod_ids):
+    return (comp_ids << KEY_SHIFT) | prod_ids
+
+
+async def load_cost_tables(conn):
+    """
+    Lookups of the product, company_product and entity carbon costs
+    """
+    product = await copy_array(
+        conn, 'SELECT id, carbon_cost FROM product', columns=2)
+    company_product = await copy_array(
+        conn, 'SELECT comp_id, prod_id, carbon_cost FROM company_product', columns=3)
+    entity = await copy_array(
+        conn, 'SELECT id, carbon_cost FROM entity', columns=2)
+    return dict(
+        product=Lookup(product[:, 0], product[:, 1]),
+        company_product=Lookup(
+            company_product_keys(company_product[:, 0], company_product[:, 1]),
+            company_product[:, 2]),
+        entity=Lookup(entity[:, 0], entity[:, 1])
+    )
+
+
+def compute_costs(tables, purchases, items):
+    """
+    The carbon cost of each purchase
+    purchases has the columns id, selr_id and price, ordered by id, and
+    items the columns prch_id, comp_id and prod_id, with -1 for NULL
+    """
+    prch_ids, selr_ids, prices = purchases[:, 0], purchases[:, 1], purchases[:, 2]
+    item_prch_ids, comp_ids, prod_ids = items[:, 0], items[:, 1], items[:, 2]
+
+    company_cost, company_found = tables['company_product'].get(
+        company_product_keys(comp_ids, prod_ids))
+    # NULL ids are -1, which no row has
+    company_found &= (comp_ids >= 0) & (prod_ids >= 0)
+    product_cost, product_found = tables['product'].get(prod_ids)
+    item_cost = np.where(company_found, company_cost, product_cost)
+    costed = company_found | product_found
+
+    # every item's purchase is in purchases, as the item's prch_ts is its
+    # purchase's ts and both are read from the same snapshot
+    index = np.searchsorted(prch_ids, item_prch_ids[costed])
+    item_total = np.zeros(len(prch_ids), dtype=np.int64)
+    np.add.at(item_total, index, item_cost[costed])
+    costed_items = np.bincount(index, minlength=len(prch_ids))
+
+    seller_cost, _ = tables['entity'].get(selr_ids)
+    fallback = seller_cost * prices
+    # SQL integer division truncates toward zero, // rounds down
+    fallback = np.sign(fallback) * (np.abs(fallback) // 100)
+    return np.where(costed_items > 0, item_total, fallback)
+
+
+async def recompute_month(conn, tables, month, dry_run=False, deltas=None):
+    """
+    Recompute the purchases of month and write the changed costs, unless
+    dry_run. Returns the number of purchases, changed and updated, and
+    the total change in grams
+    """
+    start = datetime.datetime.combine(month, datetime.time())
+    end = datetime.datetime.combine(partitions.add_months(month, 1), datetime.time())
+    # both reads see the same snapshot, so every item's purchase is read
+    async with conn.transaction(isolation='repeatable_read', readonly=True):
+        purchases = await copy_array(conn, '''
+            SELECT id, selr_id, price, coalesce(carbon_cost, 0), (carbon_cost IS NULL)::int,
+                (extract(epoch FROM ts) * 1000000)::bigint
+            FROM purchase WHERE ts >= $1 AND ts < $2 ORDER BY id
+        ''', start, end, columns=6)
+        items = await copy_array(conn, '''
+            SELECT prch_id, coalesce(comp_id, -1), coalesce(prod_id, -1)
+            FROM products_purchased WHERE prch_ts >= $1 AND prch_ts < $2
+        ''', start, end, columns=3)
+
+    new_costs = compute_costs(tables, purchases, items)
+    old_costs, old_null = purchases[:, 3], purchases[:, 4].astype(bool)
+    changed = old_null | (new_costs != old_costs)
+    ids = purchases[changed, 0]
+    # the rollups look purchases up by id and ts, so only this month's
+    # partition is read
+    tss = [EPOCH + datetime.timedelta(microseconds=us) for us in purchases[changed, 5].tolist()]
+    old = [None if null else cost for cost, null in zip(
+        old_costs[changed].tolist(), old_null[changed].tolist())]
+    new = new_costs[changed].tolist()
+    result = dict(
+        purchases=len(purchases),
+        changed=len(ids),
+        updated=0,
+        delta=int((new_costs[changed] - old_costs[changed]).sum())
+    )
+    if deltas is not None:
+        deltas.writerows(zip(ids.tolist(), old, new))
+    if dry_run or not len(ids):
+        return result
+
+    async with conn.transaction():
+        await conn.execute('''
+            CREATE TEMP TABLE recompute_cost(
+                id INT PRIMARY KEY, old_carbon_cost INT, carbon_cost INT
+            ) ON COMMIT DROP
+        ''')
+        await conn.copy_records_to_table(
+            'recompute_cost', records=zip(ids.tolist(), old, new))
+        await conn.execute('SELECT apply_purchase_rollups($1, $2, -1)', ids.tolist(), tss)
+        status = await conn.execute('''
+            UPDATE purchase p SET carbon_cost = r.carbon_cost
+            FROM recompute_cost r
+            WHERE p.id = r.id AND p.ts >= $1 AND p.ts < $2
+                AND p.carbon_cost IS NOT DISTINCT FROM r.old_carbon_cost
+        ''', start, end)
+        await conn.execute('SELECT apply_purchase_rollups($1, $2, 1)', ids.tolist(), tss)
+    result['updated'] = int(status.split()[-1])
+    return result
+
+
+async def purchase_months(conn):
+    """
+    Every month with a partition, and those with purchases in the default
+    partition
+    """
+    months = set(await partitions.month_partitions(conn))
+    rows = await conn.fetch(
+        "SELECT DISTINCT date_trunc('month', ts)::date AS month FROM purchase_default")
+    months.update(row['month'] for row in rows)
+    return sorted(months)
+
+
+async def recompute(dsn, since=None, until=None, dry_run=False, deltas=None):
+    """
+    Recompute every month from since to until, both included and both
+    optional, returns the totals over all months
+    """
+    conn = await asyncpg.connect(dsn)
+    totals = dict(purchases=0, changed=0, updated=0, delta=0)
+    try:
+        tables = await load_cost_tables(conn)
+        for month in await purchase_months(conn):
+            if (since is not None and month < since) or (until is not None and month > until):
+                continue
+            result = await recompute_month(conn, tables, month, dry_run, deltas)
+            logger.info(
+                '%s: %d purchases, %d changed, %d updated, %+d g',
+                month.strftime('%Y-%m'), result['purchases'], result['changed'],
+                result['updated'], result['delta'])
+            for key, value in result.items():
+                totals[key] += value
+    finally:
+        await conn.close()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='recompute the carbon cost of stored purchases')
+    parser.add_argument('--since', type=partitions.parse_month,
+                        help='YYYY-MM, the first month to recompute')
+    parser.add_argument('--until', type=partitions.parse_month,
+                        help='YYYY-MM, the last month to recompute')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report the changes without writing them')
+    parser.add_argument('--deltas', help='write the changed costs to this CSV file')
+    parser.add_argument('--config', default='config.ini')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    mode = config['MODE']['mode']
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    deltas_file = open(args.deltas, 'w', newline='') if args.deltas else None
+    try:
+        deltas = None
+        if deltas_file is not None:
+            deltas = csv.writer(deltas_file)
+            deltas.writerow(['id', 'old_carbon_cost', 'carbon_cost'])
+        totals = asyncio.run(recompute(
+            config[mode]['database_url'], args.since, args.until, args.dry_run, deltas))
+    finally:
+        if deltas_file is not None:
+            deltas_file.close()
+    logger.info(
+        '%s: %d purchases, %d changed, %d updated, %+d g',
+        'dry run' if args.dry_run else 'done', totals['purchases'], totals['changed'],
+        totals['updated'], totals['delta'])
+
+
+if __name__ == '__main__':
+    main()
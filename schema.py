@@ -0,0 +1,107 @@
+"""
+Static definitions of the tables in test/integration/fixtures/initialise_postgresdb.sql
+and migrations/, so the service does not have to reflect them on startup
+Keep these in step with the SQL, check_schema reports any drift
+"""
+import logging
+import sqlalchemy
+from sqlalchemy import Column, ForeignKey, ForeignKeyConstraint, Integer, BigInteger, String, DateTime, Date
+
+
+logger = logging.getLogger('tornado.application')
+
+metadata = sqlalchemy.MetaData()
+
+entity = sqlalchemy.Table(
+    'entity', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('display_name', String(255), nullable=False),
+    # grams
+    Column('carbon_offset', Integer, nullable=False),
+    # g / dollar
+    Column('carbon_cost', Integer, nullable=False)
+)
+
+product = sqlalchemy.Table(
+    'product', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('item_name', String(255), nullable=False),
+    # g / item
+    Column('carbon_cost', Integer, nullable=False)
+)
+
+company_product = sqlalchemy.Table(
+    'company_product', metadata,
+    Column('comp_id', Integer, ForeignKey('entity.id'), primary_key=True),
+    Column('prod_id', Integer, ForeignKey('product.id'), primary_key=True),
+    Column('carbon_cost', Integer, nullable=False)
+)
+
+purchase = sqlalchemy.Table(
+    'purchase', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('buyr_id', Integer, ForeignKey('entity.id'), nullable=False),
+    Column('selr_id', Integer, ForeignKey('entity.id'), nullable=False),
+    # cents
+    Column('price', Integer, nullable=False),
+    Column('carbon_cost', Integer),
+    # the partition key, so it is part of the primary key
+    Column('ts', DateTime, primary_key=True,
+           server_default=sqlalchemy.func.current_timestamp())
+)
+
+products_purchased = sqlalchemy.Table(
+    'products_purchased', metadata,
+    Column('prch_id', Integer, nullable=False),
+    Column('comp_id', Integer, ForeignKey('entity.id')),
+    Column('prod_id', Integer, ForeignKey('product.id')),
+    # the ts of the purchase, the partition key
+    Column('prch_ts', DateTime, nullable=False),
+    ForeignKeyConstraint(['prch_id', 'prch_ts'], ['purchase.id', 'purchase.ts'])
+)
+
+entity_daily_rollup = sqlalchemy.Table(
+    'entity_daily_rollup', metadata,
+    Column('entity_id', Integer, ForeignKey('entity.id'), primary_key=True),
+    Column('day', Date, primary_key=True),
+    Column('purchase_count', Integer, nullable=False),
+    # cents
+    Column('price_total', BigInteger, nullable=False),
+    # grams
+    Column('carbon_cost_total', BigInteger, nullable=False)
+)
+
+
+async def check_schema(async_engine, metadata=metadata):
+    """
+    Compare the static tables against the live database
+    Returns a list of problems, which are also logged, or None if the
+    database could not be reached. Columns that only exist in the
+    database are ignored, the handlers never select them
+    """
+    def reflect(sync_conn):
+        inspector = sqlalchemy.inspect(sync_conn)
+        return {
+            name: set(column['name'] for column in inspector.get_columns(name))
+            for name in metadata.tables
+            if inspector.has_table(name)
+        }
+
+    try:
+        async with async_engine.connect() as conn:
+            live = await conn.run_sync(reflect)
+    except (OSError, sqlalchemy.exc.SQLAlchemyError) as e:
+        logger.warning('schema check skipped, database unreachable: %s', e)
+        return None
+
+    problems = []
+    for name, table in metadata.tables.items():
+        if name not in live:
+            problems.append('table %s is missing' % name)
+            continue
+        for column in table.columns:
+            if column.name not in live[name]:
+                problems.append('column %s.%s is missing' % (name, column.name))
+    for problem in problems:
+        logger.warning('schema check: %s', problem)
+    return problems
@@ -3,6 +3,9 @@ DROP TABLE IF EXISTS product CASCADE;
 DROP TABLE IF EXISTS company_product CASCADE;
 DROP TABLE IF EXISTS purchase CASCADE;
 DROP TABLE IF EXISTS products_purchased CASCADE;
+-- dropping the tables also drops everything the migrations added to them
+DROP TABLE IF EXISTS schema_migrations CASCADE;
+DROP TABLE IF EXISTS entity_daily_rollup CASCADE;
 
 CREATE TABLE IF NOT EXISTS entity(
     id SERIAL PRIMARY KEY,
@@ -1,5 +1,21 @@
+import asyncio
+import datetime
+import os
+import signal
+import subprocess
+import sys
+import tempfile
 from types import SimpleNamespace
+import asyncpg
 import main
+import bulk_load
+import migrate
+import partitions
+import recompute
+import schema
+from handlers.base import get_serializer
+from handlers.coalesce import PurchaseCoalescer
+import tornado.tcpclient
 import tornado.testing
 import tornado.ioloop
 import configparser
@@ -25,10 +41,10 @@ class TestApp(tornado.testing.AsyncHTTPTestCase):
         engine = sqlalchemy.create_engine(
             self.config[mode]['database_url'], echo=False, future=True)
         with open('test/integration/fixtures/initialise_postgresdb.sql') as f:
-            stmt = sqlalchemy.text(''.join(f.readlines()))
+            self.fixture = sqlalchemy.text(''.join(f.readlines()))
 
         with engine.begin() as conn:
-            conn.execute(stmt)
+            conn.execute(self.fixture)
 
         metadata = sqlalchemy.MetaData()
         entity = sqlalchemy.Table(
@@ -43,11 +59,25 @@ class TestApp(tornado.testing.AsyncHTTPTestCase):
             'products_purchased', metadata, autoload=True, autoload_with=engine)
         self.db = SimpleNamespace(engine=engine, metadata=metadata)
 
+    def setUp(self) -> None:
+        """
+        reset the fixture data, so each test starts from it whatever
+        the tests before it added or changed
+        """
+        with self.db.engine.begin() as conn:
+            conn.execute(self.fixture)
+        super().setUp()
+
     def tearDown(self) -> None:
         """
-        close the async postgres connection
+        close the async postgres connections
         """
-        self.io_loop.run_sync(self.app_db.async_engine.dispose)
+        if self.app_db.purchase_feed is not None:
+            self.io_loop.run_sync(self.app_db.purchase_feed.close)
+        if self.app_db.product_cache_invalidator is not None:
+            self.io_loop.run_sync(self.app_db.product_cache_invalidator.close)
+        for engine in main.engines(self.app_db):
+            self.io_loop.run_sync(engine.dispose)
         return super().tearDown()
 
     def get_app(self):
@@ -63,6 +93,216 @@ class TestApp(tornado.testing.AsyncHTTPTestCase):
         self.assertEqual(response.code, 200)
         self.assertEqual(response.body, b'pong!')
 
+    def test_migrations(self):
+        """
+        test that the migrations run at startup added the indexes,
+        and that running them again is a no-op
+        """
+        stmt = sqlalchemy.text('''
+            SELECT indexname FROM pg_indexes
+            WHERE tablename IN ('purchase', 'products_purchased', 'company_product')
+        ''')
+        with self.db.engine.begin() as conn:
+            indexes = set(row.indexname for row in conn.execute(stmt))
+        self.assertTrue({
+            'purchase_buyr_id_ts_idx',
+            'products_purchased_prch_id_idx',
+            'company_product_pkey'
+        } <= indexes)
+
+        applied = self.io_loop.run_sync(
+            lambda: migrate.migrate(self.config['TEST']['database_url']))
+        self.assertEqual(applied, [])
+
+    def test_migration_failed_index(self):
+        """
+        test that a unique index that cannot be built over duplicate rows
+        is dropped, rather than left invalid, and not recorded as applied
+        """
+        with self.db.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(
+                'CREATE TABLE migrate_test AS SELECT 1 AS x FROM generate_series(1, 2)'))
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                with open(os.path.join(directory, '9999_migrate_test_idx.sql'), 'w') as f:
+                    f.write('-- no-transaction\n'
+                            'CREATE UNIQUE INDEX CONCURRENTLY migrate_test_idx ON migrate_test (x);\n')
+                with self.assertRaises(asyncpg.UniqueViolationError):
+                    self.io_loop.run_sync(lambda: migrate.migrate(
+                        self.config['TEST']['database_url'], directory))
+            with self.db.engine.begin() as conn:
+                counts = conn.execute(sqlalchemy.text('''
+                    SELECT
+                        (SELECT count(*) FROM pg_class WHERE relname = 'migrate_test_idx'),
+                        (SELECT count(*) FROM schema_migrations WHERE version = 9999)
+                ''')).one()
+            self.assertEqual(tuple(counts), (0, 0))
+        finally:
+            with self.db.engine.begin() as conn:
+                conn.execute(sqlalchemy.text('DROP TABLE migrate_test'))
+
+    def test_schema_check(self):
+        """
+        test that the static tables in schema.py match the migrated database
+        """
+        problems = self.io_loop.run_sync(
+            lambda: schema.check_schema(self.app_db.async_engine))
+        self.assertEqual(problems, [])
+
+    def test_pool_stats(self):
+        """
+        test that the pool gauges are configured from config.ini
+        and count checkouts
+        """
+        self.fetch('/entity/get/1')
+        response = self.fetch('/stats/pool')
+        self.assertEqual(response.code, 200)
+        stats = json.loads(response.body)
+        self.assertEqual(stats['size'], self.config['TEST'].getint('pool_size'))
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertGreaterEqual(stats['checkouts'], 1)
+
+    def test_connection_budget(self):
+        """
+        test that the pools of all workers and their LISTEN connections stay
+        within max_connections, and the replica's within max_connections_read
+        """
+        config = configparser.ConfigParser()
+        config.read_dict({'MODE': {'mode': 'TEST'}, 'TEST': dict(
+            max_connections='50', pool_size='5', pool_max_overflow='10',
+            product_cache_size='100', purchase_feed='true')})
+        main.apply_connection_budget(config, 4)
+        # 50 // 4 = 12, less a LISTEN connection each for the cache and the feed
+        self.assertEqual(
+            (config['TEST'].getint('pool_size'), config['TEST'].getint('pool_max_overflow')),
+            (5, 5))
+
+        config['TEST'].update(dict(
+            max_connections='16', pool_size='5', pool_max_overflow='10', product_cache_size='0',
+            database_url_async_read='postgresql+asyncpg://replica/db', max_connections_read='40'))
+        main.apply_connection_budget(config, 4)
+        self.assertEqual(
+            [config['TEST'].getint(key) for key in (
+                'pool_size', 'pool_max_overflow', 'read_pool_size', 'read_pool_max_overflow')],
+            [3, 0, 5, 5])
+
+        config['TEST']['max_connections'] = '4'
+        with self.assertRaises(ValueError):
+            main.apply_connection_budget(config, 4)
+
+    def test_supervisor(self):
+        """
+        test which exited workers the parent replaces, and the signals it
+        passes on to the workers
+        """
+        sent = []
+        supervisor = main.Supervisor(max_restarts=1, kill=lambda pid, signum: sent.append((pid, signum)))
+        for pid, id in ((10, 0), (11, 1), (12, 2)):
+            supervisor.started(pid, id)
+
+        # SIGHUP restarts one worker at a time, each once the last is replaced
+        supervisor.on_signal(signal.SIGHUP)
+        self.assertEqual(sent, [(10, signal.SIGHUP)])
+        self.assertEqual(supervisor.exited(10, main.EXIT_RESTART << 8), 0)
+        supervisor.started(20, 0)
+        self.assertEqual(sent[-1], (11, signal.SIGHUP))
+        self.assertEqual(supervisor.exited(11, main.EXIT_RESTART << 8), 1)
+        supervisor.started(21, 1)
+        self.assertEqual(sent[-1], (12, signal.SIGHUP))
+
+        # a crash is replaced up to max_restarts times, unknown pids are ignored
+        self.assertEqual(supervisor.exited(99, 0), None)
+        self.assertEqual(supervisor.exited(21, signal.SIGKILL), 1)
+        supervisor.started(31, 1)
+        with self.assertRaises(RuntimeError):
+            supervisor.exited(31, 1 << 8)
+
+        # once stopping, SIGHUP is ignored, nothing is replaced and a
+        # worker started meanwhile is stopped straight away
+        del sent[:]
+        supervisor.on_signal(signal.SIGTERM)
+        self.assertEqual(sorted(sent), [(12, signal.SIGTERM), (20, signal.SIGTERM)])
+        supervisor.on_signal(signal.SIGHUP)
+        self.assertEqual(supervisor.exited(12, main.EXIT_RESTART << 8), None)
+        supervisor.started(40, 2)
+        self.assertEqual(sent[-1], (40, signal.SIGTERM))
+        self.assertEqual(supervisor.exited(20, 0), None)
+        self.assertEqual(supervisor.exited(40, 0), None)
+        self.assertEqual(supervisor.children, {})
+
+    def test_metrics(self):
+        """
+        test that requests are counted by route pattern and queries are timed
+        """
+        self.fetch('/entity/get/1')
+        self.fetch('/entity/get/100')
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        body = response.body.decode()
+        route = '/entity/get/(?P<user_id>[0-9]*)'
+        self.assertIn(
+            'http_requests_total{route="%s",method="GET",status="200"} 1' % route, body)
+        self.assertIn(
+            'http_requests_total{route="%s",method="GET",status="400"} 1' % route, body)
+        self.assertIn(
+            'http_request_duration_seconds_count{route="%s",method="GET"} 2' % route, body)
+        self.assertIn('http_requests_in_flight{route="/metrics"} 1', body)
+        self.assertIn('db_query_duration_seconds_count{operation="SELECT"}', body)
+
+    def test_in_flight_abandoned(self):
+        """
+        test that a request whose client leaves before sending its whole
+        body is no longer counted as in flight
+        """
+        async def abandon():
+            stream = await tornado.tcpclient.TCPClient().connect('127.0.0.1', self.get_http_port())
+            await stream.write(
+                b'POST /purchase/add HTTP/1.1\r\nHost: localhost\r\n'
+                b'Content-Length: 100\r\n\r\n{"buyr_id": 1')
+            while self._app.in_flight == 0:
+                await asyncio.sleep(0.01)
+            stream.close()
+            for _ in range(100):
+                if self._app.in_flight == 0:
+                    break
+                await asyncio.sleep(0.01)
+
+        self.io_loop.run_sync(abandon)
+        self.assertEqual(self._app.in_flight, 0)
+        body = self.fetch('/metrics').body.decode()
+        self.assertIn(
+            'http_requests_in_flight{route="/purchase/add"} 0', body)
+
+    def test_serialize_rows(self):
+        """
+        test that rows of different results are encoded with their own keys,
+        with either serializer
+        """
+        with self.db.engine.begin() as conn:
+            entities = conn.execute(sqlalchemy.text(
+                'SELECT id, carbon_cost FROM entity WHERE id < 3 ORDER BY id')).all()
+            product = conn.execute(sqlalchemy.text(
+                'SELECT id, item_name FROM product WHERE id = 1')).one()
+        expected = [
+            [row._asdict() for row in entities], product._asdict(), entities[0]._asdict()]
+        for name in ('json', 'orjson'):
+            serializer = get_serializer(name)
+            data = serializer.dumps([entities, product, entities[0]])
+            self.assertEqual(serializer.loads(data), expected)
+
+    def test_server_timing(self):
+        """
+        test that the database time and query count of a request are reported,
+        without the statements outside debug mode
+        """
+        response = self.fetch('/entity/get/1')
+        self.assertEqual(response.code, 200)
+        timing = response.headers['Server-Timing']
+        self.assertTrue(timing.startswith('db;dur='))
+        self.assertIn('desc="1 queries"', timing)
+        self.assertIn('pool;dur=', timing)
+        self.assertNotIn('q0;', timing)
+
     def test_purchase_get_missing(self):
         response = self.fetch(
             path='/purchase/get/100',
@@ -101,6 +341,25 @@ class TestApp(tornado.testing.AsyncHTTPTestCase):
         del json_body['ts']
         self.assertEqual(expected_result, json_body)
 
+    def test_purchase_get_multi(self):
+        """
+        test that several purchases are returned with their items,
+        and that missing ids are reported instead of failing
+        """
+        response = self.fetch(
+            path='/purchase/get?ids=2,3,100',
+            method='GET'
+        )
+        self.assertEqual(response.code, 200)
+        json_body = json.loads(response.body)
+        self.assertEqual(json_body['missing'], [100])
+        self.assertEqual(sorted(json_body['data']), ['2', '3'])
+        self.assertEqual(
+            json_body['data']['2']['item_list'],
+            [{"prch_id": 2, "comp_id": 12, "prod_id": 6}]
+        )
+        self.assertEqual(json_body['data']['3']['item_list'], [])
+
     def test_purchase_add_no_product_info(self):
         """
         tests the case where no items in the transactions were provided
@@ -211,6 +470,441 @@ class TestApp(tornado.testing.AsyncHTTPTestCase):
             result = sorted(list(map(tuple, result)))
             self.assertEqual(expected_products_purchased, result)
 
+    def test_purchase_add_batch(self):
+        """
+        tests that a batch of purchases is added in input order,
+        with each purchase keeping its own items
+        """
+        query = '''
+        {
+            "purchase_list": [
+                {
+                    "buyr_id": 4,
+                    "selr_id": 6,
+                    "price": 100,
+                    "carbon_cost": 10,
+                    "item_list": [
+                        {
+                            "prod_id": 1,
+                            "comp_id": 6
+                        }
+                    ]
+                },
+                {
+                    "buyr_id": 5,
+                    "selr_id": 7,
+                    "price": 200,
+                    "carbon_cost": null,
+                    "item_list": null
+                },
+                {
+                    "buyr_id": 3,
+                    "selr_id": 6,
+                    "price": 300,
+                    "carbon_cost": 30,
+                    "item_list": [
+                        {
+                            "prod_id": 3,
+                            "comp_id": 6
+                        },
+                        {
+                            "prod_id": 2,
+                            "comp_id": null
+                        }
+                    ]
+                }
+            ]
+        }
+        '''
+        # buyr_id, self_id, price, carbon_cost
+        expected_purchases = [
+            (4, 6, 100, 10),
+            (5, 7, 200, None),
+            (3, 6, 300, 30)
+        ]
+        # prod_id, comp_id
+        expected_products_purchased = [
+            [(1, 6)],
+            [],
+            [(2, None), (3, 6)]
+        ]
+
+        response = self.fetch(
+            path='/purchase/add/batch',
+            method='POST',
+            body=query
+        )
+        self.assertEqual(response.code, 200)
+        json_body = json.loads(response.body)
+        prch_ids = json_body['data']['prch_ids']
+        self.assertEqual(len(prch_ids), 3)
+
+        table_purchase = self.db.metadata.tables['purchase']
+        table_products_purchased = self.db.metadata.tables['products_purchased']
+        with self.db.engine.begin() as conn:
+            for prch_id, expected_purchase, expected_items in zip(
+                    prch_ids, expected_purchases, expected_products_purchased):
+                stmt = sqlalchemy\
+                    .select(
+                        table_purchase.c.buyr_id,
+                        table_purchase.c.selr_id,
+                        table_purchase.c.price,
+                        table_purchase.c.carbon_cost
+                    )\
+                    .where(table_purchase.c.id == prch_id)
+                self.assertEqual(conn.execute(stmt).one(), expected_purchase)
+
+                stmt2 = sqlalchemy\
+                    .select(
+                        table_products_purchased.c.prod_id,
+                        table_products_purchased.c.comp_id,
+                    )\
+                    .where(table_products_purchased.c.prch_id == prch_id)
+                result = sorted(map(tuple, conn.execute(stmt2)),
+                                key=lambda x: x[0])
+                self.assertEqual(expected_items, result)
+
+    def test_purchase_add_coalesced(self):
+        """
+        tests that concurrent adds are written together when coalescing,
+        and that a purchase that cannot be written only fails its own request
+        """
+        coalescer = PurchaseCoalescer(
+            self.app_db.async_engine, self.app_db.stmts, window_ms=50, max_batch=10)
+        self.app_db.purchase_coalescer = coalescer
+        # buyer 100 does not exist
+        buyers = [1, 2, 100, 3]
+
+        def add(buyr_id):
+            return self.http_client.fetch(
+                self.get_url('/purchase/add'),
+                method='POST',
+                raise_error=False,
+                body=json.dumps(dict(
+                    buyr_id=buyr_id, selr_id=6, price=buyr_id, carbon_cost=None,
+                    item_list=[dict(prod_id=1, comp_id=6)]))
+            )
+
+        responses = self.io_loop.run_sync(
+            lambda: asyncio.gather(*[add(buyr_id) for buyr_id in buyers]))
+        self.assertEqual([r.code for r in responses], [200, 200, 500, 200])
+        body = self.fetch('/metrics').body.decode()
+        self.assertIn('purchase_coalescer{stat="batches"} 1', body)
+        self.assertIn('purchase_coalescer{stat="retried_batches"} 1', body)
+
+        table_purchase = self.db.metadata.tables['purchase']
+        with self.db.engine.begin() as conn:
+            for buyr_id, response in zip(buyers, responses):
+                if response.code != 200:
+                    continue
+                prch_id = json.loads(response.body)['data']['prch_id']
+                stmt = sqlalchemy\
+                    .select(table_purchase.c.buyr_id, table_purchase.c.price)\
+                    .where(table_purchase.c.id == prch_id)
+                self.assertEqual(conn.execute(stmt).one(), (buyr_id, buyr_id))
+
+    def test_purchase_add_coalesced_cancelled(self):
+        """
+        tests that the callers of a batch whose write is cancelled get an
+        error rather than waiting forever
+        """
+        coalescer = PurchaseCoalescer(
+            self.app_db.async_engine, self.app_db.stmts, window_ms=1000, max_batch=2)
+        purchase = dict(buyr_id=1, selr_id=6, price=1, carbon_cost=None, item_list=None)
+
+        async def add_and_cancel():
+            adds = [asyncio.ensure_future(coalescer.add(dict(purchase))) for _ in range(2)]
+            # the second add flushes the batch
+            await asyncio.sleep(0)
+            for task in list(coalescer.writes):
+                task.cancel()
+            return await asyncio.gather(*adds, return_exceptions=True)
+
+        results = self.io_loop.run_sync(add_and_cancel, timeout=5)
+        self.assertEqual([type(result) for result in results], [RuntimeError, RuntimeError])
+        self.assertEqual(coalescer.writes, set())
+
+    def test_purchase_feed(self):
+        """
+        tests that added purchases are streamed to feed subscribers,
+        filtered by buyer
+        """
+        chunks = []
+        stream = self.http_client.fetch(
+            self.get_url('/purchase/feed?buyr_id=4'),
+            streaming_callback=chunks.append, request_timeout=10)
+
+        async def wait_for(text):
+            while text not in b''.join(chunks):
+                await asyncio.sleep(0.01)
+
+        self.io_loop.run_sync(lambda: wait_for(b': subscribed'), timeout=5)
+        for buyr_id in (1, 4):
+            response = self.fetch('/purchase/add', method='POST', body=json.dumps(dict(
+                buyr_id=buyr_id, selr_id=6, price=123, carbon_cost=345, item_list=None)))
+            self.assertEqual(response.code, 200)
+        prch_id = json.loads(response.body)['data']['prch_id']
+        self.io_loop.run_sync(lambda: wait_for(b'event: add'), timeout=5)
+        body = self.fetch('/metrics').body.decode()
+        self.assertIn('purchase_feed{stat="subscribers"} 1', body)
+        self.assertIn('purchase_feed{stat="listening"} 1', body)
+        # ends the stream
+        self.io_loop.run_sync(self.app_db.purchase_feed.close)
+        self.io_loop.run_sync(lambda: stream)
+
+        events = [
+            json.loads(line[len('data: '):])
+            for line in b''.join(chunks).decode().splitlines()
+            if line.startswith('data: ')
+        ]
+        self.assertEqual(len(events), 1)
+        self.assertEqual(
+            (events[0]['op'], events[0]['id'], events[0]['buyr_id'], events[0]['price']),
+            ('add', prch_id, 4, 123))
+
+    def test_purchase_feed_reconnect_cancelled(self):
+        """
+        tests that subscriptions are ended when the feed stops trying to
+        reconnect, rather than left waiting for changes
+        """
+        feed = self.app_db.purchase_feed
+        subscription = self.io_loop.run_sync(feed.subscribe)
+        pid = feed.conn.get_server_pid()
+        feed.dsn = 'postgresql://postgres@127.0.0.1:1/testdb'
+        with self.db.engine.begin() as conn:
+            conn.execute(sqlalchemy.text('SELECT pg_terminate_backend(:pid)'), dict(pid=pid))
+
+        async def until_reconnecting():
+            while feed.reconnects == 0:
+                await asyncio.sleep(0.01)
+        self.io_loop.run_sync(until_reconnecting, timeout=5)
+        feed.reconnecting.cancel()
+        self.assertIsNone(self.io_loop.run_sync(subscription.get, timeout=5))
+        self.assertEqual(feed.stats()['subscribers'], 0)
+
+    def test_purchase_export(self):
+        """
+        tests that purchases are exported as csv with a row per item,
+        and as ndjson with an item_list per purchase
+        """
+        path = '/purchase/export?start_ts=145435764&end_ts=2645435774&items=true'
+        response = self.fetch(path)
+        self.assertEqual(response.code, 200)
+        lines = response.body.decode().splitlines()
+        self.assertEqual(
+            lines[0], 'id,buyr_id,selr_id,price,carbon_cost,ts,comp_id,prod_id')
+        self.assertEqual(
+            [line.split(',')[0] for line in lines[1:]], ['1', '1', '2', '3'])
+
+        response = self.fetch(path + '&format=ndjson&buyr_id=1')
+        self.assertEqual(response.code, 200)
+        purchases = [json.loads(line) for line in response.body.decode().splitlines()]
+        self.assertEqual(
+            [(purchase['id'], len(purchase['item_list'])) for purchase in purchases],
+            [(1, 2)])
+
+        response = self.fetch(path + '&format=ndjson&buyr_id=1&ts_format=unix')
+        self.assertEqual(response.code, 200)
+        unix_ts = json.loads(response.body)['ts']
+        with self.db.engine.begin() as conn:
+            ts = conn.execute(sqlalchemy.text('SELECT ts FROM purchase WHERE id = 1')).scalar()
+        self.assertEqual(datetime.datetime.fromtimestamp(unix_ts), ts)
+
+        for query in ('start_ts=abc&end_ts=1', 'start_ts=1&end_ts=inf',
+                      'start_ts=1&end_ts=2&buyr_id=abc', 'start_ts=1&end_ts=2&ts_format=x'):
+            response = self.fetch('/purchase/export?' + query)
+            self.assertEqual(response.code, 400, query)
+
+    def test_bulk_load(self):
+        """
+        tests that bulk loaded purchases keep their items linked,
+        across several chunks
+        """
+        purchases = [
+            dict(buyr_id=1, selr_id=6, price=i, carbon_cost=None, ts=1645435764,
+                 item_list=[dict(prod_id=1, comp_id=6)] * (i % 3))
+            for i in range(5)
+        ]
+        n_purchases, n_items = self.io_loop.run_sync(lambda: bulk_load.load(
+            self.config['TEST']['database_url'], purchases, chunk_size=2))
+        # i % 3 items each
+        self.assertEqual((n_purchases, n_items), (5, 4))
+
+        table_purchase = self.db.metadata.tables['purchase']
+        table_products_purchased = self.db.metadata.tables['products_purchased']
+        stmt = sqlalchemy\
+            .select(table_purchase.c.price, sqlalchemy.func.count(table_products_purchased.c.prch_id))\
+            .select_from(table_purchase)\
+            .outerjoin(table_products_purchased, table_purchase.c.id == table_products_purchased.c.prch_id)\
+            .where(table_purchase.c.ts == datetime.datetime.fromtimestamp(1645435764))\
+            .group_by(table_purchase.c.id, table_purchase.c.ts)
+        with self.db.engine.begin() as conn:
+            result = sorted(map(tuple, conn.execute(stmt)))
+        self.assertEqual(result, [(i, i % 3) for i in range(5)])
+
+    def test_bulk_load_default_partition(self):
+        """
+        tests that bulk loading into months without a partition moves
+        their rows already in the default partition into the new one
+        """
+        with self.db.engine.begin() as conn:
+            conn.execute(sqlalchemy.text('''
+                INSERT INTO purchase (buyr_id, selr_id, price, ts)
+                VALUES (1, 6, 101, '2019-05-10'), (1, 6, 102, '2019-06-10')
+            '''))
+        purchases = [
+            dict(buyr_id=1, selr_id=6, price=price, carbon_cost=None,
+                 ts=datetime.datetime(2019, month, 20).timestamp(),
+                 item_list=[dict(prod_id=1, comp_id=6)])
+            for price, month in ((103, 5), (104, 6))
+        ]
+        self.io_loop.run_sync(lambda: bulk_load.load(
+            self.config['TEST']['database_url'], purchases))
+
+        with self.db.engine.begin() as conn:
+            rows = conn.execute(sqlalchemy.text('''
+                SELECT price, tableoid::regclass::text FROM purchase
+                WHERE price BETWEEN 101 AND 104 ORDER BY price
+            ''')).all()
+        self.assertEqual([tuple(row) for row in rows], [
+            (101, 'purchase_p2019_05'), (102, 'purchase_p2019_06'),
+            (103, 'purchase_p2019_05'), (104, 'purchase_p2019_06')])
+
+    def test_bench_generate(self):
+        """
+        tests that the benchmark generates a small dataset, serves the app
+        from a child process and drives it without errors
+        """
+        endpoints = ['entity_get', 'purchase_get', 'purchase_add']
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'bench.json')
+            subprocess.run([
+                sys.executable, '-m', 'bench.run', '--mode', 'TEST', '--generate',
+                '--entities', '20', '--companies', '5', '--products', '10',
+                '--company-products', '20', '--purchases', '50',
+                '--endpoints', ','.join(endpoints), '--requests', '20',
+                '--warm-up', '0', '--concurrency', '4', '--output', output
+            ], check=True, timeout=120)
+            with open(output) as f:
+                results = json.load(f)
+        self.assertEqual(
+            {name: result['errors'] for name, result in results['endpoints'].items()},
+            {name: 0 for name in endpoints})
+
+    def test_partitions(self):
+        """
+        tests that purchases land in their month's partition, that a time
+        bounded query only scans that month, and that detaching the month
+        removes its purchases and items
+        """
+        dsn = self.config['TEST']['database_url']
+        purchases = [
+            dict(buyr_id=1, selr_id=6, price=100, carbon_cost=None,
+                 ts=datetime.datetime(2020, 1, 15).timestamp(),
+                 item_list=[dict(prod_id=1, comp_id=6)])
+        ]
+        self.io_loop.run_sync(lambda: bulk_load.load(dsn, purchases))
+
+        with self.db.engine.begin() as conn:
+            partition = conn.execute(sqlalchemy.text('''
+                SELECT tableoid::regclass::text FROM purchase WHERE price = 100
+            ''')).scalar()
+            plan = '\n'.join(row[0] for row in conn.execute(sqlalchemy.text('''
+                EXPLAIN SELECT * FROM purchase
+                WHERE buyr_id = 1 AND ts > '2020-01-01' AND ts < '2020-02-01'
+            ''')))
+        self.assertEqual(partition, 'purchase_p2020_01')
+        self.assertIn('purchase_p2020_01', plan)
+        self.assertNotIn('purchase_default', plan)
+
+        # writers look purchases up by id and ts, which only reads their
+        # own partition, the notifications are rolled back
+        with self.db.engine.connect() as conn:
+            prch_id, ts = conn.execute(sqlalchemy.text(
+                'SELECT id, ts FROM purchase WHERE price = 100')).one()
+            stmt = self.app_db.stmts.purchase_notify.compile(dialect=self.db.engine.dialect)
+            scanned = [row[0] for row in conn.exec_driver_sql(
+                'EXPLAIN (ANALYZE, COSTS OFF) ' + str(stmt),
+                stmt.construct_params(dict(prch_ids=[prch_id], prch_tss=[ts], op='add'))
+            ) if ' on purchase_' in row[0] and 'never executed' not in row[0]]
+            conn.rollback()
+        self.assertEqual(len(scanned), 1)
+        self.assertIn(' on purchase_p2020_01 ', scanned[0])
+
+        detached = self.io_loop.run_sync(lambda: partitions.detach(
+            dsn, datetime.date(2020, 2, 1), drop=True))
+        self.assertEqual(detached, [datetime.date(2020, 1, 1)])
+        with self.db.engine.begin() as conn:
+            counts = conn.execute(sqlalchemy.text('''
+                SELECT
+                    (SELECT count(*) FROM purchase WHERE price = 100),
+                    (SELECT count(*) FROM products_purchased WHERE prch_ts < '2020-02-01')
+            ''')).one()
+        self.assertEqual(tuple(counts), (0, 0))
+        # the fixture purchases are untouched
+        response = self.fetch('/purchase/get/1')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(len(json.loads(response.body)['item_list']), 2)
+
+    def test_purchase_recompute(self):
+        """
+        tests that purchases with items are costed from company_product,
+        and purchases without items from the seller's carbon cost
+        """
+        response = self.fetch(
+            path='/purchase/recompute',
+            method='POST',
+            body=json.dumps(dict(prch_ids=[2, 3, 100]))
+        )
+        self.assertEqual(response.code, 200)
+        json_body = json.loads(response.body)
+        # lenova laptop from company_product, uniglo 5 g / dollar * $10
+        self.assertEqual(json_body['data']['carbon_cost'], {'2': 130000, '3': 50})
+        self.assertEqual(json_body['data']['missing'], [100])
+
+        table_purchase = self.db.metadata.tables['purchase']
+        stmt = sqlalchemy\
+            .select(table_purchase.c.carbon_cost)\
+            .where(table_purchase.c.id == 3)
+        with self.db.engine.begin() as conn:
+            self.assertEqual(conn.execute(stmt).scalar(), 50)
+
+    def test_offline_recompute(self):
+        """
+        tests that a dry run reports the changed costs without writing them,
+        and that the written costs match /purchase/recompute
+        """
+        dsn = self.config['TEST']['database_url']
+        table_purchase = self.db.metadata.tables['purchase']
+        stmt = sqlalchemy.select(table_purchase.c.id, table_purchase.c.carbon_cost)
+
+        with self.db.engine.begin() as conn:
+            before = dict(map(tuple, conn.execute(stmt)))
+        dry_run = self.io_loop.run_sync(lambda: recompute.recompute(dsn, dry_run=True))
+        with self.db.engine.begin() as conn:
+            self.assertEqual(dict(map(tuple, conn.execute(stmt))), before)
+        self.assertEqual(dry_run['purchases'], len(before))
+        self.assertEqual(dry_run['updated'], 0)
+
+        totals = self.io_loop.run_sync(lambda: recompute.recompute(dsn))
+        self.assertEqual(totals['updated'], dry_run['changed'])
+        with self.db.engine.begin() as conn:
+            after = dict(map(tuple, conn.execute(stmt)))
+        # lenova laptop from company_product, uniglo 5 g / dollar * $10
+        self.assertEqual((after[2], after[3]), (130000, 50))
+
+        response = self.fetch(
+            path='/purchase/recompute',
+            method='POST',
+            body=json.dumps(dict(prch_ids=list(after)))
+        )
+        self.assertEqual(response.code, 200)
+        computed = json.loads(response.body)['data']['carbon_cost']
+        self.assertEqual({int(k): v for k, v in computed.items()}, after)
+        # nothing is left to change
+        again = self.io_loop.run_sync(lambda: recompute.recompute(dsn, dry_run=True))
+        self.assertEqual(again['changed'], 0)
+
     def test_purchase_update_missing(self):
         """
         test that purchase update fails when prch_id not in table
@@ -407,6 +1101,133 @@ class TestApp(tornado.testing.AsyncHTTPTestCase):
         json_body = json.loads(response.body)
         self.assertEqual(json_body, expected)
 
+    def test_product_get_cached(self):
+        """
+        test that repeated product gets are served from the cache,
+        and that updating the product invalidates the cached entry
+        """
+        # the cache is off until its invalidation listener is connected
+        self.io_loop.run_sync(self.app_db.product_cache_invalidator.listen)
+        for _ in range(2):
+            response = self.fetch(path='/product/get/6/1', method='GET')
+            self.assertEqual(json.loads(response.body)['carbon_cost'], 2300)
+        stats = json.loads(self.fetch('/stats/cache').body)['product_cache']
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+        response = self.fetch(
+            path='/product/update',
+            method='POST',
+            body=json.dumps(dict(prod_id=1, comp_id=6, carbon_cost=1000))
+        )
+        self.assertEqual(response.code, 200)
+        response = self.fetch(path='/product/get/6/1', method='GET')
+        self.assertEqual(json.loads(response.body)['carbon_cost'], 1000)
+
+    def test_product_cache_invalidated_by_other_process(self):
+        """
+        test that a product updated outside this process, with the
+        notification another worker sends, is dropped from the cache
+        """
+        self.io_loop.run_sync(self.app_db.product_cache_invalidator.listen)
+        response = self.fetch('/product/get/1')
+        etag = response.headers['Etag']
+        self.assertEqual(self.fetch('/product/get/1').code, 200)
+        self.assertIsNotNone(self.app_db.product_cache.get(('product', 1)))
+
+        with self.db.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(
+                'UPDATE product SET carbon_cost = 1000 WHERE id = 1'))
+            conn.execute(sqlalchemy.text(
+                "SELECT pg_notify('product_cache_invalidate', 'product:1')"))
+
+        async def until_invalidated():
+            while self.app_db.product_cache.get(('product', 1)) is not None:
+                await asyncio.sleep(0.01)
+        self.io_loop.run_sync(until_invalidated, timeout=5)
+        response = self.fetch('/product/get/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['carbon_cost'], 1000)
+
+    def test_product_cache_listener_lost(self):
+        """
+        test that the cache is cleared and off while its invalidation
+        listener is reconnecting, and on again once it is back
+        """
+        invalidator = self.app_db.product_cache_invalidator
+        self.io_loop.run_sync(invalidator.listen)
+        self.assertEqual(self.fetch('/product/get/1').code, 200)
+        pid = invalidator.conn.get_server_pid()
+        # refused, so every reconnect fails until the dsn is put back
+        dsn, invalidator.dsn = invalidator.dsn, 'postgresql://postgres@127.0.0.1:1/testdb'
+        with self.db.engine.begin() as conn:
+            conn.execute(sqlalchemy.text('SELECT pg_terminate_backend(:pid)'), dict(pid=pid))
+
+        async def until(condition):
+            while not condition():
+                await asyncio.sleep(0.01)
+        self.io_loop.run_sync(lambda: until(lambda: invalidator.conn is None), timeout=5)
+        self.assertFalse(self.app_db.product_cache.enabled)
+        self.assertIsNone(self.app_db.product_cache.get(('product', 1)))
+        invalidator.dsn = dsn
+        self.io_loop.run_sync(lambda: until(lambda: invalidator.conn is not None), timeout=5)
+        self.assertTrue(self.app_db.product_cache.enabled)
+
+    def test_product_get_etag(self):
+        """
+        test that a product get with the current ETag is answered with 304,
+        and that updating the product changes its ETag
+        """
+        response = self.fetch('/product/get/1')
+        self.assertEqual(response.code, 200)
+        etag = response.headers['Etag']
+        self.assertNotIn('version', json.loads(response.body))
+
+        response = self.fetch('/product/get/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b'')
+
+        response = self.fetch(
+            path='/product/update',
+            method='POST',
+            body=json.dumps(dict(prod_id=1, comp_id=None, carbon_cost=1000))
+        )
+        self.assertEqual(response.code, 200)
+        response = self.fetch('/product/get/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+        self.assertEqual(json.loads(response.body)['carbon_cost'], 1000)
+
+    def test_entity_get_etag(self):
+        """
+        test that an entity get with the current ETag is answered with 304
+        """
+        response = self.fetch('/entity/get/1')
+        etag = response.headers['Etag']
+        response = self.fetch('/entity/get/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        response = self.fetch('/entity/get/1', headers={'If-None-Match': '"0"'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['display_name'], 'Albert')
+
+    def test_product_get_multi(self):
+        """
+        test that batch product and company product gets return a keyed map,
+        reporting missing ids separately
+        """
+        response = self.fetch(path='/product/get?ids=1,100,2', method='GET')
+        self.assertEqual(response.code, 200)
+        json_body = json.loads(response.body)
+        self.assertEqual(json_body['missing'], [100])
+        self.assertEqual(json_body['data']['2']['item_name'], 'cheese')
+
+        response = self.fetch(
+            path='/product/company/get?pairs=6:1,7:1,12:6', method='GET')
+        self.assertEqual(response.code, 200)
+        json_body = json.loads(response.body)
+        self.assertEqual(json_body['missing'], ['7:1'])
+        self.assertEqual(json_body['data']['6:1']['carbon_cost'], 2300)
+        self.assertEqual(json_body['data']['12:6']['carbon_cost'], 130000)
+
     def test_product_add(self):
         query = '''
         {
@@ -431,6 +1252,35 @@ class TestApp(tornado.testing.AsyncHTTPTestCase):
             result = conn.execute(stmt)
             self.assertIn(expected_company_product, result)
 
+        response = self.fetch(path='/product/add', method='POST', body=query)
+        self.assertEqual(response.code, 400)
+        with self.db.engine.begin() as conn:
+            self.assertIn(expected_company_product, conn.execute(stmt))
+
+    def test_product_update_missing(self):
+        """
+        test that product update fails for every kind of missing row
+        """
+        for query in [
+            dict(prod_id=None, comp_id=100, carbon_cost=1000),
+            dict(prod_id=100, comp_id=None, carbon_cost=1000),
+            dict(prod_id=1, comp_id=7, carbon_cost=1000)
+        ]:
+            response = self.fetch(
+                path='/product/update',
+                method='POST',
+                body=json.dumps(query)
+            )
+            self.assertEqual(response.code, 400)
+
+    def test_invalid_json_body(self):
+        """
+        test that a body that is not JSON is rejected rather than a 500
+        """
+        for path in ['/purchase/add', '/product/update', '/entity/update']:
+            response = self.fetch(path=path, method='POST', body='{"id": ')
+            self.assertEqual(response.code, 400)
+
     def test_product_update_prod_id_none(self):
         query = '''
         {
@@ -528,6 +1378,14 @@ class TestApp(tornado.testing.AsyncHTTPTestCase):
         json_body = json.loads(response.body)
         self.assertEqual(expected, json_body)
 
+    def test_entity_get_multi(self):
+        response = self.fetch(path='/entity/get?ids=1,6,100', method='GET')
+        self.assertEqual(response.code, 200)
+        json_body = json.loads(response.body)
+        self.assertEqual(json_body['missing'], [100])
+        self.assertEqual(json_body['data']['6']['display_name'], 'Sainsburrows')
+        self.assertEqual(json_body['data']['1']['display_name'], 'Albert')
+
     def test_entity_purchases_get(self):
         expected = json.loads('''
         {
@@ -554,6 +1412,114 @@ class TestApp(tornado.testing.AsyncHTTPTestCase):
             purchase.pop('ts')
         self.assertEqual(expected, json_body)
 
+    def test_entity_purchases_get_paginated(self):
+        """
+        test that pages follow (ts, id) order without gaps or repeats,
+        and that streaming returns the same page
+        """
+        purchase = dict(buyr_id=5, selr_id=6, price=1,
+                        carbon_cost=0, item_list=None)
+        response = self.fetch(
+            path='/purchase/add/batch',
+            method='POST',
+            body=json.dumps(dict(purchase_list=[purchase] * 3))
+        )
+        prch_ids = json.loads(response.body)['data']['prch_ids']
+
+        path = '/entity/purchases/get/5?start_ts=145435764&end_ts=2645435774&limit=2'
+        response = self.fetch(path=path, method='GET')
+        self.assertEqual(response.code, 200)
+        page_1 = json.loads(response.body)
+        self.assertEqual(
+            [p['id'] for p in page_1['purchase_list']], prch_ids[:2])
+        self.assertIsNotNone(page_1['next_cursor'])
+
+        response = self.fetch(
+            path=path + '&cursor=' + page_1['next_cursor'], method='GET')
+        page_2 = json.loads(response.body)
+        self.assertEqual(
+            [p['id'] for p in page_2['purchase_list']], prch_ids[2:])
+        self.assertIsNone(page_2['next_cursor'])
+
+        response = self.fetch(path=path + '&stream=true', method='GET')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body), page_1)
+
+        path = '/entity/purchases/get/5?start_ts=145435764&end_ts=2645435774'
+        for query in ('&limit=abc', '&limit=0', '&limit=%d' % 2 ** 40, '&cursor=abc',
+                      '&cursor=WzFd', '&limit=2&cursor=e30='):
+            response = self.fetch(path=path + query, method='GET')
+            self.assertEqual(response.code, 400, query)
+
+    def test_entity_carbon_get(self):
+        """
+        test that the daily rollups follow purchase adds and updates
+        """
+        def expected_series():
+            table_purchase = self.db.metadata.tables['purchase']
+            day = sqlalchemy.cast(table_purchase.c.ts, sqlalchemy.Date)
+            stmt = sqlalchemy\
+                .select(
+                    day,
+                    sqlalchemy.func.count(),
+                    sqlalchemy.func.sum(table_purchase.c.price),
+                    sqlalchemy.func.coalesce(sqlalchemy.func.sum(table_purchase.c.carbon_cost), 0)
+                )\
+                .where(table_purchase.c.buyr_id == 4)\
+                .group_by(day)\
+                .order_by(day)
+            with self.db.engine.begin() as conn:
+                return [tuple(row)[1:] for row in conn.execute(stmt)]
+
+        def series():
+            response = self.fetch(
+                path='/entity/carbon/get/4?start_ts=145435764&end_ts=2645435774&bucket=day',
+                method='GET'
+            )
+            self.assertEqual(response.code, 200)
+            return [
+                (row['purchase_count'], row['price'], row['carbon_cost'])
+                for row in json.loads(response.body)['series']
+            ]
+
+        response = self.fetch(
+            path='/purchase/add',
+            method='POST',
+            body=json.dumps(dict(buyr_id=4, selr_id=6, price=500,
+                                 carbon_cost=70, item_list=None))
+        )
+        prch_id = json.loads(response.body)['data']['prch_id']
+        self.assertEqual(series(), expected_series())
+
+        response = self.fetch(
+            path='/purchase/update',
+            method='POST',
+            body=json.dumps(dict(prch_id=prch_id, buyr_id=4, selr_id=6,
+                                 price=900, carbon_cost=80, item_list=None))
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(series(), expected_series())
+
+        # moving the purchase to another buyer empties buyer 4's day
+        response = self.fetch(
+            path='/purchase/update',
+            method='POST',
+            body=json.dumps(dict(prch_id=prch_id, buyr_id=5, selr_id=6,
+                                 price=900, carbon_cost=80, item_list=None))
+        )
+        self.assertEqual(response.code, 200)
+        self.assertEqual(series(), expected_series())
+        with self.db.engine.begin() as conn:
+            empty = conn.execute(sqlalchemy.text(
+                'SELECT count(*) FROM entity_daily_rollup WHERE purchase_count = 0')).scalar()
+        self.assertEqual(empty, 0)
+
+        response = self.fetch(
+            path='/entity/carbon/get/4?start_ts=145435764&end_ts=2645435774&bucket=year',
+            method='GET'
+        )
+        self.assertEqual(response.code, 400)
+
     def test_entity_update_missing(self):
         """
         test update fails when entity id not in table
@@ -606,3 +1572,34 @@ class TestApp(tornado.testing.AsyncHTTPTestCase):
         with self.db.engine.begin() as conn:
             for row in conn.execute(stmt):
                 self.assertEqual(expected_result, row)
+
+    def test_read_replica(self):
+        """
+        test that GET requests read from the replica, and from the primary
+        when they ask to read their own writes
+        Needs database_url_async_read in the TEST section, pointing at a
+        streaming replica of the test database
+        """
+        if not self.config['TEST'].get('database_url_async_read'):
+            self.skipTest('no read replica configured')
+
+        def checkouts():
+            return (self.app_db.async_engine.pool.stats()['checkouts'],
+                    self.app_db.read_engine.pool.stats()['checkouts'])
+
+        before = checkouts()
+        response = self.fetch('/entity/get/1')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(checkouts(), (before[0], before[1] + 1))
+
+        response = self.fetch('/entity/update', method='POST', body=json.dumps(
+            dict(id=1, carbon_offset=10, carbon_cost=10)))
+        self.assertEqual(response.code, 200)
+        before = checkouts()
+        response = self.fetch('/entity/get/1', headers={'X-Read-Primary': 'true'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['carbon_offset'], 10)
+        self.assertEqual(checkouts(), (before[0] + 1, before[1]))
+
+        response = self.fetch('/stats/pool')
+        self.assertIn('replica', json.loads(response.body))